@@ -0,0 +1,90 @@
+"""Benchmark simulation tick throughput on the shipped maps.
+
+    python run_bench.py --output bench.json
+    python run_bench.py level2 prototype --ticks 20000
+    python run_bench.py --replay boss.replay
+
+Runs headless (no window, GL or audio).  For every map it reports ticks
+per second, p50/p99 tick latency and the net growth in live memory
+blocks per tick, and writes the lot to a JSON file you can diff between
+commits.  With --replay it
+plays back games recorded with run_game.py --record instead.
+"""
+import argparse
+import sys
+
+if sys.version_info < (3, 6):
+    sys.exit(
+        "This game requires Python 3.6 or later."
+    )
+
+import os
+from pathlib import Path
+
+
+dist = Path(__file__).parent.resolve()
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+parser.add_argument(
+    'maps', nargs='*',
+    help="basenames of maps in src/maps (default: every level*.tmx and prototype)"
+)
+parser.add_argument('--ticks', type=int, default=6000,
+    help="timed ticks per map (default: 6000)")
+parser.add_argument('--warmup', type=int, default=240,
+    help="untimed ticks before timing starts (default: 240)")
+parser.add_argument('--robots', type=int, default=40,
+    help="number of robots to keep alive (default: 40)")
+parser.add_argument('--seed', type=int, default=24,
+    help="random seed (default: 24)")
+parser.add_argument('--no-swarm', dest='swarm', action='store_false',
+    help="update plain bullets one at a time rather than with BulletSwarm")
+parser.add_argument('--no-lod', dest='lod', action='store_false',
+    help="keep every robot awake, rather than letting the ones far off screen doze")
+parser.add_argument('--no-sweep', dest='sweep', action='store_false',
+    help="don't sweep fast bullets for walls before each physics step")
+parser.add_argument('--no-point-blank', dest='point_blank', action='store_false',
+    help="don't also fire point-blank past wall corners on level1")
+parser.add_argument('--hz', type=int,
+    help="engine ticks per second (default: the game's ENGINE_TICKS_IN_HERTZ)")
+parser.add_argument('--replay', action='append', default=[], metavar='RECORDING',
+    help="play back a recording from run_game.py --record instead of "
+         "benchmarking the maps (may be given more than once)")
+parser.add_argument('--output', default='bench.json',
+    help="where to write the JSON results (default: bench.json)")
+args = parser.parse_args()
+
+# resolve these before we chdir into src
+output = os.path.abspath(args.output)
+replays = [os.path.abspath(path) for path in args.replay]
+
+src = str(dist / 'src')
+sys.path.insert(0, src)
+os.chdir(src)
+
+import bench
+
+maps = args.maps or bench.DEFAULT_MAPS
+point_blank = [m for m in maps if m in bench.POINT_BLANK_MAPS] if args.point_blank else []
+
+report = bench.run(
+    maps=maps,
+    ticks=args.ticks,
+    warmup=args.warmup,
+    robots=args.robots,
+    seed=args.seed,
+    swarm=args.swarm,
+    sweep=args.sweep,
+    hz=args.hz,
+    replays=replays,
+    lod=args.lod,
+    point_blank=point_blank,
+)
+bench.write_results(report, output)
+print(f"wrote {output}")
+
+if report['wall_blob_mismatches']:
+    sys.exit("collision.wall_blobs() disagrees with wall_blobs_python() on: "
+        + ", ".join(report['wall_blob_mismatches']))
+if args.sweep and bench.tunnelled(report):
+    sys.exit("bullets went through walls in: " + ", ".join(bench.tunnelled(report)))
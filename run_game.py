@@ -1,3 +1,12 @@
+"""Play My Sincere Apologies.
+
+    python run_game.py
+    python run_game.py --record boss.replay
+
+With --record, every keyboard and mouse event is written to a file
+when the game exits, for run_bench.py --replay to play back.
+"""
+import argparse
 import sys
 
 if sys.version_info < (3, 6):
@@ -11,10 +20,24 @@ from pathlib import Path
 
 dist = Path(__file__).parent.resolve()
 
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+parser.add_argument('--record', metavar='RECORDING',
+    help="record this game's input to RECORDING")
+parser.add_argument('--seed', type=int,
+    help="random seed to record with (default: pick one)")
+args = parser.parse_args()
+
+# resolve this before we chdir into src
+recording = args.record and os.path.abspath(args.record)
+
 src = str(dist / 'src')
 sys.path.insert(0, src)
 os.chdir(src)
 
+if recording:
+    import replay
+    replay.record(recording, args.seed)
+
 
 try:
     import main
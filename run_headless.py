@@ -0,0 +1,45 @@
+"""Run the game simulation without a window, GL context or audio.
+
+    python run_headless.py level1 --ticks 12000
+
+Steps the physics, player, robots and bullets at a fixed 120 Hz as fast
+as the CPU allows, then prints how many ticks per second that came to.
+"""
+import argparse
+import sys
+
+if sys.version_info < (3, 6):
+    sys.exit(
+        "This game requires Python 3.6 or later."
+    )
+
+import os
+from pathlib import Path
+
+
+dist = Path(__file__).parent.resolve()
+
+src = str(dist / 'src')
+sys.path.insert(0, src)
+os.chdir(src)
+
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+parser.add_argument(
+    'levels', nargs='*', default=['level1'],
+    help="basenames of maps in src/maps to run (default: level1)"
+)
+parser.add_argument(
+    '--ticks', type=int, default=12000,
+    help="number of 120 Hz ticks to run per level (default: 12000)"
+)
+args = parser.parse_args()
+
+import headless
+headless.enable()
+import main
+
+for basename in args.levels:
+    ticks, elapsed = main.run_headless(basename, args.ticks)
+    rate = ticks / elapsed if elapsed else float('inf')
+    print(f"{basename}: {ticks} ticks in {elapsed:.3f}s ({rate:.0f} ticks/sec)")
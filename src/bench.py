@@ -0,0 +1,435 @@
+"""Tick-throughput benchmarks for the headless simulation.
+
+Each scenario loads a map, drops a scripted player into it, keeps a crowd
+of robots from spawn_robot() alive, and holds down the fire button while
+cycling through every entry in weapon_matrix.  We time every tick and
+write the results as JSON, so runs from different commits can be diffed.
+
+Or, instead of the scripted player, play back a game recorded with
+run_game.py --record; then every build does exactly the same work, and
+the per-tick latencies can be compared tick for tick.
+
+Run it with run_bench.py from the top of the repository.
+"""
+import gc
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import headless
+headless.enable()
+import levelcache
+import main
+import replay
+from main import Vec2d, GameState, weapon_matrix, key
+
+
+DEFAULT_MAPS = sorted(
+    os.path.splitext(os.path.basename(p))[0]
+    for p in glob.glob('maps/level*.tmx')
+) + ['prototype']
+
+# the maps PointBlankScenario also runs on, and for how many ticks
+POINT_BLANK_MAPS = ('level1',)
+POINT_BLANK_TICKS = 1200
+
+# the scripted player sweeps the reticle around at this many
+# mouse pixels per tick, and changes direction of travel
+# every STRAFE_TICKS ticks
+SWEEP_DX = 7
+STRAFE_TICKS = 90
+STRAFE_KEYS = (key.UP, key.LEFT, key.DOWN, key.RIGHT)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_layer_position(level):
+    """Return the first tile in a 'Player Starting Position' layer, if any."""
+    for layer in level.tiles.layers:
+        if layer.name != 'Player Starting Position':
+            continue
+        for i, gid in enumerate(layer.gids):
+            if gid:
+                y, x = divmod(i, level.tiles.width)
+                y = level.tiles.height - y - 1
+                return Vec2d(x + 0.5, y + 0.5)
+    return None
+
+
+def reachable_tiles(level):
+    """Return the open tiles the player can reach, sorted."""
+    ys, xs = level.reachable.nonzero()
+    return sorted(zip(xs.tolist(), ys.tolist()))
+
+
+class Scenario:
+    """One benchmark run: a map, a scripted player and a crowd of robots."""
+
+    # whether to report every tick's latency, in order
+    per_tick = False
+
+    def __init__(self, basename, ticks, warmup, robots, seed, hz=None):
+        self.basename = basename
+        self.hz = hz or main.ENGINE_TICKS_IN_HERTZ
+        self.ticks = ticks
+        self.warmup = warmup
+        self.robots = robots
+        self.seed = seed
+
+    @property
+    def name(self):
+        return self.basename
+
+    def setup(self):
+        random.seed(self.seed)
+        main.load_level(self.basename)
+        level = main.level
+
+        if not main.player:
+            # maps without a Fab (prototype.tmx) get a player anyway
+            level.start_position = start_layer_position(level) or Vec2d(
+                level.tiles.width / 2,
+                level.tiles.height / 2,
+            )
+            main.spawn_player()
+            level.paint_unreachable_with_instadeath()
+
+        player = main.player
+        player.lives = 10 ** 9
+        main.game.powerups_available = 0b1111
+
+        # robots spawn in open tiles the player can reach,
+        # but not right on top of the player
+        px, py = player.position
+        self.spawn_points = [
+            (x, y) for x, y in reachable_tiles(level)
+            if abs(x - px) + abs(y - py) > 4
+        ]
+        self.top_up_robots()
+        self.strafe_key = None
+
+    def top_up_robots(self):
+        while len(main.robots) < self.robots and self.spawn_points:
+            x, y = random.choice(self.spawn_points)
+            main.spawn_robot(Vec2d(x + 0.5, y + 0.5))
+
+    def set_weapon(self, index):
+        player = main.player
+        player.weapon_index = index
+        player.weapon = weapon_matrix[index]
+        player.sprite.level = player.weapon.player_level
+
+    def script(self, tick):
+        """Drive the player the way a (twitchy) human would."""
+        player = main.player
+        if not player.alive:
+            return
+        per_weapon = max(1, self.ticks // len(weapon_matrix))
+        index = (tick // per_weapon) % len(weapon_matrix)
+        if player.weapon is not weapon_matrix[index]:
+            self.set_weapon(index)
+        player.shooting = True
+
+        main.reticle.on_mouse_motion(0, 0, SWEEP_DX, 0)
+
+        if tick % STRAFE_TICKS == 0:
+            if self.strafe_key:
+                player.on_key_release(self.strafe_key, 0)
+            self.strafe_key = STRAFE_KEYS[(tick // STRAFE_TICKS) % len(STRAFE_KEYS)]
+            player.on_key_press(self.strafe_key, 0)
+
+    def step(self, tick, dt):
+        if main.game.paused():
+            # clearing the level would pause us; keep fighting
+            main.game.transition_to(GameState.PLAYING)
+        self.top_up_robots()
+        self.script(tick)
+        headless.clock.advance(dt)
+        main.on_update(dt)
+
+    def bullet_positions(self):
+        """Return {bullet: position} for every bullet body in flight."""
+        positions = {}
+        for bullet in main.bullets:
+            body = getattr(bullet, 'body', None)
+            if body and body.body_type == main.pymunk.Body.DYNAMIC:
+                positions[bullet] = Vec2d(body.position)
+        return positions
+
+    def count_tunnelling(self, before, after):
+        """Count the bullets that jumped over a wall between two ticks.
+
+        That's any bullet whose centre went from outside every wall,
+        through one, and out the other side, without pymunk noticing.
+        """
+        space = main.level.space
+        walls = main.WALL_COLLISION_TYPES
+
+        def in_wall(bullet, point):
+            return any(
+                hit.shape.collision_type in walls and hit.distance < 0
+                for hit in space.point_query(point, 0, bullet.shape.filter)
+            )
+
+        count = 0
+        for bullet, start in before.items():
+            end = after.get(bullet)
+            if end is None or in_wall(bullet, start) or in_wall(bullet, end):
+                continue
+            for hit in space.segment_query(start, end, 0, bullet.shape.filter):
+                if hit.shape.collision_type in walls:
+                    count += 1
+                    break
+        return count
+
+    def run(self):
+        # so RobotLOD and PlayerVisibility work out their periods
+        # from the tick rate we're really running at
+        main.ENGINE_TICKS_IN_HERTZ = self.hz
+        self.setup()
+        dt = 1 / self.hz
+        for tick in range(self.warmup):
+            self.step(tick, dt)
+
+        timer = time.perf_counter
+        latencies = []
+        peak_bullets = 0
+        tunnelling = 0
+        positions = self.bullet_positions()
+        gc_before = sum(stat['collections'] for stat in gc.get_stats())
+        blocks_before = sys.getallocatedblocks()
+        for tick in range(self.warmup, self.warmup + self.ticks):
+            t = timer()
+            self.step(tick, dt)
+            latencies.append(timer() - t)
+            peak_bullets = max(peak_bullets, len(main.bullets))
+            before, positions = positions, self.bullet_positions()
+            tunnelling += self.count_tunnelling(before, positions)
+        # just the ticks, not our bookkeeping between them
+        elapsed = sum(latencies)
+        blocks_after = sys.getallocatedblocks()
+        gc_after = sum(stat['collections'] for stat in gc.get_stats())
+
+        in_order = latencies[:]
+        latencies.sort()
+        result = {
+            'map': self.basename,
+            'scenario': self.name,
+            'ticks': self.ticks,
+            'hz': self.hz,
+            'seconds': round(elapsed, 6),
+            'ticks_per_sec': round(self.ticks / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 4),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+            'max_ms': round(latencies[-1] * 1000, 4),
+            # net growth in live Python memory blocks, not how many were
+            # allocated; a leak shows up as a steady positive number here
+            'net_blocks_per_tick': round((blocks_after - blocks_before) / self.ticks, 3),
+            'gc_collections': gc_after - gc_before,
+            'robots': self.robots,
+            'peak_bullets': peak_bullets,
+            'tunnelling_bullets': tunnelling,
+            'bullet_pools': {
+                cls.__name__: {
+                    'size': cls.pool.size,
+                    'hits': cls.pool.hits,
+                    'misses': cls.pool.misses,
+                    'recycled': cls.pool.recycled,
+                }
+                for cls in main.BulletClasses
+            },
+        }
+        if self.per_tick:
+            result['tick_ms'] = [round(t * 1000, 4) for t in in_order]
+        return result
+
+
+class PointBlankScenario(Scenario):
+    """Fire fast bullets past wall corners from right up against them.
+
+    Every tick, after the usual scripted tick, we fire a fan of shots
+    from the next outside corner of the walls round the open tiles the
+    player can reach.  Each starts with its circle just over the
+    corner and heads off past it at an angle, so the first step clips
+    the corner; with Bullet.sweep() on, none of them should tunnel.
+    """
+
+    # how far round from straight at the corner each shot heads, in degrees
+    ANGLES = (-80, -60, -40, -20, 20, 40, 60, 80)
+
+    @property
+    def name(self):
+        return f"{self.basename} (point blank)"
+
+    def setup(self):
+        super().setup()
+        level = main.level
+        walls = level.walls
+        # the open tiles with a wall diagonally off them, but not
+        # on either side between: the corners a bullet can clip
+        self.corners = []
+        for x, y in reachable_tiles(level):
+            for dx, dy in ((1, 1), (-1, 1), (-1, -1), (1, -1)):
+                if (walls.is_wall(x + dx, y + dy)
+                    and not walls.is_wall(x + dx, y)
+                    and not walls.is_wall(x, y + dy)):
+                    corner = Vec2d(x + 0.5 + dx / 2, y + 0.5 + dy / 2)
+                    self.corners.append((corner, Vec2d(dx, dy).normalized()))
+        # the fastest plain, normal sized bullets there are
+        self.weapon = max(
+            (
+                weapon for weapon in weapon_matrix
+                if weapon.cls is main.Bullet
+                and weapon.shape == main.BulletShape.BULLET_SHAPE_NORMAL
+            ),
+            key=lambda weapon: weapon.speed,
+        )
+
+    def fire(self, tick):
+        player = main.player
+        if not (self.corners and player.alive):
+            return
+        corner, towards = self.corners[tick % len(self.corners)]
+        # the radius Bullet gives a normal sized bullet
+        radius = player.radius / 3
+        start = corner - towards * (radius / 2)
+        # weapon.fire() starts the bullet a player's and a bullet's
+        # radius from the player; move where it thinks the player is,
+        # just for the shot, so every bullet starts off at start
+        position = player.position
+        try:
+            for angle in self.ANGLES:
+                vector = towards.rotated_degrees(angle)
+                player.position = start - vector * (player.radius + radius)
+                self.weapon.fire(player, vector)
+        finally:
+            player.position = position
+
+    def step(self, tick, dt):
+        super().step(tick, dt)
+        # after the tick, so each fan's first step is the one we count
+        self.fire(tick)
+
+
+class ReplayScenario(Scenario):
+    """A benchmark run that plays back a recorded game."""
+
+    per_tick = True
+
+    def __init__(self, path):
+        self.recording = replay.Recording.load(path)
+        super().__init__(
+            os.path.basename(path),
+            ticks=self.recording.ticks,
+            warmup=0,
+            robots=None,
+            seed=self.recording.seed,
+            hz=self.recording.hz,
+        )
+
+    def setup(self):
+        # back to the title screen, where the recording started
+        main.game.transition_to(GameState.NEW_GAME)
+        self.replayer = replay.Replayer(self.recording, main)
+
+    def step(self, tick, dt):
+        self.replayer.dispatch(tick)
+        headless.clock.advance(dt)
+        main.on_update(dt)
+
+
+def check_wall_blobs():
+    """Check the NumPy wall blobs against the pure Python ones on every map.
+
+    Returns {tmx path: differences}, for the maps that differ.
+    """
+    mismatches = {}
+    for tmx_path in sorted(glob.glob('maps/*.tmx')):
+        problems = levelcache.check_wall_blobs(tmx_path)
+        if problems:
+            mismatches[tmx_path] = problems
+    return mismatches
+
+
+def run(
+        maps=DEFAULT_MAPS, ticks=6000, warmup=240, robots=40, seed=24,
+        swarm=True, sweep=True, hz=None, replays=(), lod=True,
+        point_blank=POINT_BLANK_MAPS):
+    """Run a scenario per map, or per recording, and return the results as a dict."""
+    main.bullet_swarm.enabled = swarm
+    main.robot_lod.enabled = lod
+    main.BULLET_SWEEP = sweep
+    if replays:
+        scenarios = [ReplayScenario(path) for path in replays]
+    else:
+        scenarios = [
+            Scenario(basename, ticks, warmup, robots, seed, hz)
+            for basename in maps
+        ]
+        scenarios += [
+            PointBlankScenario(basename, POINT_BLANK_TICKS, warmup, robots, seed, hz)
+            for basename in point_blank
+        ]
+    wall_blob_mismatches = check_wall_blobs()
+    for tmx_path, problems in wall_blob_mismatches.items():
+        print(f"{tmx_path}: wall blobs don't match: {'; '.join(problems)}")
+
+    results = []
+    for scenario in scenarios:
+        name = scenario.name
+        result = scenario.run()
+        print(
+            f"{name:>10}: {result['ticks_per_sec']:9.1f} ticks/sec  "
+            f"p50 {result['p50_ms']:.3f}ms  p99 {result['p99_ms']:.3f}ms  "
+            f"{result['net_blocks_per_tick']:+.2f} blocks/tick  "
+            f"{result['tunnelling_bullets']} tunnelled"
+        )
+        results.append(result)
+
+    return {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'bullet_swarm': swarm,
+        'bullet_sweep': sweep,
+        'robot_lod': lod,
+        'wall_blob_mismatches': wall_blob_mismatches,
+        'results': results,
+    }
+
+
+def tunnelled(report):
+    """Return the names of the scenarios whose bullets went through walls."""
+    return [
+        result['scenario'] for result in report['results']
+        if result['tunnelling_bullets']
+    ]
+
+
+def write_results(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
@@ -0,0 +1,602 @@
+"""Collision geometry worked out from a level's wall tiles.
+
+These work on tile coordinates (y up, like the rest of the game) and
+only need to know which tiles are walls, so they run the same at load
+time and when compiling a level into the level cache.  is_wall(x, y)
+must treat tiles outside the map as walls, like WallGrid.is_wall.
+"""
+from collections import deque
+import math
+
+import numpy as np
+
+
+# bits in WallGrid.neighbour_mask()
+UP = 1
+DOWN = 2
+LEFT = 4
+RIGHT = 8
+
+
+class WallGrid:
+    """The wall tiles of a level, packed into a bytearray.
+
+    cells has one byte per tile, 1 for walls and 0 for open tiles,
+    in rows from the bottom of the map up (y up, like tile coordinates).
+    The map is framed by a one tile border of walls, so neighbour
+    lookups at the edge of the map don't need a bounds check.
+    Anything outside the map reads as a wall.
+    """
+
+    def __init__(self, width, height, collision):
+        """collision is one byte per tile in .tmx order, top row first."""
+        self.width = width
+        self.height = height
+        self.stride = stride = width + 2
+        cells = bytearray(b'\x01' * (stride * (height + 2)))
+        for row in range(height):
+            y = height - row - 1
+            start = (y + 1) * stride + 1
+            cells[start:start + width] = collision[row * width:(row + 1) * width]
+        self.cells = cells
+
+    @property
+    def array(self):
+        """cells as a NumPy array (a view, not a copy), indexed [y + 1, x + 1]."""
+        return np.frombuffer(self.cells, dtype=np.uint8).reshape(
+            self.height + 2, self.stride)
+
+    def copy(self):
+        walls = WallGrid.__new__(WallGrid)
+        walls.width = self.width
+        walls.height = self.height
+        walls.stride = self.stride
+        walls.cells = bytearray(self.cells)
+        return walls
+
+    def fill(self, left, bottom, right, top):
+        """Make every tile in a rectangle a wall.
+
+        left and bottom are inclusive, right and top exclusive.
+        """
+        left = max(left, 0)
+        right = min(right, self.width)
+        if left >= right:
+            return
+        for y in range(max(bottom, 0), min(top, self.height)):
+            start = (y + 1) * self.stride + left + 1
+            self.cells[start:start + right - left] = b'\x01' * (right - left)
+
+    def index(self, x, y):
+        """Return the offset of tile (x, y) in cells."""
+        return (y + 1) * self.stride + x + 1
+
+    def is_wall(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.cells[(y + 1) * self.stride + x + 1]
+        return 1
+
+    def row(self, y, left=0, right=None):
+        """Return the tiles from left to right (exclusive) in row y, as bytes."""
+        if right is None:
+            right = self.width
+        if not (0 <= y < self.height):
+            return b'\x01' * max(0, right - left)
+        l = max(left, 0)
+        r = min(right, self.width)
+        if l >= r:
+            return b'\x01' * max(0, right - left)
+        start = (y + 1) * self.stride + 1
+        return (
+            b'\x01' * (l - left)
+            + bytes(self.cells[start + l:start + r])
+            + b'\x01' * (right - r)
+        )
+
+    def window(self, left, bottom, right, top):
+        """Return the rows of a rectangle of tiles, bottom row first.
+
+        left and bottom are inclusive, right and top exclusive.
+        """
+        return [self.row(y, left, right) for y in range(bottom, top)]
+
+    def any_wall(self, left, bottom, right, top):
+        """Return whether there's a wall anywhere in the rectangle."""
+        return any(1 in row for row in self.window(left, bottom, right, top))
+
+    def neighbour_mask(self, x, y):
+        """Return UP | DOWN | LEFT | RIGHT for the walls next to (x, y)."""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return (
+                (UP if self.is_wall(x, y + 1) else 0)
+                | (DOWN if self.is_wall(x, y - 1) else 0)
+                | (LEFT if self.is_wall(x - 1, y) else 0)
+                | (RIGHT if self.is_wall(x + 1, y) else 0)
+            )
+        cells = self.cells
+        stride = self.stride
+        i = (y + 1) * stride + x + 1
+        return (
+            cells[i + stride]
+            | cells[i - stride] << 1
+            | cells[i - 1] << 2
+            | cells[i + 1] << 3
+        )
+
+
+def _runs(grid):
+    """Find the horizontal runs of nonzero tiles in a 2D array indexed [y, x].
+
+    Returns arrays of each run's y, start x and end x (exclusive),
+    in order of y then x, and an array like grid holding the index
+    of the run each tile is in (or -1).
+    """
+    height, width = grid.shape
+    # a run starts where a row steps up from 0 to 1 and ends
+    # where it steps back down.  np.nonzero() walks row by row,
+    # so the starts and ends line up.
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = grid != 0
+    steps = np.diff(padded, axis=1)
+    run_y, run_start = np.nonzero(steps == 1)
+    end_y, run_end = np.nonzero(steps == -1)
+    assert (run_y == end_y).all()
+
+    starts = np.zeros((height, width), dtype=np.int64)
+    starts[run_y, run_start] = 1
+    run_id = np.where(grid != 0, np.cumsum(starts).reshape(height, width) - 1, -1)
+    return run_y, run_start, run_end, run_id
+
+
+def _merge_down(run_y, run_start, run_end, run_id):
+    """Stack runs with identical edges into rectangles.
+
+    A run merges down into the run directly below it if that run
+    has the same edges.  Returns, for every run, the run at the
+    bottom of its rectangle, and for those bottom runs, the y of
+    the rectangle's top row.
+    """
+    count = len(run_y)
+    below = np.full(count, -1)
+    lifted = run_y > 0
+    below[lifted] = run_id[run_y[lifted] - 1, run_start[lifted]]
+    merges = (
+        (below >= 0)
+        & (run_start[below] == run_start)
+        & (run_end[below] == run_end)
+    )
+    # follow the chains down
+    bottom = np.where(merges, below, np.arange(count))
+    while True:
+        next_bottom = bottom[bottom]
+        if (next_bottom == bottom).all():
+            break
+        bottom = next_bottom
+    top = np.zeros(count, dtype=np.int64)
+    np.maximum.at(top, bottom, run_y)
+    return bottom, top
+
+
+def rectangles(grid):
+    """Cover the nonzero tiles of a 2D array indexed [y, x] with rectangles.
+
+    Horizontal runs are stacked into one rectangle wherever the runs
+    above and below have the same edges.  Returns a sorted list of
+    ((x, y), (end_x, end_y)).
+    """
+    if not grid.any():
+        return []
+    run_y, run_start, run_end, run_id = _runs(grid)
+    bottom, top = _merge_down(run_y, run_start, run_end, run_id)
+    return sorted(
+        ((int(run_start[r]), int(run_y[r])), (int(run_end[r]), int(top[r]) + 1))
+        for r in np.nonzero(bottom == np.arange(len(run_y)))[0].tolist()
+    )
+
+
+def wall_blobs(walls):
+    """Merge the wall tiles into rectangles, and group touching rectangles.
+
+    walls is a WallGrid.  Returns a list of "blobs", each a set of
+    rectangles ((x, y), (end_x, end_y)) that touch each other.
+
+    This is a NumPy version of wall_blobs_python() and returns exactly
+    the same rectangles:
+
+    * every horizontal run of walls in a row is a rectangle one tile high;
+    * a run sits on top of the run below it, and they merge, if the run
+      below has the same left and right edges;
+    * two rectangles touch if a wall in one is directly above a wall in
+      the other, so the blobs are just the 4-connected groups of walls.
+    """
+    grid = walls.array[1:-1, 1:-1]
+    if not grid.any():
+        return []
+    run_y, run_start, run_end, run_id = _runs(grid)
+    bottom, top = _merge_down(run_y, run_start, run_end, run_id)
+    count = len(run_y)
+
+    # passes 3 and 4: group runs that touch vertically
+    # into blobs, with a union-find over the touching pairs
+    touching = grid[:-1].astype(bool) & grid[1:].astype(bool)
+    pairs = np.unique(np.stack((run_id[:-1][touching], run_id[1:][touching]), axis=1), axis=0)
+    parent = list(range(count))
+
+    def find(r):
+        while parent[r] != r:
+            parent[r] = parent[parent[r]]
+            r = parent[r]
+        return r
+
+    for a, b in pairs.tolist():
+        a = find(a)
+        b = find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    blobs = {}
+    for r in np.nonzero(bottom == np.arange(count))[0].tolist():
+        rect = (
+            (int(run_start[r]), int(run_y[r])),
+            (int(run_end[r]), int(top[r]) + 1),
+        )
+        blobs.setdefault(find(r), set()).add(rect)
+    return [blobs[key] for key in sorted(blobs)]
+
+
+def wall_blobs_python(width, height, is_wall):
+    """The original, pure Python wall_blobs().
+
+    Slow, but easy to follow; levelcache.py --check compares
+    the two on every map.
+    """
+
+    # pass 1: RLE encode horizontal runs of tiles into rectangles
+    in_rect = False
+    startx = None
+    x_rects = set()
+
+    def finish_rect():
+        nonlocal x
+        nonlocal y
+        nonlocal startx
+        nonlocal in_rect
+        in_rect = False
+        rect = ((startx, y), (x, y + 1))
+        x_rects.add(rect)
+
+    for y in range(0, height):
+        y = height - y - 1
+        for x in range(0, width):
+            tile = is_wall(x, y)
+            if tile:
+                if not in_rect:
+                    in_rect = True
+                    startx = x
+            elif in_rect:
+                finish_rect()
+        if in_rect:
+            x += 1
+            finish_rect()
+
+    # sort fns for sorting lists of rects
+    sort_by_y = lambda box: (box[0][1], box[0][0])
+    # we usually sort lowest y coord to the end,
+    # this lets us pop efficiently when processing
+    # from lowest to highest x
+    sort_by_reverse_y = lambda box: (-box[0][1], box[0][0])
+
+    # pass 2: merge rectangles down where possible.
+    # (if there are two rectangles adjacent in y
+    #  and having identical left and right x edges,
+    #  merge them into one big rectangle.)
+    xy_rects = []
+    sorted_x_rects = list(sorted(x_rects, key=sort_by_reverse_y))
+    while sorted_x_rects:
+        rect = sorted_x_rects.pop()
+        if rect not in x_rects:
+            continue
+        start, end = rect
+        start_x, start_y = start
+        end_x, end_y = end
+        new_start_y = start_y
+        new_end_y = end_y
+        while True:
+            new_start_y += 1
+            new_end_y += 1
+            nextrect = ((start_x, new_start_y), (end_x, new_end_y))
+            if nextrect not in x_rects:
+                break
+            x_rects.remove(nextrect)
+            end_y = new_end_y
+        xy_rects.append(((start_x, start_y), (end_x, end_y)))
+
+    # pass 3:
+    # find all rects who touch each other in y,
+    # constructing a dict of r -> set(rects_touching_r)
+    # where r is a rect and all the members of the set are also rects.
+    #
+    # note: we don't have to check if rects are touching on our left or right.
+    # if a rect r2 was touching r on the left or the right,
+    # then during pass 1 we wouldn't have generated two rects!
+    touching = {}
+    topdown_rects = list(xy_rects)
+    topdown_rects.sort(key=sort_by_reverse_y)
+    def r_as_tiles(r):
+        return ( (r[0][0]//16, r[0][1]//16), (r[1][0]//16, r[1][1]//16))
+    def r_as_tiles_str(r):
+        r = r_as_tiles(r)
+        return f"(({r[0][0]:2}, {r[0][1]:2}), ({r[1][0]:2}, {r[1][1]:2}))"
+    def r_touches(r, r2):
+        s = touching.get(r)
+        if not s:
+            s = set()
+            touching[r] = s
+        s.add(r2)
+        # print(f"{r_as_tiles_str(r)} TOUCHES {r_as_tiles_str(r2)}")
+    while topdown_rects:
+        r = topdown_rects.pop()
+        (x, y), (end_x, end_y) = r
+        skip_y = y
+        check_y = end_y
+        for r2 in reversed(topdown_rects):
+            (x2, y2), (end_x2, end_y2) = r2
+            if y2 < check_y:
+                # on same y coordinate as us, skip
+                continue
+            if y2 != check_y:
+                # too far away in y, all subsequent rects will also be too far away, stop
+                break
+
+            # r2.topleft.y is the same as r.bottomright.y.
+            # so if the two rects overlap in x, they're touching.
+            # how do we determine that?  easy!
+            #
+            # there are six possible scenarios:
+            #
+            # 1. rrrr        no overlap, r < r2
+            #         r2r2
+            #
+            # 2. rrrr           overlap, on the left side of r2
+            #      r2r2
+            #
+            # 3. rrrrrrrr       overlap, r2 is inside r
+            #      r2r2
+            #
+            # 4.   rrrr         overlap, r is inside r2
+            #    r2r2r2r2
+            #
+            # 5.   rrrr         overlap, on the right side of r2
+            #    r2r2
+            #
+            # 6.      rrrr   no overlap, r > r2
+            #    r2r2
+            #
+            # so we just check for 1 and 6.
+            # if either is true, we don't overlap.
+            # otherwise we do.
+            if not ((end_x <= x2) or (end_x2 <= x)):
+                r_touches(r, r2)
+                r_touches(r2, r)
+
+    # pass 4:
+    # construct "blobs" of touching rects.
+    #
+    # pull out a rect and put it in a set.
+    # then pull out all rects that touch it and put them in the set too,
+    # and all rects that touch *that*, ad infinitum.
+    # keep iterating until we don't find any new rects.
+    # that's a blob.  repeat until no rects left.
+    final_rects = set(xy_rects)
+    blobs = []
+    while final_rects:
+        r = final_rects.pop()
+        # print(f"blob, starting with {r_as_tiles_str(r)}")
+        blob = set([r])
+        check = set([r])
+        while check:
+            check_next = set()
+            for r in check:
+                neighbors = touching.get(r, ())
+                for r2 in neighbors:
+                    if r2 not in blob:
+                        # print(f"  {r_as_tiles_str(r)} touches {r_as_tiles_str(r2)}")
+                        blob.add(r2)
+                        final_rects.remove(r2)
+                        check_next.add(r2)
+            check = check_next
+        blobs.append(blob)
+
+    return blobs
+
+
+def reachable_mask(walls, start):
+    """Return a mask of the open tiles reachable from start.
+
+    walls is a WallGrid and start an (x, y) tile.  This is a plain
+    breadth-first search over walls.cells, so it visits every tile at
+    most once.  The mask is a bool NumPy array indexed [y, x].
+    """
+    width = walls.width
+    height = walls.height
+    x, y = start
+    reached = bytearray(len(walls.cells))
+    cells = walls.cells
+    stride = walls.stride
+    frontier = deque()
+    if (0 <= x < width) and (0 <= y < height):
+        # the start counts even if it's a wall, like it always has
+        i = walls.index(x, y)
+        reached[i] = 1
+        frontier.append(i)
+    else:
+        # just off the map; we can still step onto it
+        for nx, ny in ((x, y + 1), (x, y - 1), (x - 1, y), (x + 1, y)):
+            if not walls.is_wall(nx, ny):
+                i = walls.index(nx, ny)
+                reached[i] = 1
+                frontier.append(i)
+
+    pop = frontier.popleft
+    push = frontier.append
+    offsets = (stride, -stride, -1, 1)
+    while frontier:
+        i = pop()
+        for offset in offsets:
+            n = i + offset
+            # the border around the map is all walls,
+            # so we never step outside it
+            if not (cells[n] or reached[n]):
+                reached[n] = 1
+                push(n)
+    mask = np.frombuffer(reached, dtype=np.uint8).reshape(height + 2, walls.stride)
+    return mask[1:-1, 1:-1] != 0
+
+
+def distance_field(walls, start):
+    """Return how many steps it is from start to every open tile.
+
+    walls is a WallGrid and start an (x, y) tile.  A step is up, down,
+    left or right onto an open tile.  Like reachable_mask(), this is a
+    breadth-first search over walls.cells.  The result is an int32
+    NumPy array indexed [y, x], with -1 for walls and for tiles that
+    can't be reached from start.
+    """
+    width = walls.width
+    height = walls.height
+    stride = walls.stride
+    x, y = start
+    distances = [-1] * len(walls.cells)
+    if not ((0 <= x < width) and (0 <= y < height)):
+        return np.full((height, width), -1, dtype=np.int32)
+
+    cells = walls.cells
+    i = walls.index(x, y)
+    distances[i] = 0
+    frontier = deque([i])
+    pop = frontier.popleft
+    push = frontier.append
+    offsets = (stride, -stride, -1, 1)
+    while frontier:
+        i = pop()
+        d = distances[i] + 1
+        for offset in offsets:
+            n = i + offset
+            # the border around the map is all walls,
+            # so we never step outside it
+            if distances[n] < 0 and not cells[n]:
+                distances[n] = d
+                push(n)
+    field = np.array(distances, dtype=np.int32).reshape(height + 2, stride)
+    return field[1:-1, 1:-1]
+
+
+# the neighbours of a tile, (dx, dy), orthogonal ones first
+NEIGHBOURS = (
+    (0, 1), (0, -1), (-1, 0), (1, 0),
+    (-1, 1), (1, 1), (-1, -1), (1, -1),
+)
+
+
+def flow_directions(distances):
+    """Return which way to step from each tile to get closer to the start.
+
+    distances is a distance_field().  From each tile we step to
+    whichever of its eight neighbours is closest to the start, but only
+    step diagonally if both the tiles beside the diagonal are open, so
+    nothing tries to cut a corner.  Returns two int8 arrays indexed
+    [y, x] of the steps' dx and dy, which are both 0 at the start and
+    where there's no way to get any closer.
+    """
+    height, width = distances.shape
+    unreachable = np.iinfo(np.int32).max
+    padded = np.full((height + 2, width + 2), unreachable, dtype=np.int32)
+    padded[1:-1, 1:-1] = np.where(distances >= 0, distances, unreachable)
+
+    def neighbour(dx, dy):
+        return padded[1 + dy:height + 1 + dy, 1 + dx:width + 1 + dx]
+
+    best = padded[1:-1, 1:-1].copy()
+    step_x = np.zeros((height, width), dtype=np.int8)
+    step_y = np.zeros((height, width), dtype=np.int8)
+    for dx, dy in NEIGHBOURS:
+        d = neighbour(dx, dy)
+        if dx and dy:
+            beside = (neighbour(dx, 0) != unreachable) & (neighbour(0, dy) != unreachable)
+            d = np.where(beside, d, unreachable)
+        closer = d < best
+        best[closer] = d[closer]
+        step_x[closer] = dx
+        step_y[closer] = dy
+    return step_x, step_y
+
+
+def line_of_sight(walls, start, end):
+    """Return whether the segment from start to end crosses no wall tiles.
+
+    walls is a WallGrid, and start and end are points in tile
+    coordinates, so tile (x, y) covers x to x + 1 and y to y + 1.
+    We step from tile to tile along the segment (Amanatides and Woo's
+    DDA), so the cost is the number of tiles it crosses.  Where it
+    passes exactly through the corner between four tiles, it's blocked
+    if either of the tiles it squeezes between is a wall.
+    """
+    x0, y0 = start
+    x1, y1 = end
+    x = math.floor(x0)
+    y = math.floor(y0)
+    if walls.is_wall(x, y):
+        return False
+    cells = walls.cells
+    stride = walls.stride
+    i = walls.index(x, y)
+
+    dx = x1 - x0
+    dy = y1 - y0
+    # how far along the segment (0 to 1) we are when we cross
+    # into the next column / row, and how far it is between them
+    if dx > 0:
+        step_x = 1
+        t_delta_x = 1 / dx
+        t_max_x = (x + 1 - x0) * t_delta_x
+    elif dx < 0:
+        step_x = -1
+        t_delta_x = -1 / dx
+        t_max_x = (x0 - x) * t_delta_x
+    else:
+        step_x = 0
+        t_delta_x = t_max_x = math.inf
+    if dy > 0:
+        step_y = stride
+        t_delta_y = 1 / dy
+        t_max_y = (y + 1 - y0) * t_delta_y
+    elif dy < 0:
+        step_y = -stride
+        t_delta_y = -1 / dy
+        t_max_y = (y0 - y) * t_delta_y
+    else:
+        step_y = 0
+        t_delta_y = t_max_y = math.inf
+
+    # the border of walls round the map stops us
+    # before we can step off the edge of cells
+    steps = abs(math.floor(x1) - x) + abs(math.floor(y1) - y)
+    while steps > 0:
+        if t_max_x < t_max_y:
+            i += step_x
+            t_max_x += t_delta_x
+            steps -= 1
+        elif t_max_y < t_max_x:
+            i += step_y
+            t_max_y += t_delta_y
+            steps -= 1
+        else:
+            if cells[i + step_x] or cells[i + step_y]:
+                return False
+            i += step_x + step_y
+            t_max_x += t_delta_x
+            t_max_y += t_delta_y
+            steps -= 2
+        if cells[i]:
+            return False
+    return True
@@ -14,6 +14,16 @@ COLOR_ATTACHMENTS = [
 ]
 
 
+# for estimating video memory use
+BYTES_PER_TEXEL = {
+    gl.GL_RGBA32F: 16,
+    gl.GL_RGBA16F: 8,
+    gl.GL_RGBA8: 4,
+    gl.GL_RGBA: 4,
+}
+DEPTH_BYTES = 2  # GL_DEPTH_COMPONENT16
+
+
 class FrameBuffer:
     """An interface to OpenGL Frame Buffer Objects.
 
@@ -23,17 +33,24 @@ class FrameBuffer:
     num_bufs).
 
     The depth buffer will be a render buffer, which is not readable.
+
+    internal_format is the texture format, eg. GL_RGBA32F, GL_RGBA16F or
+    GL_RGBA8, and filter is used for both minification and magnification,
+    so pass GL_LINEAR to get bilinear filtering when a buffer is drawn at a
+    different size.
     """
     fbo = None
     textures = ()
     depthbuf = None
 
-    def __init__(self, width, height, num_bufs=1):
+    def __init__(self, width, height, num_bufs=1, internal_format=gl.GL_RGBA32F, filter=gl.GL_NEAREST):
         assert 0 < num_bufs <= len(COLOR_ATTACHMENTS), \
             "Invalid number of buffers."
         self.width = width
         self.height = height
         self.num_bufs = num_bufs
+        self.internal_format = internal_format
+        self.filter = filter
         self._allocate()
 
     def _allocate(self):
@@ -53,12 +70,13 @@ class FrameBuffer:
     def _link(self):
         for attachment, tex in zip(COLOR_ATTACHMENTS, self.textures):
             gl.glBindTexture(gl.GL_TEXTURE_2D, tex)
-            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_REPEAT)
-            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_REPEAT)
-            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
-            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+            # clamp, so filtering doesn't bleed one edge into the other
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, self.filter)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, self.filter)
             gl.glTexImage2D(
-                gl.GL_TEXTURE_2D, 0, gl.GL_RGBA32F,
+                gl.GL_TEXTURE_2D, 0, self.internal_format,
                 self.width, self.height,
                 0,
                 gl.GL_RGBA, gl.GL_FLOAT,
@@ -93,19 +111,40 @@ class FrameBuffer:
         assert gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER) == gl.GL_FRAMEBUFFER_COMPLETE, \
             "Framebuffer is not complete!"
 
-    def __del__(self):
+    def delete(self):
+        """Free the GL objects now, rather than whenever we're collected."""
         def call(func, vals):
-            vals = list(vals)
             size = len(vals)
             buf = (gl.GLuint * size)(*vals)
             func(size, buf)
 
         if self.fbo:
             call(gl.glDeleteFramebuffers, [self.fbo])
+            self.fbo = None
+
+        textures = [tex for tex in self.textures if tex]
+        if textures:
+            call(gl.glDeleteTextures, textures)
+        self.textures = ()
+
+        if self.depthbuf:
+            call(gl.glDeleteRenderbuffers, [self.depthbuf])
+            self.depthbuf = None
+
+    def __del__(self):
+        self.delete()
+
+    @property
+    def key(self):
+        """The FrameBufferPool key for buffers interchangeable with this one."""
+        return self.width, self.height, self.num_bufs, self.internal_format, self.filter
 
-        texids = filter(None, [self.depthbuf, *self.textures])
-        if texids:
-            call(gl.glDeleteTextures, texids)
+    @property
+    def vram(self):
+        """Estimate the video memory used by this buffer, in bytes."""
+        texel = BYTES_PER_TEXEL.get(self.internal_format, 16)
+        pixels = self.width * self.height
+        return pixels * (texel * self.num_bufs + DEPTH_BYTES)
 
     def __enter__(self):
         """Bind the FBO for rendering."""
@@ -114,3 +153,78 @@ class FrameBuffer:
     def __exit__(self, *_):
         """Unbind the FBO."""
         gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+
+class FrameBufferPool:
+    """Hands out FrameBuffers, reusing ones that have been given back.
+
+    Buffers are matched on size, number of colour buffers, format and
+    filter.  Call release() when you are done with a buffer rather than
+    dropping it, and end_frame() once per frame; buffers that nobody has
+    asked for in max_idle frames are deleted then, so that a resized
+    window doesn't leave its old buffers hanging around.
+    """
+
+    def __init__(self, max_idle=60):
+        self.max_idle = max_idle
+        # released buffers by key, each as [buffer, frames idle]
+        self.free = {}
+        self.in_use = set()
+
+    def acquire(self, width, height, num_bufs=1, internal_format=gl.GL_RGBA32F, filter=gl.GL_NEAREST):
+        """Return a FrameBuffer, reusing a released one if we can."""
+        key = width, height, num_bufs, internal_format, filter
+        free = self.free.get(key)
+        if free:
+            fb, _ = free.pop()
+            if not free:
+                del self.free[key]
+        else:
+            fb = FrameBuffer(width, height, num_bufs, internal_format, filter)
+        self.in_use.add(fb)
+        return fb
+
+    def release(self, fb):
+        """Give a buffer back to the pool."""
+        if fb is None:
+            return
+        self.in_use.discard(fb)
+        self.free.setdefault(fb.key, []).append([fb, 0])
+
+    def end_frame(self):
+        """Delete the buffers that have been idle for too long."""
+        for key, free in list(self.free.items()):
+            for entry in free:
+                entry[1] += 1
+            expired = [fb for fb, idle in free if idle > self.max_idle]
+            if expired:
+                for fb in expired:
+                    fb.delete()
+                free[:] = [entry for entry in free if entry[1] <= self.max_idle]
+                if not free:
+                    del self.free[key]
+
+    def trim(self):
+        """Delete every buffer that isn't in use."""
+        for free in self.free.values():
+            for fb, _ in free:
+                fb.delete()
+        self.free.clear()
+
+    def vram(self):
+        """Return the estimated video memory in use and held free, in bytes."""
+        used = sum(fb.vram for fb in self.in_use)
+        held = sum(fb.vram for free in self.free.values() for fb, _ in free)
+        return used, held
+
+    def report(self):
+        used, held = self.vram()
+        count = sum(len(free) for free in self.free.values())
+        return (
+            f"framebuffers: {len(self.in_use)} in use ({used / 2 ** 20:.1f} MiB), "
+            f"{count} free ({held / 2 ** 20:.1f} MiB)"
+        )
+
+
+# the pool shared by all render passes
+pool = FrameBufferPool()
@@ -0,0 +1,230 @@
+"""Stand-ins for the display, audio and particle objects.
+
+In headless mode the game runs its simulation (pymunk, the player, robots
+and bullets) without a window, an OpenGL context or an audio device.
+Everything that would normally touch one of those is replaced by one of
+the null objects below, which accept the same calls and do nothing.
+
+Headless mode must be switched on before main is imported:
+
+    import headless
+    headless.enable()
+    import main
+
+"""
+import struct
+
+import pyglet
+import pyglet.clock
+
+
+enabled = False
+
+clock = None
+
+
+def enable():
+    """Switch on headless mode.
+
+    This must be called before anything imports pyglet.gl, pyglet.window or
+    pyglet.media, because those read pyglet.options at import time.
+
+    """
+    global enabled
+    global clock
+    enabled = True
+    pyglet.options['shadow_window'] = False
+    pyglet.options['debug_gl'] = False
+    pyglet.options['audio'] = ('silent',)
+
+    clock = VirtualClock()
+    pyglet.clock.set_default(clock)
+
+
+class VirtualClock(pyglet.clock.Clock):
+    """A pyglet clock that only moves when it is told to.
+
+    Things scheduled with pyglet.clock (light flashes, respawns, the railgun
+    fade-out) then happen on simulation time rather than wall-clock time.
+
+    """
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(time_function=lambda: self.now)
+
+    def advance(self, dt):
+        """Move time forward by dt seconds and run anything now due."""
+        self.now += dt
+        self.tick()
+
+
+def load_image(filename):
+    """Return a NullImage with the size of the named resource image.
+
+    All our images are PNGs, so the size is read straight out of the IHDR
+    chunk rather than decoding the whole file.
+    """
+    with pyglet.resource.file(filename) as f:
+        header = f.read(24)
+    assert header[:8] == b'\x89PNG\r\n\x1a\n', f"{filename} is not a PNG"
+    width, height = struct.unpack('>II', header[16:24])
+    return NullImage(width, height)
+
+
+class NullImage:
+    def __init__(self, width=0, height=0):
+        self.width = width
+        self.height = height
+        self.anchor_x = 0
+        self.anchor_y = 0
+        self.id = 0
+
+    def get_region(self, x, y, width, height):
+        return NullImage(width, height)
+
+
+class NullSprite:
+    """Stands in for pyglet.sprite.Sprite and pyglet.text.Label."""
+
+    def __init__(self, image=None, x=0, y=0, *args, **kwargs):
+        self.image = image
+        self.x = x
+        self.y = y
+        self.rotation = 0
+        self.scale = 1.0
+        self.visible = True
+        self.opacity = 255
+        self.color = (255, 255, 255)
+
+    @property
+    def position(self):
+        return self.x, self.y
+
+    @position.setter
+    def position(self, v):
+        self.x, self.y = v
+
+    def set_position(self, x, y):
+        self.x = x
+        self.y = y
+
+    @property
+    def width(self):
+        return getattr(self.image, 'width', 0) * self.scale
+
+    @property
+    def height(self):
+        return getattr(self.image, 'height', 0) * self.scale
+
+    def draw(self):
+        pass
+
+    def delete(self):
+        pass
+
+
+class NullVertexList:
+    def __init__(self):
+        self.vertices = ()
+        self.colors = ()
+        self.tex_coords = ()
+
+    def draw(self, mode):
+        pass
+
+    def delete(self):
+        pass
+
+
+class NullBatch:
+    def add(self, count, mode, group, *data):
+        return NullVertexList()
+
+    def draw(self):
+        pass
+
+
+class NullSound:
+    volume = 1.0
+
+    def play(self):
+        return self
+
+
+class NullWindow:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def get_size(self):
+        return self.width, self.height
+
+    def event(self, fn):
+        return fn
+
+    def push_handlers(self, *args, **kwargs):
+        # there's no window to send any events
+        pass
+
+    def set_exclusive_mouse(self, exclusive=True):
+        pass
+
+    def clear(self):
+        pass
+
+
+class NullEffect:
+    """Stands in for the particle effects in the particles module."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def emit(cls, *args, **kwargs):
+        pass
+
+    def set_world_position(self, *args):
+        pass
+
+    def update(self, *args):
+        pass
+
+    def destroy(self):
+        pass
+
+
+class NullParticleSystem:
+    def update(self, dt):
+        pass
+
+    def draw(self):
+        pass
+
+
+class NullHUD:
+    def __init__(self, viewport, player):
+        pass
+
+    def close(self):
+        pass
+
+    def set_weapon_visible(self, n, visible):
+        pass
+
+    def set_weapon_enabled(self, n, enabled):
+        pass
+
+    def set_boss_weapon(self, enabled):
+        pass
+
+    def set_health(self, health):
+        pass
+
+    def set_lives(self, num):
+        pass
+
+    def show_profile(self, profiler):
+        pass
+
+    def draw(self):
+        pass
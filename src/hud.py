@@ -1,13 +1,14 @@
 import pyglet.sprite
-import pyglet.resource
 from pyglet import gl
 
+from profiler import ProfileGraph
+from textures import cache as texture_cache
 
 
 class HUD:
     SPACING = 5
 
-    image = pyglet.resource.image(f'hud.png')
+    image = texture_cache.image('hud.png')
 
     def __init__(self, viewport, player):
         self.viewport = viewport
@@ -15,11 +16,7 @@ class HUD:
 
         self.batch = pyglet.graphics.Batch()
 
-        self.tiles = pyglet.image.ImageGrid(
-            image=self.image,
-            rows=4,
-            columns=4,
-        ).get_texture_sequence()
+        self.tiles = texture_cache.grid('hud.png', rows=4, columns=4)
 
 
         self.weapons = []
@@ -40,11 +37,7 @@ class HUD:
                 sprite.visible = False
             y += img.height + self.SPACING
 
-        self.bars = tuple(pyglet.image.ImageGrid(
-            image=self.image,
-            rows=2,
-            columns=4,
-        ).get_texture_sequence())[:2]
+        self.bars = tuple(texture_cache.grid('hud.png', rows=2, columns=4))[:2]
 
         self.power = tuple(
             pyglet.sprite.Sprite(
@@ -62,6 +55,8 @@ class HUD:
         self.lives = []
         self.set_lives(player.lives)
 
+        self.profile_graph = None
+
     def close(self):
         pass
 
@@ -113,5 +108,20 @@ class HUD:
             )
             self.lives.append(s)
 
+    def show_profile(self, profiler):
+        """Show a frame time graph for profiler, or hide it if None."""
+        if self.profile_graph:
+            self.profile_graph.delete()
+            self.profile_graph = None
+        if profiler:
+            self.profile_graph = ProfileGraph(
+                profiler,
+                self.batch,
+                self.SPACING,
+                self.viewport.h - ProfileGraph.HEIGHT - self.SPACING,
+            )
+
     def draw(self):
+        if self.profile_graph:
+            self.profile_graph.update()
         self.batch.draw()
@@ -0,0 +1,488 @@
+"""Compiled levels.
+
+Loading a .tmx map means parsing XML, base64/zlib layer data and the .tsx
+tilesets it refers to, and then the map renderer, the collision geometry
+and the instadeath painting each walk the result again.  Instead, the
+first time a map is loaded we do all of that once and save the results as
+a binary bundle in maps/.levelcache/.  After that, loading a level is a
+memory map plus a few array copies.
+
+A bundle holds:
+
+* the tile layers, as arrays of gids
+* the collision layer and the shadow casting tiles
+* the map's vertices, split into MapRenderer chunks, with the gid of
+  every quad (texture coordinates depend on the loaded texture, so the
+  renderer looks them up by gid)
+* the wall rectangles, merged into blobs (see collision.wall_blobs())
+* the tiles reachable from the player's starting position
+* the lights, the objects and the powerup bits
+
+A bundle is rebuilt whenever its .tmx or one of the tilesets changes
+(compared by mtime and size, then by hash) or FORMAT_VERSION changes.
+To compile every map ahead of time, from the src directory:
+
+    python levelcache.py maps/*.tmx
+
+To check that the NumPy collision.wall_blobs() still agrees with the
+original pure Python version on every map:
+
+    python levelcache.py --check maps/*.tmx
+
+run_bench.py does the same check on every map, and fails if it doesn't.
+
+"""
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections import namedtuple
+
+import numpy as np
+import tmx
+
+import collision
+
+
+FORMAT_VERSION = 1
+MAGIC = b'MSALEVEL'
+HEADER = struct.Struct('<8sII')  # magic, version, length of the JSON index
+
+CACHE_DIR = '.levelcache'
+
+# the map is split into square chunks of this many tiles
+# (see MapRenderer)
+CHUNK_SIZE = 16
+
+# the player starts just below the Fab (see Fab.__init__); we flood fill
+# the reachable tiles from there when compiling
+START_OBJECT = 'Fab'
+START_OFFSET = (0, -64)
+
+
+Tileset = namedtuple(
+    'Tileset',
+    'image tilewidth tileheight margin spacing columns tilecount firstgid'
+)
+
+# an object from an object layer; x and y are the centre,
+# in world coordinates, and rotation is in radians
+MapObject = namedtuple('MapObject', 'cls x y rotation')
+
+TileLayer = namedtuple('TileLayer', 'name gids')
+
+
+class CompiledLevel:
+    """Everything the game needs from a .tmx map.
+
+    Tile arrays (layers, collision) are in .tmx order, top row first,
+    like Level.position_to_tile_index().  Everything else is in tile
+    coordinates with y up.
+    """
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.tilewidth = 0
+        self.tileheight = 0
+        self.tileset = None
+        # gid -> wall value (1 = whole tile, 2 = pillar)
+        self.wall_gids = {}
+        self.layers = []
+        # 1 for every wall in the first layer
+        self.collision = bytearray()
+        # the same, as a collision.WallGrid
+        self.walls = None
+        # (x, y) -> wall value for walls in every layer
+        self.shadow_casters = {}
+        self.lights = []
+        # (cx, cy) -> (vertices, one gid per quad)
+        self.chunks = {}
+        self.chunk_size = CHUNK_SIZE
+        self.blobs = []
+        # reach_mask has a 1 for every tile reachable from reach_start
+        self.reach_start = None
+        self.reach_mask = bytearray()
+        self.objects = []
+        self.powerups = 0
+        self.ambient = None
+        # the .tmx file and the tilesets it uses
+        self.sources = []
+
+    def reachable_mask(self, start):
+        """Return collision.reachable_mask() for start, from the cache if we can."""
+        if start != self.reach_start:
+            return collision.reachable_mask(self.walls, start)
+        mask = np.frombuffer(self.reach_mask, dtype=np.uint8)
+        return mask.reshape(self.height, self.width)[::-1] != 0
+
+
+def compile_tmx(tmx_path):
+    """Parse a .tmx file and work out everything in a CompiledLevel."""
+    tiles = tmx.TileMap.load(tmx_path)
+    level = CompiledLevel()
+    level.sources = [tmx_path]
+    for ts in tiles.tilesets:
+        source = getattr(ts, 'source', None)
+        if source and source not in level.sources:
+            level.sources.append(source)
+    level.width = w = tiles.width
+    level.height = h = tiles.height
+
+    tileset = [t for t in tiles.tilesets if 'object' not in t.name.lower()][0]
+    level.tileset = Tileset(
+        image=os.path.basename(tileset.image.source),
+        tilewidth=tileset.tilewidth,
+        tileheight=tileset.tileheight,
+        margin=tileset.margin,
+        spacing=tileset.spacing,
+        columns=tileset.columns,
+        tilecount=tileset.tilecount,
+        firstgid=tileset.firstgid,
+    )
+    level.tilewidth = tilew = tileset.tilewidth
+    level.tileheight = tileh = tileset.tileheight
+
+    light_tiles = {}
+    for tile in tileset.tiles:
+        gid = tileset.firstgid + tile.id
+        props = {p.name: p.value for p in tile.properties}
+        wall = int(props.get('wall', '0'))
+        if wall:
+            level.wall_gids[gid] = wall
+        if 'lightx' in props:
+            light_tiles[gid] = props['lightx'], props['lighty']
+
+    chunk_data = {}
+    for layer in tiles.layers:
+        if not isinstance(layer, tmx.Layer):
+            continue
+        gids = array('I', (tile.gid for tile in layer.tiles))
+        level.layers.append(TileLayer(layer.name, gids))
+
+        for i, gid in enumerate(gids):
+            if gid == 0:
+                continue
+            y, x = divmod(i, w)
+            y = h - y - 1
+
+            chunk = x // CHUNK_SIZE, y // CHUNK_SIZE
+            if chunk not in chunk_data:
+                chunk_data[chunk] = array('i'), array('I')
+            verts, quads = chunk_data[chunk]
+            l = x * tilew
+            t = y * tileh
+            r = l + tilew
+            b = t + tileh
+            verts.extend((l, t, r, t, r, b, l, b))
+            quads.append(gid)
+
+            wall = level.wall_gids.get(gid)
+            if wall:
+                level.shadow_casters[x, y] = wall
+
+            light = light_tiles.get(gid)
+            if light:
+                lx, ly = light
+                level.lights.append((lx + x, ly + y))
+    level.chunks = chunk_data
+
+    level.collision = bytearray(
+        1 if gid in level.wall_gids else 0
+        for gid in level.layers[0].gids
+    )
+    level.walls = collision.WallGrid(w, h, level.collision)
+    level.blobs = [
+        sorted(blob)
+        for blob in collision.wall_blobs(level.walls)
+    ]
+
+    types = {}
+    for ts in tiles.tilesets:
+        for tile in ts.tiles:
+            props = {p.name: p.value for p in tile.properties}
+            if props.get('cls'):
+                types[ts.firstgid + tile.id] = props['cls']
+
+    for layer in tiles.layers:
+        if not isinstance(layer, tmx.ObjectGroup):
+            continue
+        for obj in layer.objects:
+            # same sums as Level.spawn_map_objects() used to do
+            angle = -math.radians(obj.rotation)
+            ox = obj.width / 2
+            oy = obj.height / 2
+            cx = obj.x + ox * math.cos(angle) - oy * math.sin(angle)
+            cy = h * tilew - obj.y + ox * math.sin(angle) + oy * math.cos(angle)
+            cls = types[obj.gid]
+            level.objects.append(MapObject(cls, cx, cy, angle))
+            if cls.startswith("Powerup"):
+                level.powerups |= 1 << int(cls[len("Powerup"):])
+
+    level.reach_mask = bytearray(w * h)
+    for obj in level.objects:
+        if obj.cls == START_OBJECT:
+            sx = (obj.x + START_OFFSET[0]) / tilew
+            sy = (obj.y + START_OFFSET[1]) / tilew
+            level.reach_start = int(sx), int(sy)
+            mask = collision.reachable_mask(level.walls, level.reach_start)
+            level.reach_mask = bytearray(mask[::-1].astype(np.uint8).tobytes())
+            break
+
+    props = {p.name: p.value for p in tiles.properties}
+    if 'ambient' in props:
+        a = props['ambient']
+        level.ambient = (a.red / 255, a.green / 255, a.blue / 255)
+
+    return level
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return {'path': path, 'mtime': st.st_mtime_ns, 'size': st.st_size, 'sha1': digest}
+
+
+def is_fresh(sources):
+    """Return True if none of the fingerprinted files have changed."""
+    for source in sources:
+        try:
+            st = os.stat(source['path'])
+        except OSError:
+            return False
+        if (st.st_mtime_ns, st.st_size) == (source['mtime'], source['size']):
+            continue
+        # touched but maybe not changed
+        if fingerprint(source['path'])['sha1'] != source['sha1']:
+            return False
+    return True
+
+
+def cache_path(tmx_path):
+    directory, filename = os.path.split(tmx_path)
+    basename = os.path.splitext(filename)[0]
+    return os.path.join(directory, CACHE_DIR, basename + '.lvl')
+
+
+def write_bundle(path, level):
+    arrays = {
+        'collision': array('B', level.collision),
+        'reach_mask': array('B', level.reach_mask),
+        'shadow_casters': array('i', (
+            v for (x, y), wall in sorted(level.shadow_casters.items())
+            for v in (x, y, wall)
+        )),
+    }
+    for i, layer in enumerate(level.layers):
+        arrays[f'layer{i}'] = layer.gids
+
+    # every chunk's vertices and gids, end to end, with an index of
+    # (cx, cy, first quad, number of quads)
+    chunk_index = array('i')
+    chunk_verts = array('i')
+    chunk_gids = array('I')
+    for (cx, cy), (verts, gids) in sorted(level.chunks.items()):
+        chunk_index.extend((cx, cy, len(chunk_gids), len(gids)))
+        chunk_verts.extend(verts)
+        chunk_gids.extend(gids)
+    arrays['chunk_index'] = chunk_index
+    arrays['chunk_verts'] = chunk_verts
+    arrays['chunk_gids'] = chunk_gids
+
+    blob_sizes = array('I', (len(blob) for blob in level.blobs))
+    blob_rects = array('i', (
+        v for blob in level.blobs
+        for (x, y), (end_x, end_y) in blob
+        for v in (x, y, end_x, end_y)
+    ))
+    arrays['blob_sizes'] = blob_sizes
+    arrays['blob_rects'] = blob_rects
+
+    index = {
+        'sources': [fingerprint(p) for p in level.sources],
+        'byteorder': sys.byteorder,
+        'width': level.width,
+        'height': level.height,
+        'tileset': level.tileset._asdict(),
+        'wall_gids': sorted(level.wall_gids.items()),
+        'layers': [layer.name for layer in level.layers],
+        'lights': level.lights,
+        'objects': [obj._asdict() for obj in level.objects],
+        'powerups': level.powerups,
+        'ambient': level.ambient,
+        'reach_start': level.reach_start,
+        'chunk_size': CHUNK_SIZE,
+        'arrays': {},
+    }
+
+    # lay the arrays out after the index, each 8-byte aligned
+    blobs = []
+    offset = 0
+    for name, a in arrays.items():
+        data = a.tobytes()
+        index['arrays'][name] = [a.typecode, offset, len(a)]
+        blobs.append(data + b'\0' * (-len(data) % 8))
+        offset += len(blobs[-1])
+
+    header = json.dumps(index).encode('utf8')
+    header += b' ' * (-(HEADER.size + len(header)) % 8)
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # a file of our own to write to, as the preload thread and the main
+    # thread can both be compiling the same map
+    f = tempfile.NamedTemporaryFile(
+        dir=directory,
+        prefix=os.path.basename(path) + '.',
+        suffix='.tmp',
+        delete=False,
+    )
+    try:
+        with f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for data in blobs:
+                f.write(data)
+        # so that nobody ever reads half a bundle
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def read_index(mm):
+    magic, version, length = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None
+    index = json.loads(mm[HEADER.size:HEADER.size + length].decode('utf8'))
+    if index['byteorder'] != sys.byteorder or index['chunk_size'] != CHUNK_SIZE:
+        return None
+    index['data_offset'] = HEADER.size + length
+    return index
+
+
+def read_bundle(path):
+    """Return the CompiledLevel in the bundle, or None if it is stale."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        index = read_index(mm)
+        if not index or not is_fresh(index['sources']):
+            return None
+
+        arrays = {}
+        base = index['data_offset']
+        with memoryview(mm) as view:
+            for name, (typecode, offset, count) in index['arrays'].items():
+                a = array(typecode)
+                start = base + offset
+                a.frombytes(view[start:start + count * a.itemsize])
+                arrays[name] = a
+
+    level = CompiledLevel()
+    level.width = index['width']
+    level.height = index['height']
+    level.tileset = Tileset(**index['tileset'])
+    level.tilewidth = level.tileset.tilewidth
+    level.tileheight = level.tileset.tileheight
+    level.wall_gids = dict(index['wall_gids'])
+    level.layers = [
+        TileLayer(name, arrays[f'layer{i}'])
+        for i, name in enumerate(index['layers'])
+    ]
+    level.collision = bytearray(arrays['collision'])
+    level.walls = collision.WallGrid(level.width, level.height, level.collision)
+    level.reach_mask = bytearray(arrays['reach_mask'])
+    if index['reach_start']:
+        level.reach_start = tuple(index['reach_start'])
+
+    casters = arrays['shadow_casters']
+    level.shadow_casters = {
+        (casters[i], casters[i + 1]): casters[i + 2]
+        for i in range(0, len(casters), 3)
+    }
+
+    verts = arrays['chunk_verts']
+    gids = arrays['chunk_gids']
+    ci = arrays['chunk_index']
+    for i in range(0, len(ci), 4):
+        cx, cy, first, count = ci[i:i + 4]
+        level.chunks[cx, cy] = (
+            verts[first * 8:(first + count) * 8],
+            gids[first:first + count],
+        )
+
+    rects = arrays['blob_rects']
+    i = 0
+    for size in arrays['blob_sizes']:
+        level.blobs.append([
+            ((rects[j], rects[j + 1]), (rects[j + 2], rects[j + 3]))
+            for j in range(i, i + size * 4, 4)
+        ])
+        i += size * 4
+
+    level.lights = [tuple(light) for light in index['lights']]
+    level.objects = [MapObject(**obj) for obj in index['objects']]
+    level.powerups = index['powerups']
+    level.ambient = index['ambient'] and tuple(index['ambient'])
+    level.sources = [source['path'] for source in index['sources']]
+    return level
+
+
+def load(tmx_path):
+    """Return the CompiledLevel for a .tmx file, compiling it if need be."""
+    path = cache_path(tmx_path)
+    try:
+        level = read_bundle(path)
+    except (OSError, ValueError, KeyError, struct.error):
+        # missing, truncated or from some other version of this code
+        level = None
+    if level:
+        return level
+
+    level = compile_tmx(tmx_path)
+    try:
+        write_bundle(path, level)
+    except OSError as e:
+        print(f"couldn't write level cache {path}: {e}")
+    return level
+
+
+def check_wall_blobs(tmx_path):
+    """Compare collision.wall_blobs() with wall_blobs_python() for a map.
+
+    Returns a list of the differences, which should be empty.
+    """
+    level = compile_tmx(tmx_path)
+    fast = collision.wall_blobs(level.walls)
+    slow = collision.wall_blobs_python(level.width, level.height, level.walls.is_wall)
+    fast_rects = {rect for blob in fast for rect in blob}
+    slow_rects = {rect for blob in slow for rect in blob}
+    problems = [f"extra rect {r}" for r in sorted(fast_rects - slow_rects)]
+    problems += [f"missing rect {r}" for r in sorted(slow_rects - fast_rects)]
+    fast_blobs = {frozenset(blob) for blob in fast}
+    slow_blobs = {frozenset(blob) for blob in slow}
+    if not problems and fast_blobs != slow_blobs:
+        problems.append("rects are grouped into different blobs")
+    return problems
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--check']:
+        failed = False
+        for tmx_path in sys.argv[2:]:
+            problems = check_wall_blobs(tmx_path)
+            print(f"{tmx_path}: {'ok' if not problems else 'MISMATCH'}")
+            for problem in problems:
+                print(f"    {problem}")
+            failed = failed or bool(problems)
+        sys.exit(failed)
+
+    for tmx_path in sys.argv[1:]:
+        path = cache_path(tmx_path)
+        write_bundle(path, compile_tmx(tmx_path))
+        print(f"{tmx_path} -> {path}")
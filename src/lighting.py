@@ -1,15 +1,16 @@
 from contextlib import contextmanager
+from ctypes import byref
 from math import floor, ceil, degrees, sqrt
 
+import pyglet.graphics
 from pyglet import gl
 import lightvolume
 
-from fbo import FrameBuffer
+from fbo import pool as framebuffer_pool
 from shader import Shader
 
 
-lighting_shader = Shader(
-    vert="""
+LIGHTING_VERT = """
 varying vec2 pos; // position of the fragment in screen space
 varying vec2 uv;
 
@@ -24,8 +25,9 @@ void main(void)
     pos = gl_Vertex.xy;
     uv = gl_Position.xy * 0.5 + vec2(0.5, 0.5);
 }
-""",
-    frag="""
+"""
+
+LIGHTING_FRAG = """
 varying vec2 pos;
 varying vec2 uv;
 
@@ -49,34 +51,352 @@ void main (void) {
 
     float dist = max(1.0 - distance(pos, light_pos) / attenuation, 0.0);
     float lum = pow(dist, exponent);
+#ifdef LIGHT_MAP
+    gl_FragColor = vec4(lum * light_color, 1.0);
+#else
     gl_FragColor = lum * (diffuse * vec4(light_color, 1.0));
+#endif
 }
 """
-)
+
+# The batched path draws every light as one quad in a single vertex list,
+# with the light's parameters riding along as vertex attributes:
+#
+#    gl_MultiTexCoord0 = (light x, light y, radius, exponent)
+#    gl_Color          = light colour (unclamped, flashes go above 1.0)
+#
+# Instead of lightvolume's per-light visibility polygons, the fragment
+# shader finds shadows by walking the tiles between the fragment and the
+# light (Amanatides & Woo) through a texture of the shadow casting tiles.
+BATCHED_VERT = """
+varying vec2 pos;
+varying vec2 uv;
+varying vec2 light_pos;
+varying vec3 light_color;
+varying float attenuation;
+varying float exponent;
+
+void main(void)
+{
+    gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+    pos = gl_Vertex.xy;
+    uv = gl_Position.xy * 0.5 + vec2(0.5, 0.5);
+    light_pos = gl_MultiTexCoord0.xy;
+    attenuation = gl_MultiTexCoord0.z;
+    exponent = gl_MultiTexCoord0.w;
+    light_color = gl_Color.rgb;
+}
+"""
+
+BATCHED_FRAG = """
+// enough for a 400px light on a 16px tile map
+#define MAX_STEPS 64
+
+varying vec2 pos;
+varying vec2 uv;
+varying vec2 light_pos;
+varying vec3 light_color;
+varying float attenuation;
+varying float exponent;
+
+uniform sampler2D diffuse_tex;
+uniform sampler2D walls_tex;  // 1.0 = whole tile wall, 0.5 = pillar
+uniform vec2 walls_size;      // in tiles
+uniform float tilew;
+
+float wall_at(vec2 cell) {
+    if (any(lessThan(cell, vec2(0.0))) || any(greaterThanEqual(cell, walls_size))) {
+        return 0.0;
+    }
+    return texture2D(walls_tex, (cell + 0.5) / walls_size).r;
+}
+
+// does the segment from + t * d, 0 <= t <= 1, pass through
+// the pillar in the middle of this cell?
+bool hits_pillar(vec2 from, vec2 d, vec2 cell) {
+    vec2 safe_d = vec2(
+        abs(d.x) < 1e-6 ? 1e-6 : d.x,
+        abs(d.y) < 1e-6 ? 1e-6 : d.y
+    );
+    vec2 t0 = (cell + 0.25 - from) / safe_d;
+    vec2 t1 = (cell + 0.75 - from) / safe_d;
+    vec2 tmin = min(t0, t1);
+    vec2 tmax = max(t0, t1);
+    float enter = max(tmin.x, tmin.y);
+    float leave = min(tmax.x, tmax.y);
+    return enter <= leave && leave >= 0.0 && enter <= 1.0;
+}
+
+float visibility(vec2 from, vec2 to) {
+    vec2 d = to - from;
+    vec2 cell = floor(from);
+    vec2 end = floor(to);
+    vec2 dir = sign(d);
+    vec2 delta = 1.0 / max(abs(d), vec2(1e-6));
+    vec2 next = (dir * (cell - from) + max(dir, vec2(0.0))) * delta;
+
+    for (int i = 0; i < MAX_STEPS; i++) {
+        // the light's own tile never shadows it
+        if (cell == end) {
+            return 1.0;
+        }
+        float wall = wall_at(cell);
+        if (wall > 0.75 || (wall > 0.25 && hits_pillar(from, d, cell))) {
+            return 0.0;
+        }
+        if (next.x < next.y) {
+            cell.x += dir.x;
+            next.x += delta.x;
+        } else {
+            cell.y += dir.y;
+            next.y += delta.y;
+        }
+    }
+    return 1.0;
+}
+
+void main (void) {
+    float dist = max(1.0 - distance(pos, light_pos) / attenuation, 0.0);
+    if (dist <= 0.0) {
+        discard;
+    }
+    float lit = visibility(pos / tilew, light_pos / tilew);
+    float lum = lit * pow(dist, exponent);
+#ifdef LIGHT_MAP
+    gl_FragColor = vec4(lum * light_color, 1.0);
+#else
+    vec4 diffuse = texture2D(diffuse_tex, uv);
+    gl_FragColor = lum * (diffuse * vec4(light_color, 1.0));
+#endif
+}
+"""
+
+# When the light map is drawn at reduced resolution the light shaders are
+# compiled with LIGHT_MAP defined.  They then write only the light, which
+# is added up in a small buffer on top of the ambient light, and this
+# multiplies the (bilinearly filtered) light map with the full resolution
+# diffuse buffer.
+COMPOSITE_VERT = """
+varying vec2 uv;
+
+void main(void)
+{
+    gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+    uv = gl_MultiTexCoord0.xy;
+}
+"""
+
+COMPOSITE_FRAG = """
+varying vec2 uv;
+
+uniform sampler2D diffuse_tex;
+uniform sampler2D light_tex;
+
+void main (void) {
+    gl_FragColor = texture2D(diffuse_tex, uv) * texture2D(light_tex, uv);
+}
+"""
+
+# program name -> (vertex source, fragment source, texture unit for each
+# sampler, uniforms set per light or per frame)
+PROGRAMS = {
+    'light': (
+        LIGHTING_VERT, LIGHTING_FRAG,
+        {'diffuse_tex': 0},
+        ('light_pos', 'light_color', 'attenuation', 'exponent'),
+    ),
+    'batched': (
+        BATCHED_VERT, BATCHED_FRAG,
+        {'diffuse_tex': 0, 'walls_tex': 1},
+        ('walls_size', 'tilew'),
+    ),
+    'composite': (
+        COMPOSITE_VERT, COMPOSITE_FRAG,
+        {'diffuse_tex': 0, 'light_tex': 1},
+        (),
+    ),
+}
+
+# the fractions of the window size the light map can be drawn at
+LIGHT_MAP_SCALES = (1, 0.5, 0.25)
 
 
 class Light:
     exponent = 2
+    # the LightGrid this light is in, if any
+    grid = None
 
-    def __init__(self, position=(0, 0), color=(1.0, 1.0, 1.0), radius=200):
+    def __init__(self, position=(0, 0), color=(1.0, 1.0, 1.0), radius=200, static=False):
         self.position = position
         self.color = color
         self.radius = radius
+        # static lights (the ones placed in the map) don't move, so
+        # LightRenderer can keep their shadow casters between frames
+        self.static = static
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, v):
+        self._position = v
+        if self.grid:
+            self.grid.move(self)
+
+
+class LightGrid:
+    """Lights bucketed by the grid cell their centre is in.
+
+    Cells are CELL_SIZE tiles square.  Lights tell the grid when they
+    move, so finding the lights near the viewport only looks at the
+    cells around it rather than at every light.
+    """
+    CELL_SIZE = 8
+
+    def __init__(self):
+        self.cells = {}
+        self.count = 0
+        # the largest radius (in pixels) of any light added since the
+        # last clear(), which bounds how far outside the viewport a
+        # visible light can be
+        self.max_radius = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for cell in self.cells.values():
+            yield from cell
+
+    def cell_for(self, position):
+        x, y = position
+        return int(x // self.CELL_SIZE), int(y // self.CELL_SIZE)
+
+    def add(self, light):
+        if light.grid is self:
+            return
+        cell = self.cell_for(light.position)
+        self.cells.setdefault(cell, set()).add(light)
+        light.grid = self
+        light.cell = cell
+        self.count += 1
+        if light.radius > self.max_radius:
+            self.max_radius = light.radius
+
+    def discard(self, light):
+        if light.grid is not self:
+            return
+        cell = self.cells[light.cell]
+        cell.discard(light)
+        if not cell:
+            del self.cells[light.cell]
+        light.grid = None
+        self.count -= 1
+
+    def move(self, light):
+        cell = self.cell_for(light.position)
+        if cell != light.cell:
+            old = self.cells[light.cell]
+            old.discard(light)
+            if not old:
+                del self.cells[light.cell]
+            self.cells.setdefault(cell, set()).add(light)
+            light.cell = cell
+
+    def clear(self):
+        for light in self:
+            light.grid = None
+        self.cells.clear()
+        self.count = 0
+        self.max_radius = 0
+
+    def query(self, l, r, b, t):
+        """Yield the lights whose centres may lie in the given tile rect."""
+        size = self.CELL_SIZE
+        cells = self.cells
+        for cx in range(int(l // size), int(r // size) + 1):
+            for cy in range(int(b // size), int(t // size) + 1):
+                cell = cells.get((cx, cy))
+                if cell:
+                    yield from cell
+
+
+def rect_segments(l, r, b, t):
+    """Return the edges of a rectangle as lightvolume line segments."""
+    return [
+        l, b, r, b,
+        r, b, r, t,
+        r, t, l, t,
+        l, t, l, b,
+    ]
 
 
 class LightRenderer:
-    def __init__(self, viewport, shadow_casters=None, ambient=(0.15, 0.15, 0.3)):
+    # (Shader, UniformGroup) by (program name, light map), shared by all
+    # renderers and compiled on first use, so that creating a
+    # LightRenderer doesn't need a GL context
+    programs = {}
+
+    shader = None
+    batched_shader = None
+    # UniformGroups for the per-light and per-frame uploads
+    light_uniforms = None
+    batched_uniforms = None
+
+    def __init__(
+            self, viewport, shadow_casters=None, ambient=(0.15, 0.15, 0.3), batched=True,
+            scale=1, buffer_format=gl.GL_RGBA16F):
         self.viewport = viewport
-        self.shadow_casters = shadow_casters or {}
-        self.lights = set()
+        self.lights = LightGrid()
+        # things that keep lights of their own, outside the grid
+        self.light_sources = []
         self.fbo = None
+        # with scale < 1 the lights are added up in this smaller buffer,
+        # which is then stretched over the diffuse buffer in self.fbo
+        self.light_fbo = None
+        self.scale = scale
+        # the format of both buffers; GL_RGBA8 saves the most bandwidth,
+        # but clamps lights brighter than 1.0 in the light map
+        self.buffer_format = buffer_format
         self.ambient = ambient
         self.sh = None
+        # packed occluder segments for static lights, by light; only
+        # render_light() uses these, as the batched pass reads the
+        # shadow casters from walls_tex instead, which is only built
+        # when they change
+        self.occluders = {}
+        # draw all lights in one pass; if the batched shader won't
+        # compile we fall back to drawing them one at a time
+        self.batched = batched
+        self.walls_tex = None
+        self.walls_size = (0, 0)
+        self.batch_vl = None
+        self.shadow_casters = shadow_casters or {}
+
+    @property
+    def shadow_casters(self):
+        return self._shadow_casters
+
+    @shadow_casters.setter
+    def shadow_casters(self, v):
+        self._shadow_casters = v
+        self.invalidate_shadows()
+
+    def invalidate_shadows(self):
+        """Rebuild everything derived from the shadow casters before the
+        next frame.
+
+        Assigning shadow_casters does this; call it directly after
+        changing the shadow_casters dict in place.
+        """
+        self.sh = None
+        self.occluders.clear()
+        self._delete_walls_texture()
 
     def clear(self):
-        self.lights.clear()
+        self.clear_lights()
         self.shadow_casters = {}
-        self.sh = None
 
     def _build_spatial_hash(self):
         sh = {}
@@ -85,14 +405,51 @@ class LightRenderer:
                 sh[tx, ty] = self._make_volume(tx, ty, wall)
         return sh
 
+    def _build_walls_texture(self):
+        """Upload the shadow casters as a one texel per tile texture."""
+        self._delete_walls_texture()
+        if not self.shadow_casters:
+            return
+        w = max(tx for tx, ty in self.shadow_casters) + 1
+        h = max(ty for tx, ty in self.shadow_casters) + 1
+        texels = bytearray(w * h)
+        for (tx, ty), wall in self.shadow_casters.items():
+            if wall and tx >= 0 and ty >= 0:
+                texels[ty * w + tx] = 128 if wall == 2 else 255
+
+        tex = gl.GLuint()
+        gl.glGenTextures(1, byref(tex))
+        gl.glBindTexture(gl.GL_TEXTURE_2D, tex)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glTexImage2D(
+            gl.GL_TEXTURE_2D, 0, gl.GL_LUMINANCE,
+            w, h,
+            0,
+            gl.GL_LUMINANCE, gl.GL_UNSIGNED_BYTE,
+            (gl.GLubyte * len(texels)).from_buffer(texels)
+        )
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+        self.walls_tex = tex
+        self.walls_size = (w, h)
+
+    def _delete_walls_texture(self):
+        if self.walls_tex:
+            gl.glDeleteTextures(1, byref(self.walls_tex))
+            self.walls_tex = None
+            self.walls_size = (0, 0)
+
     def _make_volume(self, tx, ty, wall):
         if wall == 2:
-            return lightvolume.rect(
+            return rect_segments(
                 (tx + 0.25) * self.tilew, (tx + 0.75) * self.tilew,
                 (ty + 0.25) * self.tilew, (ty + 0.75) * self.tilew
             )
         else:
-            return lightvolume.rect(
+            return rect_segments(
                 tx * self.tilew, (tx + 1) * self.tilew,
                 ty * self.tilew, (ty + 1) * self.tilew
             )
@@ -104,10 +461,56 @@ class LightRenderer:
     def remove_light(self, light):
         """Remove a light."""
         self.lights.discard(light)
+        self.occluders.pop(light, None)
+
+    def add_light_source(self, source):
+        """Add something that keeps lights of its own.
+
+        Every frame, source.visible_lights(x, y, radius) is asked for
+        the lights that could touch a circle of the given radius
+        around (x, y), all in pixels, and should yield them ready to
+        draw.  It's how a crowd of lights that all move every tick can
+        be brought up to date only when they're drawn.
+        """
+        self.light_sources.append(source)
+
+    def remove_light_source(self, source):
+        self.light_sources.remove(source)
 
     def clear_lights(self):
         """Remove all lights."""
         self.lights.clear()
+        self.occluders.clear()
+
+    def set_quality(self, scale=None, buffer_format=None):
+        """Change the light map scale or the buffer format.
+
+        The buffers are reallocated at the start of the next frame.
+        """
+        if scale is not None:
+            assert scale in LIGHT_MAP_SCALES, f"Unsupported light map scale {scale}"
+            self.scale = scale
+        if buffer_format is not None:
+            self.buffer_format = buffer_format
+        self._release_buffers()
+
+    def _allocate_buffers(self):
+        self._release_buffers()
+        w = self.viewport.w
+        h = self.viewport.h
+        self.fbo = framebuffer_pool.acquire(w, h, internal_format=self.buffer_format)
+        if self.scale != 1:
+            self.light_fbo = framebuffer_pool.acquire(
+                max(1, round(w * self.scale)),
+                max(1, round(h * self.scale)),
+                internal_format=self.buffer_format,
+                filter=gl.GL_LINEAR,
+            )
+
+    def _release_buffers(self):
+        framebuffer_pool.release(self.fbo)
+        framebuffer_pool.release(self.light_fbo)
+        self.fbo = self.light_fbo = None
 
     def is_fbo_valid(self):
         """Return True if the FBO still matches the size of the viewport."""
@@ -117,10 +520,33 @@ class LightRenderer:
             self.fbo.height == self.viewport.h
         )
 
+    def _program(self, name):
+        """Return the (Shader, UniformGroup) for one of PROGRAMS."""
+        light_map = self.scale != 1
+        program = self.programs.get((name, light_map))
+        if program is None:
+            vert, frag, samplers, uniforms = PROGRAMS[name]
+            if light_map:
+                frag = '#define LIGHT_MAP\n' + frag
+            shader = Shader(vert=vert, frag=frag)
+            # samplers never change unit, so set them once
+            shader.bind()
+            for sampler, unit in samplers.items():
+                shader.uniformi(sampler, unit)
+            shader.unbind()
+            program = self.programs[name, light_map] = shader, shader.uniform_group(*uniforms)
+        return program
+
     @contextmanager
     def illuminate(self):
+        if self.batched:
+            self.batched_shader, self.batched_uniforms = self._program('batched')
+            if not self.batched_shader.linked:
+                self.batched = False
+        if not self.batched:
+            self.shader, self.light_uniforms = self._program('light')
         if not self.is_fbo_valid():
-            self.fbo = FrameBuffer(self.viewport.w, self.viewport.h)
+            self._allocate_buffers()
 
         #self.vl.vertices = self.viewport_coords()
 
@@ -132,34 +558,48 @@ class LightRenderer:
 
         if self.sh is None:
             self.sh = self._build_spatial_hash()
+            if self.batched:
+                self._build_walls_texture()
         self.render()
 
-    def render(self):
-        """Render all lights."""
-        gl.glEnable(gl.GL_TEXTURE_2D)
-        gl.glActiveTexture(gl.GL_TEXTURE0)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.fbo.textures[0])
-        lighting_shader.bind()
-        lighting_shader.uniformi('diffuse_tex', 0)
-        gl.glEnable(gl.GL_BLEND)
-        gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE)
-
+    def visible_lights(self):
+        """Yield the lights that could touch the viewport."""
         vpw = self.viewport.w
         vph = self.viewport.h
         vpx, vpy = self.viewport.position
         vpradius = sqrt(vpw * vpw + vph * vph) * 0.5
 
-        c = 0
-        for light in self.lights:
+        # only look in the cells that a visible light's centre could be in
+        reach = (vpradius + self.lights.max_radius) / self.tilew
+        cx = vpx / self.tilew
+        cy = vpy / self.tilew
+        nearby = self.lights.query(cx - reach, cx + reach, cy - reach, cy + reach)
+
+        for light in nearby:
             lx, ly = light.position
             maxdist = light.radius + vpradius
             dx = vpx - lx * self.tilew
             dy = vpy - ly * self.tilew
             dist = sqrt(dx * dx + dy * dy)
             if dist < maxdist:
-                self.render_light(light)
-                c += 1
-        lighting_shader.unbind()
+                yield light
+
+        for source in self.light_sources:
+            yield from source.visible_lights(vpx, vpy, vpradius)
+
+    def render(self):
+        """Render all lights."""
+        if self.light_fbo:
+            self.render_light_map()
+            return
+
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.fbo.textures[0])
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE)
+
+        self.draw_lights()
 
         # Draw ambient using a full-screen quad
         gl.glColor3f(*self.ambient)
@@ -167,8 +607,48 @@ class LightRenderer:
         gl.glColor4f(1, 1, 1, 1)
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
-    def render_light(self, light):
-        volumes = []
+    def render_light_map(self):
+        """Add up the lights at reduced resolution, then composite."""
+        gl.glPushAttrib(gl.GL_VIEWPORT_BIT | gl.GL_COLOR_BUFFER_BIT)
+        with self.light_fbo:
+            # the projection still covers the whole window; only the
+            # viewport shrinks
+            gl.glViewport(0, 0, self.light_fbo.width, self.light_fbo.height)
+            # every pixel starts with the ambient light
+            gl.glClearColor(*self.ambient, 1.0)
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+            gl.glEnable(gl.GL_BLEND)
+            gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE)
+            self.draw_lights()
+        gl.glPopAttrib()
+
+        shader, _ = self._program('composite')
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE)
+        gl.glActiveTexture(gl.GL_TEXTURE1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.light_fbo.textures[0])
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.fbo.textures[0])
+        shader.bind()
+        self.viewport.draw_quad()
+        shader.unbind()
+        gl.glActiveTexture(gl.GL_TEXTURE1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+    def draw_lights(self):
+        if self.batched:
+            self.render_batched()
+        else:
+            self.shader.bind()
+            for light in self.visible_lights():
+                self.render_light(light)
+            self.shader.unbind()
+
+    def _occluder_segments(self, light):
+        """Pack the edges of the shadow casters around light for lightvolume."""
         x, y = light.position
 
         tr = ceil(light.radius / self.tilew)
@@ -177,23 +657,81 @@ class LightRenderer:
         b = y - tr
         t = y + tr
 
-        volumes.append(
-            lightvolume.rect(
-                (l - 1) * self.tilew, (r + 1) * self.tilew,
-                (b - 1) * self.tilew, (t + 1) * self.tilew,
-            )
+        segments = rect_segments(
+            (l - 1) * self.tilew, (r + 1) * self.tilew,
+            (b - 1) * self.tilew, (t + 1) * self.tilew,
         )
 
         for tx in range(int(floor(l)), int(ceil(r))):
             for ty in range(int(floor(b)), int(ceil(t))):
                 vol = self.sh.get((tx, ty))
                 if vol:
-                    volumes.append(vol)
+                    segments.extend(vol)
+
+        return lightvolume.ffi.new('float []', segments)
+
+    def render_light(self, light):
+        # the key tells us if a static light was moved or resized anyway
+        key = light.position, light.radius
+        cached = self.occluders.get(light)
+        if cached and cached[0] == key:
+            segments = cached[1]
+        else:
+            segments = self._occluder_segments(light)
+            if light.static:
+                self.occluders[light] = key, segments
 
+        x, y = light.position
         wx = x * self.tilew
         wy = y * self.tilew
-        lighting_shader.uniformf('light_pos', wx, wy)
-        lighting_shader.uniformf('light_color', *light.color)
-        lighting_shader.uniformf('attenuation', light.radius)
-        lighting_shader.uniformf('exponent', light.exponent)
-        lightvolume.draw_light((wx, wy), volumes)
+        self.light_uniforms.set((wx, wy), light.color, light.radius, light.exponent)
+        # lightvolume.draw_light() would repack the segments every call
+        lightvolume.lib.draw_visibility(wx, wy, segments, len(segments))
+
+    def render_batched(self):
+        """Render every visible light with a single draw call."""
+        tilew = self.tilew
+        verts = []
+        params = []
+        colors = []
+        for light in self.visible_lights():
+            lx, ly = light.position
+            wx = lx * tilew
+            wy = ly * tilew
+            r = light.radius
+            verts.extend((
+                wx - r, wy - r,
+                wx + r, wy - r,
+                wx + r, wy + r,
+                wx - r, wy + r,
+            ))
+            param = (wx, wy, r, light.exponent)
+            params.extend(param * 4)
+            colors.extend(tuple(light.color) * 4)
+
+        count = len(verts) // 2
+        if not count:
+            return
+
+        if self.batch_vl is None:
+            self.batch_vl = pyglet.graphics.vertex_list(
+                count, 'v2f/stream', 't4f/stream', 'c3f/stream'
+            )
+        elif self.batch_vl.get_size() != count:
+            self.batch_vl.resize(count)
+        vl = self.batch_vl
+        vl.vertices = verts
+        vl.tex_coords = params
+        vl.colors = colors
+
+        shader = self.batched_shader
+        gl.glActiveTexture(gl.GL_TEXTURE1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.walls_tex or 0)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        shader.bind()
+        self.batched_uniforms.set(self.walls_size, tilew)
+        vl.draw(gl.GL_QUADS)
+        shader.unbind()
+        gl.glActiveTexture(gl.GL_TEXTURE1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
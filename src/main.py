@@ -2,6 +2,7 @@
 # -*- coding: UTF-8 -*-
 
 # system includes
+import concurrent.futures
 from enum import Enum, IntEnum
 import io
 import math
@@ -13,8 +14,13 @@ import random
 import sys
 import time
 
+# headless mode must be enabled before we import anything from pyglet
+import headless
+HEADLESS = headless.enabled
+
 # built from source
-from lepton import default_system
+if not HEADLESS:
+    from lepton import default_system
 
 # pip3.6 install pyglet
 # currently 1.2.4
@@ -25,8 +31,11 @@ from pyglet import gl
 
 # The "pulse" audio driver was super crashy for us.
 # on Linux we recommend OpenAL (Debian package: libopenal1)
-pyglet.options['audio'] = ('openal', 'directsound', 'silent')
-pyglet.resource.path = ["gfx", "fonts", "sfx"]
+if not HEADLESS:
+    pyglet.options['audio'] = ('openal', 'directsound', 'silent')
+# pyglet resolves relative paths against the directory of the __main__
+# script, which isn't src/ (and is absolute from Python 3.9 onwards)
+pyglet.resource.path = [os.path.abspath(p) for p in ("gfx", "fonts", "sfx")]
 pyglet.resource.reindex()
 
 
@@ -41,31 +50,60 @@ sys.stdout = tmp
 del tmp
 import pymunk.pyglet_util
 
+import numpy as np
+
 # Vec2D: 2D vector, mutable (sigh)
 from pymunk import Vec2d
 vector_zero = Vec2d.zero()
 vector_unit_x = Vec2d(1, 0)
 vector_unit_y = Vec2d(0, 1)
 
-# pip3.6 install tmx
-# currently 1.9.1
-import tmx
-
 # local libraries
-from particles import Trail, Kaboom, Smoke, diffuse_system, Impact, Debris
 from maprenderer import MapRenderer, Viewport
-from lighting import LightRenderer, Light
-from hud import HUD
+import collision
+import levelcache
+from lighting import LightRenderer, Light, LIGHT_MAP_SCALES
+from fbo import pool as framebuffer_pool
+from profiler import Profiler
+from timestep import FixedTimestep
+import replay
+if HEADLESS:
+    from headless import (
+        NullEffect as Trail,
+        NullEffect as Kaboom,
+        NullEffect as Smoke,
+        NullEffect as Impact,
+        NullEffect as Debris,
+        NullHUD as HUD,
+        NullSprite as Sprite,
+        NullSprite as Label,
+        NullBatch as Batch,
+        load_image,
+        load_image as load_texture,
+    )
+    diffuse_system = default_system = headless.NullParticleSystem()
+else:
+    from particles import Trail, Kaboom, Smoke, diffuse_system, Impact, Debris
+    from hud import HUD
+    from pyglet.sprite import Sprite, SpriteGroup
+    from pyglet.text import Label
+    from pyglet.graphics import Batch
+    from textures import cache as texture_cache
+    load_image = texture_cache.image
+    load_texture = texture_cache.texture
 
 
 key = pyglet.window.key
 EVENT_HANDLED = pyglet.event.EVENT_HANDLED
 
-window = pyglet.window.Window(600, 800)
-window.set_caption("My Sincerest Apologies")
-window.set_icon(pyglet.image.load('gfx/icon32.png'), pyglet.image.load('gfx/icon16.png'))
+if HEADLESS:
+    window = headless.NullWindow(600, 800)
+else:
+    window = pyglet.window.Window(600, 800)
+    window.set_caption("My Sincerest Apologies")
+    window.set_icon(pyglet.image.load('gfx/icon32.png'), pyglet.image.load('gfx/icon16.png'))
 
-pyglet.font.add_file("fonts/checkbk0.ttf")
+    pyglet.font.add_file("fonts/checkbk0.ttf")
 
 
 viewport = Viewport(*window.get_size())
@@ -73,12 +111,38 @@ debug_viewport = Viewport(50, 50)
 
 ENGINE_TICKS_IN_HERTZ = 120
 
+# cooldowns and countdowns are counted in 120ths of a second, and
+# count down by dt * COOLDOWN_HZ a tick, so whatever the tick rate,
+# everything fires as often as it does at 120 Hz
+COOLDOWN_HZ = 120
+
+# the most engine ticks we'll run to catch up after a slow frame;
+# beyond that, the game slows down instead
+MAX_TICKS_PER_FRAME = 6
+
+# sweep fast bullets along their path before each physics step,
+# so they can't pass through walls between ticks; see sweep_bullets()
+BULLET_SWEEP = True
+
+# how many times a second each robot that cares looks for the player;
+# see PlayerVisibility
+VISIBILITY_HZ = 15
+
+# robots more than this many tiles beyond the edge of the screen doze,
+# and a dozing robot is updated this many times a second; see RobotLOD
+ROBOT_ACTIVE_MARGIN = 4
+DOZING_HZ = 15
+
 PLAYER_GLOW = (0, 0.4, 0.5)
 
 lighting = LightRenderer(viewport)
 
+profiler = Profiler()
+
 
 def sfx(basename):
+    if HEADLESS:
+        return headless.NullSound()
     return pyglet.resource.media(basename + '.wav', streaming=False) 
 
 bkill_sound = sfx('boss_killer')
@@ -112,7 +176,7 @@ def play_music(filename):
             )
 
 
-if not os.path.exists(os.path.expanduser("~/my.sincerest.apologies.quiet")):
+if not (HEADLESS or os.path.exists(os.path.expanduser("~/my.sincerest.apologies.quiet"))):
     play_music('bensound-scifi.mp3')
 
 
@@ -162,14 +226,26 @@ class RobotSprite:
     ROWS = COLS = 8
     FILENAMES = 'obj_s'
 
-    batch = pyglet.graphics.Batch()
+    batch = Batch()
 
     flips = {}
 
     @classmethod
     def load(cls):
-        cls.diffuse_tex = pyglet.resource.texture(f'{cls.FILENAMES}_diffuse.png')
-        cls.emit_tex = pyglet.resource.texture(f'{cls.FILENAMES}_emit.png')
+        if HEADLESS:
+            image = load_image(f'{cls.FILENAMES}_diffuse.png')
+            cell = headless.NullImage(image.width // cls.COLS, image.height // cls.ROWS)
+            cls.sprites = {
+                (x, y): cell
+                for x in range(cls.COLS)
+                for y in range(cls.ROWS)
+            }
+            return
+
+        # these need textures of their own: draw_emit() swaps
+        # one for the other under the sprites' feet
+        cls.diffuse_tex = load_texture(f'{cls.FILENAMES}_diffuse.png')
+        cls.emit_tex = load_texture(f'{cls.FILENAMES}_emit.png')
         cls.flip_tex = pyglet.image.Texture(
             cls.diffuse_tex.width,
             cls.diffuse_tex.height,
@@ -210,7 +286,7 @@ class RobotSprite:
             group.blend_dest = gl.GL_ONE_MINUS_SRC_ALPHA
 
     def __init__(self, position, sprite_position, angle=0):
-        self.sprite = pyglet.sprite.Sprite(
+        self.sprite = Sprite(
             self.sprites[tuple(sprite_position)],
             batch=self.batch
         )
@@ -374,23 +450,29 @@ class Fab(BigRobotSprite):
         level.space.add(shape)
         level.space.add(self.body)
         level.start_position = level.world_to_map(position + Vec2d(0, -64))
+        spawn_player()
 
-        global hud
-        global player
-        global reticle
 
-        assert hud is None
-        assert player is None
-        assert reticle is None
+def spawn_player():
+    """Create the player, reticle and HUD at level.start_position."""
+    global hud
+    global player
+    global reticle
+
+    assert hud is None
+    assert player is None
+    assert reticle is None
 
-        reticle = Reticle()
+    reticle = Reticle()
 
-        player = Player()
-        player.on_player_moved()
-        hud = HUD(viewport, player)
-        for bit in range(4):
-            visible = game.powerups_available & (1 << bit)
-            hud.set_weapon_visible(bit, visible)
+    player = Player()
+    player.on_player_moved()
+    hud = HUD(viewport, player)
+    for bit in range(4):
+        visible = game.powerups_available & (1 << bit)
+        hud.set_weapon_visible(bit, visible)
+    if profiler.enabled:
+        hud.show_profile(profiler)
 
 
 @tilemap_object
@@ -479,6 +561,7 @@ class Destroyable(WideSprite):
         level.objects.remove(self)
         del shape_to_robot[self.shape]
         level.space.remove(self.body, self.shape)
+        flow_field.clear()
         super().delete()
 
 
@@ -513,7 +596,7 @@ class Fans(Destroyable):
     SPRITE = 0, 2
 
 def label(text, font_size, y_ratio):
-    return pyglet.text.Label(text,
+    return Label(text,
         font_name='Checkbook',
         font_size=font_size,
         x=window.width//2, y=window.height * y_ratio,
@@ -540,10 +623,10 @@ class Game:
     press_escape_to_exit_label = label('press escape to exit', 24, 0.2)
     press_escape_to_really_exit_label = label('press escape to really exit', 24, 0.2)
 
-    img = pyglet.resource.image('logo.png')
+    img = load_image('logo.png')
     img.anchor_x = img.width // 2
     img.anchor_y = img.height // 2
-    logo = pyglet.sprite.Sprite(img)
+    logo = Sprite(img)
     logo.x = window.width // 2
     logo.y = window.height // 2
 
@@ -609,6 +692,7 @@ class Game:
         global level
         level = Level(f"new_game")
         level.start()
+        preloader.preload("level1")
 
     def transition_to(self, state):
         # print(f"transitioning from {self.state} to {state}")
@@ -634,11 +718,15 @@ class Game:
         if self.state == GameState.LOAD_LEVEL:
             level.close()
             self.level_counter += 1
-            level = Level(f"level{self.level_counter}")
+            level = preloader.take(f"level{self.level_counter}")
             self.is_final_level = not os.path.isfile(f"maps/level{self.level_counter + 1}.tmx")
             level.start()
             auto_transition_to = GameState.PRESHOW
 
+        if self.state in (GameState.PRESHOW, GameState.LEVEL_COMPLETE):
+            # get a head start on the level after this one
+            preloader.preload(f"level{self.level_counter + 1}")
+
         if self.state == GameState.PRESHOW:
             try:
                 with open(f"maps/level{self.level_counter}.txt", "rt") as f:
@@ -738,30 +826,17 @@ class Game:
 
 
 def read_powerups_from_map(tmx_path):
-    # print("reading powerups from map", tmx_path)
-    tiles = tmx.TileMap.load(tmx_path)
-    types = {}
-    powerups = 0
-    for tileset in tiles.tilesets:
-        for tile in tileset.tiles:
-            props = {p.name: p.value for p in tile.properties}
-            cls = props.get('cls')
-            if cls:
-                gid = tileset.firstgid + tile.id
-                types[gid] = cls
-
-    for obj in tiles.layers[1].objects:
-        cls = types.get(obj.gid, 0)
-        if cls:
-            if cls.startswith("Powerup"):
-                bit = int(cls[len("Powerup"):])
-                powerups |= 1 << bit
-    # print("powerup bits found", powerups)
-    return powerups
+    # the level cache worked out the powerup bits when it compiled the map
+    return levelcache.load(tmx_path).powerups
 
 
 class Level:
     start_position = Vec2d(10, 10)
+    maprenderer = None
+    prepared = False
+    # bool array [y, x] of the tiles the player can reach,
+    # set by paint_unreachable_with_instadeath()
+    reachable = None
 
     def __init__(self, basename):
         self.basename = basename
@@ -774,34 +849,61 @@ class Level:
         hud = player = reticle = None
 
         robots.clear()
+        visibility.clear()
+        robot_lod.clear()
+        flow_field.clear()
+        # close the last level's bullets properly, so none of them
+        # has anything (like a railgun's timer) left to do in this one
+        for bullet in tuple(bullets):
+            bullet.close()
         bullets.clear()
         collectables.clear()
         viewport.angle = 0
 
+        self.prepare()
         self.load(self.basename)
 
-        self.collision_tiles = self.tiles.layers[0].tiles
+        self.bullet_batch = Batch()
+        self.foreground_sprite_group = pyglet.graphics.OrderedGroup(1)
+
+        self.objects = set()
+        self.destroyables = 0
+        self.spawn_map_objects()
+        reset_bullet_pools()
+
+        self.paint_unreachable_with_instadeath()
+
+
+    def prepare(self):
+        """
+        Load the compiled map and build the static collision geometry.
+
+        This doesn't touch GL, the lighting or any of the globals,
+        so LevelPreloader can run it on a worker thread.  start()
+        calls it too, in case nobody preloaded us.
+        """
+        if self.prepared:
+            return
+
+        tmx_path = f'maps/{self.basename}.tmx'
+        if not os.path.isfile(tmx_path):
+            sys.exit(f"Couldn't find tmx for basename {self.basename}!")
+        self.tiles = levelcache.load(tmx_path)
+
+        self.collision_tiles = self.tiles.collision
+        self.walls = self.tiles.walls
         self.upper_left = Vec2d(vector_zero)
         self.lower_right = Vec2d(
             self.tiles.width,
             self.tiles.height
             )
 
-        self.bullet_batch = pyglet.graphics.Batch()
-        self.foreground_sprite_group = pyglet.graphics.OrderedGroup(1)
-
         self.space = pymunk.Space()
         self.draw_options = pymunk.pyglet_util.DrawOptions()
         self.space.gravity = (0.0, 0.0)
 
         self.construct_collision_geometry()
-
-        self.objects = set()
-        self.destroyables = 0
-        self.spawn_map_objects()
-
-        self.paint_unreachable_with_instadeath()
-
+        self.prepared = True
 
     def close(self):
         global hud
@@ -816,6 +918,8 @@ class Level:
             hud.close()
         if lighting:
             lighting.clear_lights()
+        if self.maprenderer:
+            self.maprenderer.delete()
 
         hud = player = reticle = None
 
@@ -835,29 +939,16 @@ class Level:
                 game.transition_to(GameState.LEVEL_COMPLETE)
 
     def spawn_map_objects(self):
-        tilesets = [t for t in self.tiles.tilesets if 'object' in t.name.lower()]
-        types = {}
-        for tileset in tilesets:
-            for tile in tileset.tiles:
-                gid = tileset.firstgid + tile.id
-                props = {p.name: p.value for p in tile.properties}
-                if props.get('cls'):
-                    types[gid] = tilemap_object_map[props['cls']]
-
-        for obj in self.tiles.layers[1].objects:
-            cls = types[obj.gid]
+        # the level cache has already worked out each object's
+        # class name, centre and rotation
+        for obj in self.tiles.objects:
+            cls = tilemap_object_map[obj.cls]
 
             if issubclass(cls, Destroyable):
                 self.destroyables += 1
 
-            opos = Vec2d(obj.x, self.tiles.height * self.tilew - obj.y)
-            off = Vec2d(obj.width / 2, obj.height / 2)
-
-            angle = math.radians(obj.rotation)
-            center = opos + off.rotated(-angle)
-
             self.objects.add(
-                cls(center, angle=-angle)
+                cls(Vec2d(obj.x, obj.y), angle=obj.rotation)
             )
 
     def destroy_one(self):
@@ -867,18 +958,10 @@ class Level:
                 Boss.instance.start()
 
     def load(self, basename):
-        # we should always save the tmx file
-        # then export the json file
-        # this function will detect that that's true
-        tmx_path = f'maps/{basename}.tmx'
-        try:
-            tmx_stat = os.stat(tmx_path)
-        except FileNotFoundError:
-            sys.exit(f"Couldn't find tmx for basename {basename}!")
-
+        # the main-thread half of loading: prepare() has already
+        # read the map, so this just uploads it and sets up the lights
         lighting.clear()
-        self.tiles = tmx.TileMap.load(tmx_path)
-        self.maprenderer = MapRenderer(self.tiles)
+        self.maprenderer = MapRenderer(self.tiles, graphics=not HEADLESS)
         lighting.shadow_casters = self.maprenderer.shadow_casters
         for lt in self.maprenderer.light_objects:
             lighting.add_light(lt)
@@ -886,10 +969,8 @@ class Level:
         self.tilew = self.maprenderer.tilew
         lighting.tilew = self.tilew  # ugh, sorry
 
-        props = {p.name: p.value for p in self.tiles.properties}
-        if 'ambient' in props:
-            a = props['ambient']
-            lighting.ambient = (a.red / 255, a.green / 255, a.blue / 255)
+        if self.tiles.ambient:
+            lighting.ambient = self.tiles.ambient
 
     def map_to_world(self, x, y=None):
         if y is None:
@@ -924,161 +1005,10 @@ class Level:
         Construct PyMunk collision geometry by studying tileset map.
         """
 
-        # pass 1: RLE encode horizontal runs of tiles into rectangles
-        in_rect = False
-        startx = None
-        x_rects = set()
-
-        def finish_rect():
-            nonlocal x
-            nonlocal y
-            nonlocal startx
-            nonlocal in_rect
-            in_rect = False
-            rect = ((startx, y), (x, y + 1))
-            x_rects.add(rect)
-
-        for y in range(0, self.tiles.height):
-            y = self.tiles.height - y - 1
-            for x in range(0, self.tiles.width):
-                tile = self.collision_tile_at(x, y)
-                if tile:
-                    if not in_rect:
-                        in_rect = True
-                        startx = x
-                elif in_rect:
-                    finish_rect()
-            if in_rect:
-                x += 1
-                finish_rect()
-
-        # sort fns for sorting lists of rects
-        sort_by_y = lambda box: (box[0][1], box[0][0])
-        # we usually sort lowest y coord to the end,
-        # this lets us pop efficiently when processing
-        # from lowest to highest x
-        sort_by_reverse_y = lambda box: (-box[0][1], box[0][0])
-
-        # pass 2: merge rectangles down where possible.
-        # (if there are two rectangles adjacent in y
-        #  and having identical left and right x edges,
-        #  merge them into one big rectangle.)
-        xy_rects = []
-        sorted_x_rects = list(sorted(x_rects, key=sort_by_reverse_y))
-        while sorted_x_rects:
-            rect = sorted_x_rects.pop()
-            if rect not in x_rects:
-                continue
-            start, end = rect
-            start_x, start_y = start
-            end_x, end_y = end
-            new_start_y = start_y
-            new_end_y = end_y
-            while True:
-                new_start_y += 1
-                new_end_y += 1
-                nextrect = ((start_x, new_start_y), (end_x, new_end_y))
-                if nextrect not in x_rects:
-                    break
-                x_rects.remove(nextrect)
-                end_y = new_end_y
-            xy_rects.append(((start_x, start_y), (end_x, end_y)))
-
-        # pass 3:
-        # find all rects who touch each other in y,
-        # constructing a dict of r -> set(rects_touching_r)
-        # where r is a rect and all the members of the set are also rects.
-        #
-        # note: we don't have to check if rects are touching on our left or right.
-        # if a rect r2 was touching r on the left or the right,
-        # then during pass 1 we wouldn't have generated two rects!
-        touching = {}
-        topdown_rects = list(xy_rects)
-        topdown_rects.sort(key=sort_by_reverse_y)
-        def r_as_tiles(r):
-            return ( (r[0][0]//16, r[0][1]//16), (r[1][0]//16, r[1][1]//16))
-        def r_as_tiles_str(r):
-            r = r_as_tiles(r)
-            return f"(({r[0][0]:2}, {r[0][1]:2}), ({r[1][0]:2}, {r[1][1]:2}))"
-        def r_touches(r, r2):
-            s = touching.get(r)
-            if not s:
-                s = set()
-                touching[r] = s
-            s.add(r2)
-            # print(f"{r_as_tiles_str(r)} TOUCHES {r_as_tiles_str(r2)}")
-        while topdown_rects:
-            r = topdown_rects.pop()
-            (x, y), (end_x, end_y) = r
-            skip_y = y
-            check_y = end_y
-            for r2 in reversed(topdown_rects):
-                (x2, y2), (end_x2, end_y2) = r2
-                if y2 < check_y:
-                    # on same y coordinate as us, skip
-                    continue
-                if y2 != check_y:
-                    # too far away in y, all subsequent rects will also be too far away, stop
-                    break
-
-                # r2.topleft.y is the same as r.bottomright.y.
-                # so if the two rects overlap in x, they're touching.
-                # how do we determine that?  easy!
-                #
-                # there are six possible scenarios:
-                #
-                # 1. rrrr        no overlap, r < r2
-                #         r2r2
-                #
-                # 2. rrrr           overlap, on the left side of r2
-                #      r2r2
-                #
-                # 3. rrrrrrrr       overlap, r2 is inside r
-                #      r2r2
-                #
-                # 4.   rrrr         overlap, r is inside r2
-                #    r2r2r2r2
-                #
-                # 5.   rrrr         overlap, on the right side of r2
-                #    r2r2
-                #
-                # 6.      rrrr   no overlap, r > r2
-                #    r2r2
-                #
-                # so we just check for 1 and 6.
-                # if either is true, we don't overlap.
-                # otherwise we do.
-                if not ((end_x <= x2) or (end_x2 <= x)):
-                    r_touches(r, r2)
-                    r_touches(r2, r)
-
-        # pass 4:
-        # construct "blobs" of touching rects.
-        #
-        # pull out a rect and put it in a set.
-        # then pull out all rects that touch it and put them in the set too,
-        # and all rects that touch *that*, ad infinitum.
-        # keep iterating until we don't find any new rects.
-        # that's a blob.  repeat until no rects left.
-        final_rects = set(xy_rects)
-        blobs = []
-        while final_rects:
-            r = final_rects.pop()
-            # print(f"blob, starting with {r_as_tiles_str(r)}")
-            blob = set([r])
-            check = set([r])
-            while check:
-                check_next = set()
-                for r in check:
-                    neighbors = touching.get(r, ())
-                    for r2 in neighbors:
-                        if r2 not in blob:
-                            # print(f"  {r_as_tiles_str(r)} touches {r_as_tiles_str(r2)}")
-                            blob.add(r2)
-                            final_rects.remove(r2)
-                            check_next.add(r2)
-                check = check_next
-            blobs.append(blob)
+        # passes 1-4 (run length encode the walls into rectangles,
+        # merge them, and group touching rectangles into "blobs") were
+        # done when the level was compiled; see collision.wall_blobs()
+        blobs = self.tiles.blobs
 
         # pass 5:
         # pass 4 produced "blobs", which are sets of boxes
@@ -1129,7 +1059,8 @@ class Level:
             # in the map that tiled shows you on its status bar
             a = []
             print(prefix + "{")
-            for rect in sorted(blob, key=sort_by_reverse_y):
+            # top to bottom, then left to right
+            for rect in sorted(blob, key=lambda box: (-box[0][1], box[0][0])):
                 (x1, y1), (x2, y2) = rect
                 y1 = (self.tiles.height + 0) - (y1 + 0)
                 y2 = (self.tiles.height + 0) - (y2 + 0)
@@ -1143,6 +1074,8 @@ class Level:
         # and that kills bouncy shots.
         # with a higher hz and slower shots we're
         # not having warping problems.
+        # (and Bullet.sweep() stops fast bullets
+        # warping through walls at any hz.)
         if 0:
             blob_lists = []
             for blob in blobs:
@@ -1162,8 +1095,8 @@ class Level:
                         y_above = rect[0][1] - 1
                         y_below = rect[1][1]
                         for x in iterator:
-                            tile_above = self.collision_tile_at(x, y_above)
-                            tile_below = self.collision_tile_at(x, y_below)
+                            tile_above = self.walls.is_wall(x, y_above)
+                            tile_below = self.walls.is_wall(x, y_below)
                             if (tile_above and tile_below
                                 and not (spackled_above or spackled_below)):
                                 # the "1x3" tile
@@ -1341,77 +1274,42 @@ class Level:
         # now:
         # find all unreachable areas *inside* the map
         # and fill them in with instadeath
-        occupiable = set()
-        for y in range(0, self.tiles.height):
-            y = self.tiles.height - y - 1
-            for x in range(0, self.tiles.width):
-                tile = self.collision_tile_at(x, y)
-                if not tile:
-                    occupiable.add((x, y))
-
-        reachable = set()
-        floodfill = set(((
+
+        # usually the level cache already knows what's
+        # reachable from where the player starts.
+        # AI and spawn code can use this mask too.
+        self.reachable = self.tiles.reachable_mask((
             int(player.position.x),
             int(player.position.y),
-            ),))
-
-        directions = [
-            (+0, +1), # up
-            (+0, -1), # down
-            (-1, +0), # left
-            (+1, +0), # right
-            ]
-
-        i = 0
-        while floodfill:
-            i += 1
-            # print("starting floodfill", i, sorted(floodfill))
-            floodfill2 = set()
-            test_set = set(reachable)
-            test_set.update(floodfill)
-            for p in floodfill:
-                for direction in directions:
-                    test = (p[0] + direction[0], + p[1] + direction[1])
-                    if not self.collision_tile_at(test[0], test[1]):
-                        if test not in test_set:
-                            floodfill2.add(test)
-            reachable.update(floodfill)
-            floodfill = floodfill2
-
-        # unreachable is the set of all coordinates
-        # that don't have a collidable block on them
-        # but can't be reached from the starting position.
+            ))
+
+        # unreachable is all the tiles that don't have
+        # a collidable block on them but can't be reached
+        # from the starting position.
         #
         # we now create instadeath walls for all those
-        # tiles.  we do a quick RLE by sorting the
-        # coordinates and glomming together by runs of x.
-        unreachable = list(reversed(sorted(occupiable - reachable)))
-        # print("unreachable?", sorted(unreachable))
-        start = end = None
-        def finish():
-            nonlocal start
-            nonlocal end
-            if start and end:
-                rect = ( Vec2d(start), Vec2d(end[0] + 1, end[1] + 1) )
-                self.add_box_from_bb(rect, CollisionType.INSTADEATH)
-                start = end = None
-
-        while unreachable:
-            if not start:
-                start = end = unreachable.pop()
-                continue
-            candidate = unreachable[-1]
-            if ((candidate[0] == (end[0] + 1))
-                and (candidate[1] == end[1])):
-                unreachable.pop()
-                end = candidate
-                continue
-            finish()
-        finish()
+        # tiles, merged into as few rectangles as we can.
+        # (like the wall blobs, these are polys on one static
+        # body, which puts them exactly on the tiles.)
+        open_tiles = self.walls.array[1:-1, 1:-1] == 0
+        unreachable = open_tiles & ~self.reachable
+        body = pymunk.Body(body_type=pymunk.Body.STATIC)
+        self.space.add(body)
+        for (x, y), (end_x, end_y) in collision.rectangles(unreachable):
+            vertices = [
+                (    x,     y),
+                (end_x,     y),
+                (end_x, end_y),
+                (    x, end_y),
+                ]
+            shape = pymunk.Poly(body, vertices)
+            shape.collision_type = CollisionType.INSTADEATH
+            shape.elasticity = 1.0
+            self.space.add(shape)
 
 
     def on_draw(self):
-        self.maprenderer.render()
+        self.maprenderer.render(viewport)
 
     def position_to_tile_index(self, x, y=None):
         if y is None:
@@ -1433,15 +1331,71 @@ class Level:
         return Vec2d(x, y)
 
     def collision_tile_at(self, x, y=None):
-        # for collision tiles outside the level, just return -1
-        if not ((0 <= x < self.tiles.width) and (0 <= y < self.tiles.height)):
-            return -1
-        gid = self.collision_tiles[self.position_to_tile_index(x, y)].gid
-        return gid in self.collision_gids
+        # tiles outside the level count as walls.
+        # (new code should ask self.walls directly.)
+        if y is None:
+            x, y = x
+        return self.walls.is_wall(x, y)
+
+
+class LevelPreloader:
+    """
+    Prepares upcoming levels on a worker thread.
+
+    We always know which level comes next, so while the player
+    reads the preshow text (or plays, or looks at "Level Complete")
+    we parse its map and build its collision geometry in the
+    background.  LOAD_LEVEL then only has the main-thread work left:
+    the GL upload, the lights and spawning the objects.
+    """
+    def __init__(self):
+        self.executor = None
+        # basename -> Future returning a prepared Level
+        self.pending = {}
+
+    def preload(self, basename):
+        if basename in self.pending:
+            return
+        if not os.path.isfile(f"maps/{basename}.tmx"):
+            return
+        if not self.executor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='preload')
+        self.pending[basename] = self.executor.submit(self._prepare, basename)
+
+    @staticmethod
+    def _prepare(basename):
+        level = Level(basename)
+        level.prepare()
+        return level
+
+    def take(self, basename):
+        """
+        Return a new Level for basename, prepared if we preloaded it.
+
+        If the worker hasn't finished yet we wait for it, which is
+        still quicker than starting over.  If it failed, the Level
+        comes back unprepared and start() tries again (and reports
+        the error) on the main thread.
+        """
+        future = self.pending.pop(basename, None)
+        if future:
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"preloading {basename} failed: {e!r}")
+        return Level(basename)
 
 
+preloader = LevelPreloader()
 
-bullets = set()
+
+# the bullets in flight, as the keys of a dict rather than a set, so
+# they're updated in the order they were fired, not in an order that
+# depends on where they happen to be in memory; that would hand out
+# the random numbers differently in every build, and replays wouldn't
+# match (see replay.py)
+bullets = {}
 shape_to_bullet = {}
 
 
@@ -1459,27 +1413,152 @@ class BulletShape(IntEnum):
 PLAYER_BASE_DAMAGE = 100
 
 
+# the bullet pools hold enough bullets for everybody to keep
+# firing for this many seconds without any of them landing
+BULLET_POOL_SECONDS = 3
+# ...with up to this many ordinary robots shooting at once
+BULLET_POOL_ROBOTS = 32
+
+# parked bullets don't collide with anything,
+# and sit in a row off the bottom left of the map
+PARKED_FILTER = pymunk.ShapeFilter(categories=0, mask=0)
+PARKING_LOT = Vec2d(-10000, -10000)
+
+
+class BulletPool:
+    """
+    A fixed number of bullets of one class, made once per level.
+
+    Bullets are never removed from the space.  When one is closed
+    it stops colliding straight away, and at the end of the tick
+    (once pymunk is done with it) it's parked: moved out of the way
+    and turned into a static body, so pymunk doesn't simulate it
+    until it's fired again.  (Sleeping would be the obvious way, but
+    pymunk can crash freeing a space with sleeping bodies in it.)
+
+    If every bullet is in flight, the oldest one is recycled,
+    so the pool (and shape_to_bullet) never grows past its size.
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.size = 0
+        self.created = 0
+        # parked bullets, ready to fire
+        self.free = []
+        # bullets closed during this tick, parked at the end of it
+        self.finishing = []
+        # bullets in flight, oldest first (dicts keep their order)
+        self.live = {}
+        # fired from the pool / had to make (or recycle) a bullet
+        self.hits = self.misses = 0
+        # how many of the misses recycled a bullet in flight
+        self.recycled = 0
+
+    def fire_rate(self):
+        """Return how many bullets of our class a second we might need."""
+        hz = COOLDOWN_HZ
+        def rate(weapon, cooldown_range):
+            return weapon.count * hz / (cooldown_range[0] * weapon.cooldown_multiplier)
+
+        # the player only has one weapon at a time
+        rates = [rate(w, Player.cooldown_range) for w in weapon_matrix if w.cls is self.cls]
+        total = max(rates, default=0)
+        if Robot.weapon.cls is self.cls:
+            total += BULLET_POOL_ROBOTS * rate(Robot.weapon, Robot.cooldown_range)
+        for boss in Boss.__subclasses__():
+            if boss.weapon.cls is self.cls:
+                total += rate(boss.weapon, boss.cooldown_range)
+        return total
+
+    def reset(self, prewarm=True):
+        """Throw away the last level's bullets and make new ones."""
+        self.free.clear()
+        self.finishing.clear()
+        self.live.clear()
+        self.created = 0
+        self.size = max(1, math.ceil(self.fire_rate() * BULLET_POOL_SECONDS))
+        if prewarm:
+            for i in range(self.size):
+                self.free.append(self.create())
+
+    def create(self):
+        b = self.cls()
+        b.serial = self.created
+        self.created += 1
+        for body, shape in b.parts:
+            shape_to_bullet[shape] = b
+            level.space.add(body, shape)
+        b.park()
+        return b
+
+    def acquire(self):
+        if self.free:
+            self.hits += 1
+            b = self.free.pop()
+        else:
+            self.misses += 1
+            if self.created < self.size:
+                b = self.create()
+            else:
+                self.recycled += 1
+                b = next(iter(self.live))
+                b.close()
+                self.finishing.remove(b)
+                # park it now, as end_tick() won't; a Bullet only
+                # unparks the one of its bodies that the next shot uses.
+                # (Nothing fires during a physics step, so we can.)
+                b.park()
+        self.live[b] = None
+        return b
+
+    def release(self, b):
+        del self.live[b]
+        self.finishing.append(b)
+
+    def end_tick(self):
+        for b in self.finishing:
+            b.park()
+        self.free.extend(self.finishing)
+        self.finishing.clear()
+
+    def report(self):
+        return (
+            f"{self.cls.__name__}: {len(self.live)}/{self.size} in flight, "
+            f"{self.hits} hits, {self.misses} misses ({self.recycled} recycled)"
+        )
+
+
 BulletClasses = []
 def add_to_bullet_classes(cls):
     BulletClasses.append(cls)
+    cls.pool = BulletPool(cls)
     return cls
 
+
+def reset_bullet_pools():
+    """Make a fresh set of bullets for a new level (and a new space)."""
+    shape_to_bullet.clear()
+    for cls in BulletClasses:
+        # making a bullet needs the player's size;
+        # without a player we make them as we need them
+        cls.pool.reset(prewarm=bool(player))
+    bullet_swarm.reset(Bullet.pool.size)
+
 class BulletBase:
     offset = Vec2d(0.0, 0.0)
     light_radius = 200
 
-    # in subclasses, this is a list of bullets that died during this tick.
-    # we don't stick them immediately into the freelist,
-    # because they might still be churning around inside pymunk.
-    # so we add them to the end of freelist at the end of the tick.
-    finishing_tick = None
-    # and naturally this is a freelist of (subclass) objects.
-    freelist = None
+    # each subclass gets a BulletPool from add_to_bullet_classes
+    pool = None
 
     def __init__(self):
         # self._log = collections.deque(maxlen=50)
         self._log = []
         self._closed = True
+        # (body, shape) for every body this bullet owns;
+        # they stay in the space, parked when we're not flying
+        self.parts = []
+        self.serial = 0
 
     def log(self, *p):
         a = ['[' + clever_time() + ']']
@@ -1494,14 +1573,11 @@ class BulletBase:
 
     @classmethod
     def fire(cls, shooter, vector, modifier):
-        if cls.freelist:
-            b = cls.freelist.pop()
-        else:
-            b = cls()
+        b = cls.pool.acquire()
         assert b._closed
         b._closed = False
         b.log("[1] add to bullets")
-        bullets.add(b)
+        bullets[b] = None
         if modifier.count == 3:
             rotated_ccw = vector.rotated(math.pi / 12) # 15 degrees
             rotated_cw = vector.rotated(-math.pi / 12) # -15 degrees
@@ -1532,8 +1608,27 @@ class BulletBase:
             return
         self._closed = True
         # self.log("[3] remove from bullets")
-        bullets.discard(self)
-        self.__class__.finishing_tick.append(self)
+        bullets.pop(self, None)
+        self.pool.release(self)
+
+    def park(self):
+        """Stop our bodies colliding and move them out of the way as static bodies."""
+        position = PARKING_LOT - Vec2d(self.serial * 4, 0)
+        for body, shape in self.parts:
+            shape.filter = PARKED_FILTER
+            if body.body_type == pymunk.Body.STATIC:
+                continue
+            body.body_type = pymunk.Body.STATIC
+            body.position = position
+            level.space.reindex_shapes_for_body(body)
+
+    @staticmethod
+    def unpark(body):
+        # pymunk works out the mass of a body that becomes dynamic
+        # from its shapes, which have no density, so set it again
+        body.body_type = pymunk.Body.DYNAMIC
+        body.mass = 1
+        body.moment = pymunk.inf
 
     def on_collision_wall(self, shape):
         self.spent = True
@@ -1571,7 +1666,7 @@ def anchor_image_to_center(image):
     return image
 
 def load_centered_image(filename):
-    image = pyglet.resource.image(filename)
+    image = load_image(filename)
     anchor_image_to_center(image)
     return image
 
@@ -1581,10 +1676,208 @@ tiny_bullet_image = load_centered_image("tiny_bullet.png")
 red_bullet_image = load_centered_image("red_bullet.png")
 tiny_red_bullet_image = load_centered_image("tiny_red_bullet.png")
 
+
+class BulletSwarm:
+    """
+    Updates all the plain Bullets in flight at once, with NumPy.
+
+    pymunk still moves the bullets and calls their collision
+    callbacks.  Once a tick we copy the position and velocity of
+    every body into an array, and work out the bullets' energy and
+    which of them have died with a handful of array operations.
+    Once a frame, update_vertices() writes the sprite quads for the
+    lot, rather than moving a Sprite per bullet, and the lighting
+    asks us for the lights of the bullets near the viewport, which
+    are the only ones we bother to bring up to date.
+
+    Everything we know about a bullet is a row of one array, and the
+    rows of the bullets in flight are packed at the top of it: when
+    a bullet leaves, the last row moves into its place.  We read the
+    bodies through pymunk's cffi functions, which is about twice as
+    quick as making a Vec2d for every position and velocity; pymunk
+    has no way to read them all at once.  Subclasses
+    of Bullet do their own thing in on_update, so they aren't part
+    of the swarm.
+    """
+    # the columns of a row
+    POSITION = slice(0, 2)
+    VELOCITY = slice(2, 4)
+    MOTION = slice(0, 4)
+    ENERGY = 4
+    INITIAL_SPEED = 5
+    LIGHT_COLOR = slice(6, 9)
+    LIGHT_RADIUS = 9
+    # anchor_x, anchor_y, width, height of the image
+    EXTENT = slice(10, 14)
+    TEX_COORDS = slice(14, 26)
+    TEXTURE_INDEX = 26
+    # where the bullet was the tick before
+    PREVIOUS_POSITION = slice(27, 29)
+    COLUMNS = 29
+
+    def __init__(self):
+        # set this to False to update bullets one at a time
+        self.enabled = True
+        # how far we're drawing from the last tick to the latest one
+        self.alpha = 1.0
+        self.vertex_lists = []
+        self.reset(0)
+        lighting.add_light_source(self)
+
+    def reset(self, capacity):
+        """Forget every bullet and make room for capacity of them."""
+        for vl in self.vertex_lists:
+            vl.delete()
+        self.capacity = capacity
+        self.count = 0
+        self.bullets = []
+        # the cffi handle of each bullet's body, to read it quickly
+        self.bodies = []
+        self.rows = np.zeros((capacity, self.COLUMNS))
+        # one vertex list (of capacity quads) per texture,
+        # made as we need them; texture_ids maps texture id to index
+        self.vertex_lists = []
+        self.texture_ids = {}
+
+    def takes(self, bullet):
+        return self.enabled and type(bullet) is Bullet and self.count < self.capacity
+
+    def add(self, bullet):
+        row = self.rows[self.count]
+        bullet.slot = self.count
+        self.bullets.append(bullet)
+        self.bodies.append(bullet.body._body)
+        self.count += 1
+
+        image = bullet.image
+        row[self.MOTION] = (*bullet.position, *bullet.velocity)
+        row[self.PREVIOUS_POSITION] = bullet.position
+        row[self.ENERGY] = bullet.energy
+        row[self.INITIAL_SPEED] = bullet.initial_speed
+        row[self.LIGHT_COLOR] = bullet.light_color
+        row[self.LIGHT_RADIUS] = bullet.light_radius
+        row[self.EXTENT] = (image.anchor_x, image.anchor_y, image.width, image.height)
+        if not HEADLESS:
+            row[self.TEX_COORDS] = image.tex_coords
+            row[self.TEXTURE_INDEX] = self.vertex_list_for(image)
+
+    def remove(self, bullet):
+        slot = bullet.slot
+        bullet.slot = None
+        last = self.count - 1
+        moved = self.bullets.pop()
+        body = self.bodies.pop()
+        if moved is not bullet:
+            self.bullets[slot] = moved
+            self.bodies[slot] = body
+            moved.slot = slot
+            self.rows[slot] = self.rows[last]
+        self.count = last
+
+    def vertex_list_for(self, image):
+        texture = image.get_texture()
+        index = self.texture_ids.get(texture.id)
+        if index is None:
+            index = self.texture_ids[texture.id] = len(self.vertex_lists)
+            group = SpriteGroup(
+                texture, gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA,
+                level.foreground_sprite_group
+            )
+            count = self.capacity * 4
+            self.vertex_lists.append(level.bullet_batch.add(
+                count, gl.GL_QUADS, group,
+                ('v2f/stream', (0,) * count * 2),
+                ('c4B/static', (255,) * count * 4),
+                ('t3f/stream', (0,) * count * 3),
+            ))
+        return index
+
+    def update(self, dt):
+        n = self.count
+        if not n:
+            return
+
+        data = []
+        position = pymunk.cp.cpBodyGetPosition
+        velocity = pymunk.cp.cpBodyGetVelocity
+        for body in self.bodies:
+            p = position(body)
+            v = velocity(body)
+            data += (p.x, p.y, v.x, v.y)
+        rows = self.rows[:n]
+        rows[:, self.PREVIOUS_POSITION] = rows[:, self.POSITION]
+        rows[:, self.MOTION] = np.reshape(data, (n, 4))
+
+        energy = rows[:, self.ENERGY]
+        speed = np.hypot(*rows[:, self.VELOCITY].T)
+        energy -= np.maximum(rows[:, self.INITIAL_SPEED] - speed, 0) * (0.1 * dt)
+
+        dead = np.flatnonzero(energy < 0)
+        if len(dead):
+            for bullet in [self.bullets[i] for i in dead.tolist()]:
+                bullet.close()
+
+    def visible_lights(self, x, y, radius):
+        """Yield the lights of the bullets that could light up the viewport."""
+        n = self.count
+        if not n:
+            return
+        rows = self.rows[:n]
+        positions = self.positions(rows)
+        px, py = (positions * level.tilew).T
+        near = np.flatnonzero(
+            np.hypot(px - x, py - y) < rows[:, self.LIGHT_RADIUS] + radius
+        )
+        rows = rows[near]
+        colors = rows[:, self.LIGHT_COLOR] * rows[:, self.ENERGY, np.newaxis]
+        for i, position, color in zip(
+                near.tolist(),
+                positions[near].tolist(),
+                colors.tolist()):
+            light = self.bullets[i].light
+            light.position = tuple(position)
+            light.color = tuple(color)
+            yield light
+
+    def positions(self, rows):
+        """Return where to draw the bullets in rows, between the last two ticks."""
+        previous = rows[:, self.PREVIOUS_POSITION]
+        return previous + (rows[:, self.POSITION] - previous) * self.alpha
+
+    def update_vertices(self):
+        """Write the sprite quads of every bullet, as a pyglet Sprite would."""
+        if not self.vertex_lists:
+            return
+        rows = self.rows
+        scale = rows[:, self.ENERGY]
+        x, y = (self.positions(rows) * level.tilew).T
+        anchor_x, anchor_y, width, height = rows[:, self.EXTENT].T
+        x1 = x - anchor_x * scale
+        y1 = y - anchor_y * scale
+        x2 = x1 + width * scale
+        y2 = y1 + height * scale
+        quads = np.stack((x1, y1, x2, y1, x2, y2, x1, y2), axis=1)
+
+        # leave out the empty rows, and anything off the screen
+        l, r, b, t = viewport.world_bounds()
+        hidden = (x2 < l) | (x1 > r) | (y2 < b) | (y1 > t)
+        hidden[self.count:] = True
+
+        texture_index = rows[:, self.TEXTURE_INDEX]
+        for index, vl in enumerate(self.vertex_lists):
+            skip = hidden | (texture_index != index)
+            np.ctypeslib.as_array(vl.vertices)[:] = np.where(
+                skip[:, np.newaxis], 0, quads).ravel()
+            np.ctypeslib.as_array(vl.tex_coords)[:] = rows[:, self.TEX_COORDS].ravel()
+
+
+bullet_swarm = BulletSwarm()
+
+
 @add_to_bullet_classes
 class Bullet(BulletBase):
-    finishing_tick = []
-    freelist = []
+    # our slot in bullet_swarm, while we're part of it
+    slot = None
 
     def __init__(self):
         super().__init__()
@@ -1598,7 +1891,7 @@ class Bullet(BulletBase):
         radius = player.radius / 3
         body = pymunk.Body(mass=1, moment=pymunk.inf, body_type=pymunk.Body.DYNAMIC)
         shape = pymunk.Circle(body, radius=radius, offset=self.offset)
-        shape_to_bullet[shape] = self
+        self.parts.append((body, shape))
 
         self.normal_bullet = (body, images, radius, shape)
 
@@ -1606,7 +1899,7 @@ class Bullet(BulletBase):
         radius = player.radius / 6
         body = pymunk.Body(mass=1, moment=pymunk.inf, body_type=pymunk.Body.DYNAMIC)
         shape = pymunk.Circle(body, radius=radius, offset=self.offset)
-        shape_to_bullet[shape] = self
+        self.parts.append((body, shape))
 
         self.small_bullet = (body, images, radius, shape)
 
@@ -1623,6 +1916,7 @@ class Bullet(BulletBase):
         bullet_offset = Vec2d(vector) * (shooter.radius + self.radius)
         self.position = Vec2d(shooter.position) + bullet_offset
 
+        self.unpark(self.body)
         self.body.position = Vec2d(self.position)
         self.body.velocity = Vec2d(self.velocity)
         level.space.reindex_shapes_for_body(self.body)
@@ -1635,8 +1929,6 @@ class Bullet(BulletBase):
         self.initial_speed = self.velocity.length
 
         self.body.velocity = self.velocity
-        # self.log("[2] add to space")
-        level.space.add(self.body, self.shape)
         self.create_visuals()
         self.on_update(0)
 
@@ -1667,8 +1959,13 @@ class Bullet(BulletBase):
 
     def create_visuals(self):
         self.light = Light(self.position, self.light_color, self.light_radius)
+        if bullet_swarm.takes(self):
+            # the swarm draws us, and our light
+            self.sprite = None
+            bullet_swarm.add(self)
+            return
         lighting.add_light(self.light)
-        self.sprite = pyglet.sprite.Sprite(
+        self.sprite = Sprite(
             self.image,
             batch=level.bullet_batch,
             group=level.foreground_sprite_group
@@ -1692,11 +1989,30 @@ class Bullet(BulletBase):
 
     def close(self):
         super().close()
-        # self.log("[4] remove from space")
-        level.space.remove(self.body, self.shape)
+        # we're probably inside a collision callback, so we can't
+        # park the body yet; just make sure it doesn't hit anything else
+        self.shape.filter = PARKED_FILTER
+        if self.slot is not None:
+            bullet_swarm.remove(self)
         self.destroy_visuals()
 
+    def draw_impact(self):
+        # self.velocity is still what we were fired with, so a bounce
+        # would point the sparks the wrong way; and the swarm doesn't
+        # keep our position up to date either.  Read them through
+        # cffi, as BulletSwarm does.
+        body = self.body._body
+        v = pymunk.cp.cpBodyGetVelocity(body)
+        self.velocity = Vec2d(v.x, v.y)
+        if self.slot is not None:
+            p = pymunk.cp.cpBodyGetPosition(body)
+            self.position = Vec2d(p.x, p.y)
+        super().draw_impact()
+
     def on_update(self, dt):
+        if self.slot is not None:
+            # bullet_swarm.update() has done this for us
+            return
         speed = self.body.velocity.length
         clamped_speed = max(self.initial_speed - speed, 0)
         self.energy -= clamped_speed * 0.1 * dt
@@ -1708,6 +2024,54 @@ class Bullet(BulletBase):
         self.position = Vec2d(self.body.position)
         self.update_visuals()
 
+    def sweep(self, dt):
+        """
+        If we'd hit a wall during the next step, make sure pymunk sees it.
+
+        pymunk only looks for collisions where bodies end up after a
+        step, so a bullet that moves further than its radius in one
+        step can skip past a corner, or right through a wall.  So we
+        sweep our circle along this step's path; if the first thing it
+        touches is a wall, we back the body up so that the step ends
+        just inside the wall, and pymunk handles the collision as usual.
+
+        A bullet that starts off touching a wall (say it was fired from
+        right up against one) meets it at alpha 0, and would slip
+        straight through its corner just the same.  So we push it out
+        of the wall first, the shortest way, and sweep from there.
+        """
+        body = self.body
+        travel = body.velocity * dt
+        if travel.get_length_sqrd() <= self.radius * self.radius:
+            return
+        for push in range(SWEEP_PUSHES + 1):
+            start = body.position
+            first = self.first_hit(start, start + travel)
+            if not first or first.shape.collision_type not in WALL_COLLISION_TYPES:
+                # anything else is big (or slow) enough for pymunk to catch
+                return
+            if first.alpha:
+                break
+            if push == SWEEP_PUSHES:
+                # wedged in a corner; leave it to pymunk
+                return
+            info = first.shape.point_query(start)
+            clearance = max(self.radius - info.distance, 0) + SWEEP_CLEARANCE
+            body.position = start + info.gradient * clearance
+
+        overshoot = min(self.radius / 2, travel.length * (1 - first.alpha))
+        body.position = start - travel * (1 - first.alpha) + travel.normalized() * overshoot
+
+    def first_hit(self, start, end):
+        """Return the first wall, robot or player our circle meets from start to end."""
+        first = None
+        for hit in level.space.segment_query(start, end, self.radius, self.shape.filter):
+            if (hit.shape.collision_type in SWEPT_COLLISION_TYPES
+                and not hit.shape.sensor
+                and (first is None or hit.alpha < first.alpha)):
+                first = hit
+        return first
+
     def on_collision_wall(self, wall_shape):
         if (wall_shape != None) and (self.last_bounced_wall == wall_shape):
             # I don't think this ever happens anymore
@@ -1722,8 +2086,6 @@ class Bullet(BulletBase):
 
 @add_to_bullet_classes
 class BossKillerBullet(Bullet):
-    finishing_tick = []
-    freelist = []
     radius = 0.7071067811865476
     light_color = (2, 2, 10.0)
     light_radius = 400
@@ -1734,7 +2096,7 @@ class BossKillerBullet(Bullet):
         self.body = pymunk.Body(mass=1, moment=pymunk.inf, body_type=pymunk.Body.DYNAMIC)
         self.shape = pymunk.Circle(self.body, radius=self.radius, offset=(0, 0))
         self.position = (0, 0)
-        shape_to_bullet[self.shape] = self
+        self.parts.append((self.body, self.shape))
 
     def _fire(self, shooter, vector, modifier):
         BulletBase._fire(self, shooter, vector, modifier)
@@ -1774,8 +2136,6 @@ class BossKillerBullet(Bullet):
 
 @add_to_bullet_classes
 class Rocket(Bullet):
-    finishing_tick = []
-    freelist = []
 
     SPRITE = (6, 1)
 
@@ -1816,8 +2176,6 @@ class Rocket(Bullet):
 
 @add_to_bullet_classes
 class RailgunBullet(BulletBase):
-    finishing_tick = []
-    freelist = []
 
     colors = [
         None,
@@ -1841,23 +2199,23 @@ class RailgunBullet(BulletBase):
             self.radius, level.player_bullet_collision_filter)
 
         # simulate collisions
-        for collision in sorted(collisions, key=operator.attrgetter('alpha')):
-            if collision.shape.body != shooter.body:
+        for info in sorted(collisions, key=operator.attrgetter('alpha')):
+            if info.shape.body != shooter.body:
                 # Apply impulse
-                collision.shape.body.apply_impulse_at_world_point(
+                info.shape.body.apply_impulse_at_world_point(
                     long_enough_vector * modifier.damage_multiplier,
-                    collision.point
+                    info.point
                 )
 
             stop = False
-            robot = shape_to_robot.get(collision.shape)
+            robot = shape_to_robot.get(info.shape)
             if robot:
                 robot.on_damage(self.damage)
                 stop = isinstance(robot, Boss)
 
-            if stop or collision.shape.collision_type == CollisionType.WALL:
-                hit = start_point + long_enough_vector * collision.alpha
-                normal = collision.normal
+            if stop or info.shape.collision_type == CollisionType.WALL:
+                hit = start_point + long_enough_vector * info.alpha
+                normal = info.normal
                 break
         else:
             return None, None
@@ -1940,6 +2298,9 @@ class RailgunBullet(BulletBase):
 
     def close(self):
         super().close()
+        # we might be closed before die() is called (at the end of a
+        # level, say), and it mustn't close us again once we're reused
+        pyglet.clock.unschedule(self.die)
         for ray in self.rays:
             ray.delete()
         self.rays.clear()
@@ -2037,6 +2398,22 @@ def on_player_hit_instadeath(arbiter, space, data):
 
 
 
+# Bullet.sweep() looks for the first of these along a bullet's path,
+# and steps in if it's one of the walls
+WALL_COLLISION_TYPES = {CollisionType.WALL, CollisionType.INSTADEATH}
+SWEPT_COLLISION_TYPES = WALL_COLLISION_TYPES | {CollisionType.ROBOT, CollisionType.PLAYER}
+# how far clear of a wall Bullet.sweep() pushes a bullet that starts
+# off touching it, and how many walls it'll push it out of in a row
+SWEEP_CLEARANCE = 1e-3
+SWEEP_PUSHES = 2
+
+def sweep_bullets(dt):
+    """Keep fast bullets from tunnelling through walls in the next step."""
+    for bullet in bullets:
+        if isinstance(bullet, Bullet):
+            bullet.sweep(dt)
+
+
 def bullet_collision(entity, arbiter):
     bullet_shape = arbiter.shapes[0]
     entity_shape = arbiter.shapes[1]
@@ -2177,14 +2554,18 @@ class Player:
     MAX_HP = 400
     INITIAL_LIVES = 5
 
+    # 120ths of a second between shots (before the weapon's
+    # cooldown_multiplier); see COOLDOWN_HZ
+    cooldown_range = (10, 12)
+
     def __init__(self):
-        self.cooldown_range = (10, 12)
         self.bullet_collision_filter = level.player_bullet_collision_filter
         self.bullet_collision_type = CollisionType.PLAYER_BULLET
         self.bullet_speed = 40
         # determine position based on first nonzero tile
         # found in player starting position layer
         self.position = level.start_position
+        self.previous_position = self.position
         self.velocity = Vec2d(vector_zero)
 
         # acceleration is a vector we add to velocity every frame
@@ -2243,6 +2624,9 @@ class Player:
         lighting.add_light(self.light)
 
     def close(self):
+        # don't come back to life in a level that has gone away
+        pyglet.clock.unschedule(self.on_respawn_timer)
+
         lighting.remove_light(self.light)
         self.light = None
 
@@ -2476,12 +2860,20 @@ class Player:
         return pyglet.event.EVENT_HANDLED
 
     def on_player_moved(self):
+        self.previous_position = self.position
         self.position = self.body.position
         sprite_coordinates = level.map_to_world(self.position)
         self.sprite.position = sprite_coordinates
         self.light.position = self.body.position
         reticle.on_player_moved()
 
+    def interpolate(self, alpha):
+        """Draw us alpha of the way from the last tick's position to this one's."""
+        position = self.previous_position.interpolate_to(self.position, alpha)
+        self.sprite.position = level.map_to_world(position)
+        self.light.position = position
+        reticle.interpolate(position)
+
     def on_update_velocity(self, body, gravity, damping, dt):
         velocity = Vec2d(self.velocity)
         body.velocity = velocity
@@ -2494,7 +2886,7 @@ class Player:
         # print(f"\n\n<<<{dt}>>>")
         self.calculate_speed()
         if self.cooldown > 0:
-            self.cooldown -= 1
+            self.cooldown -= dt * COOLDOWN_HZ
         elif self.shooting:
             modifier = self.weapon
             bullet = modifier.fire(self, reticle.offset)
@@ -2517,6 +2909,9 @@ class Player:
         if self.health <= 0:
             self.on_died()
 
+    def on_respawn_timer(self, dt):
+        self.respawn()
+
     def respawn(self):
         self.alive = True
         self.health = self.MAX_HP
@@ -2525,6 +2920,8 @@ class Player:
         hud.set_lives(self.lives)
         self.body.position = level.start_position
         self.on_player_moved()
+        # don't slide across the map from where we died
+        self.previous_position = self.position
         reticle.reset()
         self.sprite.visible = True
         reticle.sprite.visible = True
@@ -2539,7 +2936,7 @@ class Player:
         reticle.sprite.visible = False
         level.space.remove(self.body, self.shape)
         if self.lives:
-            pyglet.clock.schedule_once(lambda dt: self.respawn(), 1.5)
+            pyglet.clock.schedule_once(self.on_respawn_timer, 1.5)
         else:
             game.transition_to(GameState.GAME_OVER)
 
@@ -2550,8 +2947,8 @@ class Reticle:
     def __init__(self):
         self.red_reticle = load_centered_image("reticle.png")
         self.green_reticle = load_centered_image("green.reticle.png")
-        self.red_sprite = pyglet.sprite.Sprite(self.red_reticle, batch=level.bullet_batch, group=level.foreground_sprite_group)
-        self.green_sprite = pyglet.sprite.Sprite(self.green_reticle, batch=level.bullet_batch, group=level.foreground_sprite_group)
+        self.red_sprite = Sprite(self.red_reticle, batch=level.bullet_batch, group=level.foreground_sprite_group)
+        self.green_sprite = Sprite(self.green_reticle, batch=level.bullet_batch, group=level.foreground_sprite_group)
         self.position = Vec2d(0, 0)
         # how many pixels movement onscreen map to one revolution
         self.acceleration = 3000
@@ -2615,7 +3012,17 @@ class Reticle:
             self.on_refresh_sprite()
         else:
             self.position = Vec2d(player.position) + self.offset
-        sprite_coordinates = level.map_to_world(self.position)
+        self.place(self.position)
+
+    def interpolate(self, player_position):
+        """Follow the player's sprite between ticks."""
+        if self.target_lock:
+            self.place(self.position)
+        else:
+            self.place(player_position + self.offset)
+
+    def place(self, position):
+        sprite_coordinates = level.map_to_world(position)
         self.sprite.set_position(*sprite_coordinates)
 
         viewport.position = self.sprite.position + self.offset * 40
@@ -2632,7 +3039,9 @@ def is_moving(v):
 
 
 
-robots = set()
+# the robots, in the order they arrived; a dict for the same reason
+# as bullets
+robots = {}
 shape_to_robot = {}
 
 robot_base_weapon = Weapon("robot base weapon",
@@ -2644,6 +3053,287 @@ robot_base_weapon = Weapon("robot base weapon",
     cls=Bullet)
 
 
+class PlayerVisibility:
+    """
+    Which robots can see the player, worked out a few times a second.
+
+    A robot that wants to know asks us to watch() it, and can then ask
+    can_see_player() as often as it likes.  Each robot gets a turn,
+    one tick of every period, when we watch() it, as with RobotLOD;
+    each tick we re-check the robots whose turn it is, so each one is
+    checked hz times a second, and the work is spread evenly over the
+    ticks.
+
+    We check by walking the tiles between the robot and the player
+    (collision.line_of_sight), rather than asking pymunk, so only the
+    wall tiles block the view; crates and the like don't.
+    """
+    def __init__(self, hz):
+        self.hz = hz
+        self.tick = 0
+        # robot -> whether it could see the player when last checked
+        self.visible = {}
+        # robot -> its turn
+        self.turn_of = {}
+        self.added = 0
+        self.clear()
+
+    def watch(self, robot):
+        if robot not in self.visible:
+            turn = self.turn_of[robot] = self.added % self.period
+            self.added += 1
+            self.turns[turn][robot] = None
+            self.visible[robot] = None
+
+    def forget(self, robot):
+        if robot in self.visible:
+            del self.turns[self.turn_of.pop(robot)][robot]
+            del self.visible[robot]
+
+    def clear(self):
+        self.visible.clear()
+        self.turn_of.clear()
+        # the engine's tick rate can change between levels (run_bench.py --hz)
+        self.period = max(1, round(ENGINE_TICKS_IN_HERTZ / self.hz))
+        # the robots we re-check on each tick of the period,
+        # in dicts used as sets; see robots
+        self.turns = [{} for i in range(self.period)]
+
+    def check(self, robot):
+        return collision.line_of_sight(level.walls, robot.position, player.position)
+
+    def can_see_player(self, robot):
+        visible = self.visible.get(robot)
+        if visible is None:
+            # not checked yet
+            visible = self.visible[robot] = bool(player) and self.check(robot)
+        return visible
+
+    def update(self):
+        """Re-check this tick's share of the robots."""
+        self.tick += 1
+        visible = self.visible
+        if not player:
+            for robot in visible:
+                visible[robot] = False
+            return
+        for robot in self.turns[self.tick % self.period]:
+            # a dozing robot can't see anything
+            if not robot.dozing:
+                visible[robot] = self.check(robot)
+
+
+visibility = PlayerVisibility(VISIBILITY_HZ)
+
+
+class RobotLOD:
+    """
+    Lets the robots far from the screen doze, so they cost next to nothing.
+
+    The robots within a circle round the viewport, margin tiles wider
+    than the screen (however it's turned), are active and updated
+    every tick as usual.  Further out than that a robot dozes:
+
+    * its body is made static where it stands, so pymunk doesn't
+      simulate it but bullets and robots still bump into it.  (Sleeping
+      would be the obvious way, but pymunk can crash freeing a space
+      with sleeping bodies in it; see BulletPool.)
+    * it and its behaviours are only updated on its turn, one tick in
+      every period, so its cooldowns count down slower and it shoots
+      less.  It doesn't move, whatever its behaviours say.
+    * it can't see the player; PlayerVisibility doesn't check it.
+    * its sprite is hidden.
+
+    It wakes when it's back within the circle, or when it's shot (at
+    the start of the next robot update, as pymunk won't let us change
+    a body while it's working out the collisions).  As with
+    PlayerVisibility we check a slice of the robots each tick, so the
+    robots far away cost us a period-th of a check and update each per
+    tick, and the tick's cost follows the robots near the player.  A
+    robot has to be a couple of tiles closer to wake than it was when
+    it dozed off, so one on the edge doesn't keep flickering.
+
+    Bosses never doze.
+    """
+    # how much further out than the circle a robot has to be to doze
+    HYSTERESIS = 2
+
+    def __init__(self, margin, hz):
+        # set this to False to keep every robot awake
+        self.enabled = True
+        self.margin = margin
+        self.hz = hz
+        self.tick = 0
+        self.robots = []
+        # these are all dicts used as sets, so they keep their order;
+        # see robots
+        self.dozing = {}
+        # dozing robots that have been shot since the last update
+        self.waking = {}
+        self.added = 0
+        self.clear()
+
+    @property
+    def turn(self):
+        """Which tick of the period this is."""
+        return self.tick % self.period
+
+    def watch(self, robot):
+        robot.turn = self.added % self.period
+        self.added += 1
+        self.robots.append(robot)
+
+    def forget(self, robot):
+        if robot.dozing:
+            del self.dozing[robot]
+            del self.turns[robot.turn][robot]
+            self.waking.pop(robot, None)
+        if robot in self.robots:
+            self.robots.remove(robot)
+
+    def clear(self):
+        self.robots.clear()
+        self.dozing.clear()
+        self.waking.clear()
+        # the engine's tick rate can change between levels (run_bench.py --hz)
+        self.period = max(1, round(ENGINE_TICKS_IN_HERTZ / self.hz))
+        # the dozing robots whose turn it is, on each tick of the period
+        self.turns = [{} for i in range(self.period)]
+
+    def doze(self, robot):
+        robot.dozing = True
+        self.dozing[robot] = None
+        self.turns[robot.turn][robot] = None
+        body = robot.body
+        body.body_type = pymunk.Body.STATIC
+        level.space.reindex_shapes_for_body(body)
+        robot.previous_position = robot.position
+        robot.sprite.visible = False
+        if robot in visibility.visible:
+            visibility.visible[robot] = False
+
+    def wake(self, robot):
+        robot.dozing = False
+        del self.dozing[robot]
+        del self.turns[robot.turn][robot]
+        # pymunk works out the mass of a body that becomes dynamic
+        # from its shapes, which have no density, so set it again
+        body = robot.body
+        body.body_type = pymunk.Body.DYNAMIC
+        body.mass = 1
+        body.moment = pymunk.inf
+        robot.sprite.visible = True
+        if robot in visibility.visible:
+            # look again when asked
+            visibility.visible[robot] = None
+
+    def on_damage(self, robot):
+        self.waking[robot] = None
+
+    def due(self, robots):
+        """Return the robots to update this tick."""
+        if not self.dozing:
+            return tuple(robots)
+        return (
+            *(robot for robot in robots if not robot.dozing),
+            *self.turns[self.turn],
+        )
+
+    def update(self):
+        """Doze or wake this tick's share of the robots."""
+        self.tick += 1
+        for robot in self.waking:
+            self.wake(robot)
+        self.waking.clear()
+        if not self.enabled:
+            return
+        x, y = level.world_to_map(viewport.position)
+        radius = math.hypot(viewport.w, viewport.h) / 2 / level.tilew + self.margin
+        for robot in self.robots[self.turn::self.period]:
+            px, py = robot.position
+            distance = math.hypot(px - x, py - y)
+            if robot.dozing:
+                if distance < radius:
+                    self.wake(robot)
+            elif distance > radius + self.HYSTERESIS:
+                self.doze(robot)
+
+
+robot_lod = RobotLOD(ROBOT_ACTIVE_MARGIN, DOZING_HZ)
+
+
+class FlowField:
+    """
+    Which way to go from every tile of the level to get to the player.
+
+    Rather than every robot finding its own way round the walls, we
+    work out how far every open tile is from the player's tile
+    (collision.distance_field) and from that which neighbour to step to
+    from each one (collision.flow_directions).  Then a robot anywhere
+    on the map looks up its next step in O(1).
+
+    The static objects on the map (gas tanks, screens, bosses) block
+    the way as much as the walls do, so we count the tiles under them
+    as walls too.  Call clear() when one goes away.
+
+    We only redo it when someone asks after the player has moved into
+    another tile.
+    """
+    def __init__(self):
+        self.walls = None
+        self.tile = None
+        self.step_x = self.step_y = None
+        # how many times we've worked it out
+        self.updates = 0
+
+    def clear(self):
+        self.walls = None
+        self.tile = None
+        self.step_x = self.step_y = None
+
+    def blocked(self):
+        """Return level.walls with the tiles under the static objects filled in."""
+        walls = level.walls.copy()
+        for o in level.objects:
+            body = getattr(o, 'body', None)
+            if body is None or body.body_type != pymunk.Body.STATIC:
+                continue
+            for shape in body.shapes:
+                bb = shape.bb
+                walls.fill(
+                    floor(bb.left + 1e-6),
+                    floor(bb.bottom + 1e-6),
+                    math.ceil(bb.right - 1e-6),
+                    math.ceil(bb.top - 1e-6),
+                )
+        return walls
+
+    def update(self):
+        """Bring us up to date with the player's tile; return False if there's no player."""
+        if not player:
+            return False
+        x, y = player.position
+        tile = (floor(x), floor(y))
+        if tile != self.tile:
+            if self.walls is None:
+                self.walls = self.blocked()
+            self.tile = tile
+            distances = collision.distance_field(self.walls, tile)
+            self.step_x, self.step_y = collision.flow_directions(distances)
+            self.updates += 1
+        return True
+
+    def step(self, x, y):
+        """Return the step (dx, dy) toward the player from tile (x, y)."""
+        height, width = self.step_x.shape
+        if 0 <= x < width and 0 <= y < height:
+            return int(self.step_x[y, x]), int(self.step_y[y, x])
+        return 0, 0
+
+
+flow_field = FlowField()
+
+
 class RobotBehaviour: # Dan, you're welcome, you don't know how much I want to omit the 'u'
     def __init__(self, robot):
         self.robot = robot
@@ -2746,7 +3436,7 @@ class RobotShootsConstantly(RobotBehaviour):
 
     def on_update(self, dt):
         if self.cooldown > 0:
-            self.cooldown -= 1
+            self.cooldown -= dt * COOLDOWN_HZ
             return
 
         if not player:
@@ -2763,20 +3453,17 @@ class RobotShootsOnlyWhenPlayerIsVisible(RobotBehaviour):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.cooldown = random.randint(100, 200)
+        visibility.watch(self.robot)
 
     def on_update(self, dt):
         if self.cooldown > 0:
-            self.cooldown -= 1
+            self.cooldown -= dt * COOLDOWN_HZ
             return
 
         if not player:
             return
 
-        collision = level.space.segment_query_first(self.robot.position,
-            player.position,
-            player.radius / 3, # TODO this shouldn't be hard-coded
-            level.robot_bullet_collision_filter)
-        if collision and collision.shape == player.shape:
+        if visibility.can_see_player(self.robot):
             vector_to_player = Vec2d(player.position) - self.robot.position
             bullet = self.robot.weapon.fire(self.robot, vector_to_player)
             self.cooldown = bullet.cooldown
@@ -2790,7 +3477,7 @@ class RobotMovesRandomly(RobotBehaviour):
         self.speed = speed or (1 + (random.random() * 2.5))
 
     def pick_new_vector(self):
-        # how many 1/120 tics should we move in this direction?
+        # how many 120ths of a second should we move in this direction?
         self.countdown = random.randint(60, 240)
         self.theta = random.random() * (2 * math.pi)
         self.robot.velocity = Vec2d(self.speed, 0)
@@ -2801,7 +3488,7 @@ class RobotMovesRandomly(RobotBehaviour):
 
     def on_update(self, dt):
         if self.countdown > 0:
-            self.countdown -= 1
+            self.countdown -= dt * COOLDOWN_HZ
             return
         self.pick_new_vector()
 
@@ -2857,21 +3544,29 @@ class RobotMovesInASquare(RobotChangesDirectionWhenItHitsAWall):
             speed)
 
 class RobotMovesStraightTowardsPlayer(RobotBehaviour):
+    # while we can see the player we head straight for them;
+    # otherwise we go round the walls, following the flow_field
+    # from the middle of one tile to the middle of the next
+
     def __init__(self, robot):
         super().__init__(robot)
         # how many units per second
         self.speed = (1 + (random.random() * 2.5))
-
-    # TODO if you have time: make it try to go around walls?
-    # def on_collision_wall(self, wall_shape):
-    #     self.pick_new_vector()
+        visibility.watch(self.robot)
 
     def on_update(self, dt):
-        if not player:
+        if not flow_field.update():
             if self.robot.velocity.x or self.robot.velocity.y:
                 self.robot.velocity = Vec2d(0, 0)
             return
-        vector = player.position - self.robot.position
+        position = self.robot.position
+        vector = player.position - position
+        if not visibility.can_see_player(self.robot):
+            x = floor(position.x)
+            y = floor(position.y)
+            dx, dy = flow_field.step(x, y)
+            if dx or dy:
+                vector = Vec2d(x + dx + 0.5, y + dy + 0.5) - position
         vector = vector.normalized() * self.speed
         self.robot.velocity = vector
 
@@ -2887,6 +3582,11 @@ class Robot:
         cls=Bullet
     )
     radius = 0.7071067811865476
+    cooldown_range = (180, 240)
+
+    # whether we can doze when we're far from the screen; see RobotLOD
+    dozes = True
+    dozing = False
 
     def __init__(self, position, evolution=0):
         # used only to calculate starting position of bullet
@@ -2895,6 +3595,7 @@ class Robot:
         self.bullet_speed = 15
 
         self.position = Vec2d(position)
+        self.previous_position = self.position
         self.velocity = Vec2d(0, 0)
 
         self.on_collision_wall_callbacks = []
@@ -2905,13 +3606,14 @@ class Robot:
 
         self.evolution = evolution
         self.health = 100 * (evolution + 1)
-        self.cooldown_range = (180, 240)
         self.cooldown = 0
 
         self.create_visuals()
         self.create_body()
 
-        robots.add(self)
+        robots[self] = None
+        if self.dozes:
+            robot_lod.watch(self)
 
     def create_visuals(self):
         self.sprite = EnemyRobotSprite(
@@ -2948,6 +3650,8 @@ class Robot:
         self.body.velocity = velocity
 
     def on_damage(self, damage):
+        if self.dozing:
+            robot_lod.on_damage(self)
         for fn in self.on_damage_callbacks:
             if fn(damage):
                 return
@@ -2957,6 +3661,7 @@ class Robot:
             self.on_died()
 
     def on_update(self, dt):
+        self.previous_position = self.position
         self.position = Vec2d(self.body.position)
         sprite_coordinates = level.map_to_world(self.position)
         self.sprite.position = sprite_coordinates
@@ -2967,8 +3672,15 @@ class Robot:
             if fn(dt):
                 return
 
+    def interpolate(self, alpha):
+        """Draw us alpha of the way from the last tick's position to this one's."""
+        position = self.previous_position.interpolate_to(self.position, alpha)
+        self.sprite.position = level.map_to_world(position)
+
     def delete(self):
-        robots.discard(self)
+        robots.pop(self, None)
+        visibility.forget(self)
+        robot_lod.forget(self)
         self.delete_body()
         self.delete_visuals()
         level.on_robot_destroyed(self)
@@ -2999,6 +3711,7 @@ class Boss(Robot):
     SPRITE = None
     radius = 1.2
     instance = None
+    dozes = False
 
     started = False
 
@@ -3031,11 +3744,15 @@ class Boss(Robot):
         self.sprite.delete()
         lighting.remove_light(self.light)
 
+    def interpolate(self, alpha):
+        # bosses don't move
+        pass
+
     def start(self):
         self.started = True
         self.sprite.sprite.color = (255,) * 3
         lighting.add_light(self.light)
-        robots.add(self)
+        robots[self] = None
 
     def update(self, dt):
         to_player = (player.body.position - self.body.position)
@@ -3054,6 +3771,7 @@ class Boss(Robot):
     def delete(self):
         super().delete()
         Boss.instance = None
+        flow_field.clear()
 
 
 class RobotSpins(RobotBehaviour):
@@ -3069,7 +3787,7 @@ class RobotSpins(RobotBehaviour):
         body.angular_velocity = (av + 1.0 * dt) * 0.9 ** dt
 
         if self.cooldown > 0:
-            self.cooldown -= 1
+            self.cooldown -= dt * COOLDOWN_HZ
             return
 
         v = Vec2d(0, 10).rotated(body.angle)
@@ -3166,8 +3884,8 @@ class Boss4(Boss):
 
 
 class Ray:
-    tex = pyglet.resource.texture('ray.png')
-    batch = pyglet.graphics.Batch()
+    tex = load_texture('ray.png')
+    batch = Batch()
     group = pyglet.sprite.SpriteGroup(
         tex,
         gl.GL_SRC_ALPHA,
@@ -3326,6 +4044,46 @@ def key_space(pressed):
     if pressed:
         game.on_space()
 
+@keypress(key.F3)
+def key_f3(pressed):
+    """Toggle the profiler and its frame time graph."""
+    if not pressed:
+        return
+    profiler.set_enabled(not profiler.enabled)
+    if hud:
+        hud.show_profile(profiler if profiler.enabled else None)
+
+@keypress(key.F4)
+def key_f4(pressed):
+    """Dump what the profiler has recorded as a Chrome trace."""
+    if pressed and profiler.events:
+        path = profiler.dump_trace()
+        print(f"wrote profiler trace to {os.path.abspath(path)}")
+
+@keypress(key.F5)
+def key_f5(pressed):
+    """Toggle GPU timer queries in the profiler."""
+    if pressed:
+        on = profiler.set_gpu_timing(not profiler.gpu)
+        print(f"profiler GPU timing {'on' if on else 'off (unsupported)'}")
+
+@keypress(key.F6)
+def key_f6(pressed):
+    """Cycle the resolution of the light map."""
+    if pressed:
+        i = LIGHT_MAP_SCALES.index(lighting.scale)
+        scale = LIGHT_MAP_SCALES[(i + 1) % len(LIGHT_MAP_SCALES)]
+        lighting.set_quality(scale=scale)
+        print(f"light map at {scale:g}x resolution")
+        print(framebuffer_pool.report())
+
+@keypress(key.F7)
+def key_f7(pressed):
+    """Print how much video memory our textures and framebuffers hold."""
+    if pressed and not HEADLESS:
+        print(texture_cache.report())
+        print(framebuffer_pool.report())
+
 @keypress(key._1)
 def key_1(pressed):
     if pressed and player:
@@ -3441,54 +4199,126 @@ def on_mouse_release(x, y, button, modifiers):
 
 @window.event
 def on_draw():
+    phase = profiler.phase
     gl.glClearColor(0, 0, 0, 1.0)
     window.clear()
     gl.glEnable(gl.GL_BLEND)
     gl.glDisable(gl.GL_DEPTH_TEST)
+    with phase('interpolate'):
+        interpolate(timestep.alpha)
     with viewport:
         gl.glClearColor(0xae / 0xff, 0x51 / 0xff, 0x39 / 0xff, 1.0)
-        with lighting.illuminate():
-            level.on_draw()
-            diffuse_system.draw()
-            RobotSprite.draw_diffuse()
-        level.bullet_batch.draw()
-        RobotSprite.draw_emit()
+        # the lights themselves are rendered as we leave illuminate()
+        with phase('lighting'), lighting.illuminate():
+            with phase('map'):
+                level.on_draw()
+            with phase('diffuse particles'):
+                diffuse_system.draw()
+            with phase('robots diffuse'):
+                RobotSprite.draw_diffuse()
+        with phase('bullets'):
+            bullet_swarm.update_vertices()
+            level.bullet_batch.draw()
+        with phase('robots emit'):
+            RobotSprite.draw_emit()
 
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE)
-        default_system.draw()
-        Ray.draw()
+        with phase('particles'):
+            default_system.draw()
+        with phase('rays'):
+            Ray.draw()
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-    if hud:
-        hud.draw()
-    game.on_draw()
+    with phase('hud'):
+        if hud:
+            hud.draw()
+        game.on_draw()
+    framebuffer_pool.end_frame()
+    profiler.end_frame()
+
+
+def interpolate(alpha):
+    """Move what we draw alpha of the way from the last tick to the latest.
+
+    The engine ticks at a fixed rate that doesn't match the frame rate,
+    so we're usually drawing partway between two ticks.
+    """
+    if game.paused():
+        # nothing's moving, so the last tick is where everything is
+        alpha = 1.0
+    if player:
+        player.interpolate(alpha)
+    for robot in robots:
+        if not robot.dozing:
+            robot.interpolate(alpha)
+    bullet_swarm.alpha = alpha
 
 
 def on_update(dt):
     if game.paused():
         return
 
-    level.space.step(dt)
+    phase = profiler.phase
+    with phase('physics', 'update'):
+        if BULLET_SWEEP:
+            sweep_bullets(dt)
+        level.space.step(dt)
     # print()
     # print("PLAYER", player.body.position)
-    if player:
-        player.on_player_moved()
-        player.on_update(dt)
-    for robot in tuple(robots):
-        robot.on_update(dt)
-    for bullet in tuple(bullets):
-        bullet.on_update(dt)
+    with phase('player', 'update'):
+        if player:
+            player.on_player_moved()
+            player.on_update(dt)
+    with phase('robot update', 'update'):
+        robot_lod.update()
+        for robot in robot_lod.due(robots):
+            robot.on_update(dt)
+        visibility.update()
+    with phase('bullet update', 'update'):
+        bullet_swarm.update(dt)
+        for bullet in tuple(bullets):
+            bullet.on_update(dt)
     # print()
-    for cls in BulletClasses:
-        if cls.finishing_tick:
-            cls.freelist.extend(cls.finishing_tick)
-            cls.finishing_tick.clear()
+    with phase('bullet pools', 'update'):
+        for cls in BulletClasses:
+            cls.pool.end_tick()
+
+
+
+def load_level(basename):
+    """Replace the current level with maps/{basename}.tmx and start playing.
 
+    This skips the level-complete and preshow screens, so it's mostly
+    useful in headless mode.
+    """
+    global level
+    if level:
+        level.close()
+    level = Level(basename)
+    game.is_final_level = True
+    level.start()
+    game.transition_to(GameState.PLAYING)
+
+
+def run_headless(basename, ticks):
+    """Run the simulation for a level as fast as possible.
+
+    Steps the engine at a fixed ENGINE_TICKS_IN_HERTZ, ticking the headless
+    clock alongside it so scheduled callbacks fire on simulation time.
+    Stops early if the game pauses (level complete, game over).
+    Returns (ticks run, seconds taken).
+    """
+    assert HEADLESS, "run_headless() needs headless.enable() before importing main"
+    dt = 1 / ENGINE_TICKS_IN_HERTZ
+    load_level(basename)
 
+    start = time.perf_counter()
+    tick = 0
+    while tick < ticks and not game.paused():
+        headless.clock.advance(dt)
+        on_update(dt)
+        tick += 1
+    return tick, time.perf_counter() - start
 
-pyglet.clock.schedule_interval(on_update, 1/ENGINE_TICKS_IN_HERTZ)
-pyglet.clock.schedule_interval(diffuse_system.update, (1.0/30.0))
-pyglet.clock.schedule_interval(default_system.update, (1.0/30.0))
-pyglet.clock.set_fps_limit(60)
 
 RobotSprite.load()
 BigSprite.load()
@@ -3499,4 +4329,20 @@ if Boss.instance:
 
 game = Game()
 
-pyglet.app.run()
+engine_tick = on_update
+if replay.recorder:
+    engine_tick = replay.recorder.attach(window, on_update, ENGINE_TICKS_IN_HERTZ)
+
+timestep = FixedTimestep(engine_tick, ENGINE_TICKS_IN_HERTZ, MAX_TICKS_PER_FRAME)
+
+if not HEADLESS:
+    pyglet.clock.schedule(timestep.advance)
+    pyglet.clock.schedule_interval(diffuse_system.update, (1.0/30.0))
+    pyglet.clock.schedule_interval(default_system.update, (1.0/30.0))
+    pyglet.clock.set_fps_limit(60)
+
+    try:
+        pyglet.app.run()
+    finally:
+        if replay.recorder:
+            print(replay.recorder.save())
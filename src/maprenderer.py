@@ -1,28 +1,23 @@
-import os.path
-from math import degrees
+from math import degrees, sin, cos
 
 import pyglet.graphics
 import pyglet.sprite
 from pyglet import gl
-import tmx
 
-from json_map import get_texture_sequence
 from lighting import Light
+from textures import cache as texture_cache
 
 
 class Viewport:
+    # created on first draw, so a Viewport doesn't need a GL context
+    vl = None
+
     def __init__(self, w, h):
         self.w = w
         self.h = h
         self.position = (0, 0)
         self.angle = 0
 
-        self.vl = pyglet.graphics.vertex_list(
-            4,
-            ('v2f/static', (0, 0, 1, 0, 1, 1, 0, 1)),
-            ('t2f/static', (0, 0, 1, 0, 1, 1, 0, 1))
-        )
-
     def bounds(self):
         """Return screen bounds as a tuple (l, r, b, t)."""
         w2 = self.w // 2
@@ -30,8 +25,26 @@ class Viewport:
         x, y = self.position
         return x - w2, x + w2, y - h2, y + h2
 
+    def world_bounds(self):
+        """Return (l, r, b, t) enclosing everything visible, allowing for
+        the rotation of the viewport."""
+        w2 = self.w / 2
+        h2 = self.h / 2
+        c = abs(cos(self.angle))
+        s = abs(sin(self.angle))
+        hw = w2 * c + h2 * s
+        hh = w2 * s + h2 * c
+        x, y = self.position
+        return x - hw, x + hw, y - hh, y + hh
+
     def draw_quad(self):
         """Draw a full-screen quad."""
+        if self.vl is None:
+            self.vl = pyglet.graphics.vertex_list(
+                4,
+                ('v2f/static', (0, 0, 1, 0, 1, 1, 0, 1)),
+                ('t2f/static', (0, 0, 1, 0, 1, 1, 0, 1))
+            )
         gl.glPushMatrix()
         gl.glLoadIdentity()
         gl.glScalef(self.w, self.h, 1.0)
@@ -51,111 +64,96 @@ class Viewport:
 
 
 class MapRenderer:
-    def __init__(self, tmxfile):
+    def __init__(self, level, graphics=True):
         self.shadow_casters = {}  # quick spatial hash of shadow casting tiles
-        self.load(tmxfile)
+        # with graphics=False we only read the tile properties
+        # (walls, lights) and never touch a texture or a vertex list
+        self.graphics = graphics
+        self.load(level)
+
+    def load(self, level):
+        """Build the vertex lists for the tiles in a levelcache.CompiledLevel."""
+        self.width = level.width
+        self.height = level.height
+
+        self.light_objects = [
+            Light(position, static=True) for position in level.lights
+        ]
+        self.shadow_casters = dict(level.shadow_casters)
+
+        tileset = level.tileset
+        self.tilew = tileset.tilewidth
+        self.tileh = tileset.tileheight
 
-    def load(self, tmxfile):
-        """Populate a batch with sprites from the tmx file."""
-        self.batch = pyglet.graphics.Batch()
-        self.width = tmxfile.width
-        self.height = tmxfile.height
+        self.collision_tiles = dict(level.wall_gids)
+        self.collision_gids = set(self.collision_tiles)
 
-        self.light_objects = []
+        self.chunks = {}
+        if not self.graphics:
+            return
 
-        tileset = [t for t in tmxfile.tilesets if 'object' not in t.name.lower()][0]
-        filename = tileset.image.source
-        self.tilew = tileset.tilewidth
-        self.tileh = tileset.tileheight
-        self.tiles_tex = get_texture_sequence(
-            os.path.basename(filename),
+        # every level uses the same tileset, so this is
+        # usually already loaded
+        self.tiles_tex = texture_cache.tileset(
+            tileset.image,
             self.tilew,
             self.tileh,
             tileset.margin,
             tileset.spacing
         )
 
-        # Build mapping of tile texture by gid
-        self.tiles = {}
-        self.light_tiles = {}
-        self.collision_gids = set()
-        self.collision_tiles = {}
-
+        # Build mapping of tile texture coordinates by gid
         rows = (tileset.tilecount + tileset.columns - 1) // tileset.columns
-
-        for tile in tileset.tiles:
-            y, x = divmod(tile.id, tileset.columns)
-            gid = tileset.firstgid + tile.id
+        tex_coords = {}
+        for tile_id in range(tileset.tilecount):
+            y, x = divmod(tile_id, tileset.columns)
             tex = self.tiles_tex[(rows - 1 - y), x]
-            tex.anchor_x = 0  # tex.width // 2
-            tex.anchor_y = 0  # tex.height // 2
-            self.tiles[gid] = tex
-
-            # Load which gids are collidable here
-            props = {p.name: p.value for p in tile.properties}
-            wall = int(props.get('wall', '0'))
-            if wall:
-                self.collision_gids.add(gid)
-                self.collision_tiles[gid] = int(wall)
-
-            if 'lightx' in props:
-                lightx = props['lightx']
-                lighty = props['lighty']
-                self.light_tiles[gid] = lightx, lighty
-
-        tile_layers = [l for l in tmxfile.layers if isinstance(l, tmx.Layer)]
-        self.sprites = {}
-
-        tile_map = bytearray()
-        verts = []
-        tcs = []
-        epsilon = 0
-        for layernum, layer in enumerate(tile_layers):
-            for i, tile in enumerate(layer.tiles):
-                if tile.gid == 0:
-                    continue
-                y, x = divmod(i, self.width)
-                y = self.height - y - 1
-
-                tex = self.tiles[tile.gid]
-
-                l = x * self.tilew - epsilon
-                t = y * self.tileh - epsilon
-                r = l + self.tilew + epsilon
-                b = t + self.tileh + epsilon
-
-                #verts.extend([l, b, l, t, r, t, r, b])
-                verts.extend([l, t, r, t, r, b, l, b, ])
-                # verts.extend([l, b, r, b, r, t, l, t])
-                tcs.extend(
-                    c for i, c in enumerate(tex.tex_coords) if i % 3 != 2
-                )
-
-                gid = tile.gid
-                if gid in self.collision_tiles:
-                    wall = self.collision_tiles[gid]
-                    self.shadow_casters[x, y] = wall
-
-                light = self.light_tiles.get(gid)
-                if light:
-                    lx, ly = light
-                    self.light_objects.append(
-                        Light((lx + x, ly + y))
-                    )
+            tex_coords[tileset.firstgid + tile_id] = tuple(
+                c for i, c in enumerate(tex.tex_coords) if i % 3 != 2
+            )
 
         self.group = pyglet.sprite.SpriteGroup(
             self.tiles_tex.get_texture(),
             gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA
             #gl.GL_ONE, gl.GL_ZERO
         )
-        self.vl = self.batch.add(
-            len(verts) // 2,
-            gl.GL_QUADS,
-            self.group,
-            ('v2i/static', verts),
-            ('t2f/static', tcs),
-        )
-
-    def render(self):
-        self.batch.draw()
+        # the map is drawn in square chunks (levelcache.CHUNK_SIZE tiles),
+        # each with its own vertex list, so only the chunks on screen are
+        # drawn.  tiles in different layers overlap, but chunks don't, so
+        # drawing each chunk's tiles in layer order keeps the layers right
+        self.chunk_size = level.chunk_size
+        for chunk, (verts, gids) in level.chunks.items():
+            tcs = [c for gid in gids for c in tex_coords[gid]]
+            self.chunks[chunk] = pyglet.graphics.vertex_list(
+                len(gids) * 4,
+                ('v2i/static', verts),
+                ('t2f/static', tcs),
+            )
+
+    def delete(self):
+        """Free the vertex lists."""
+        if self.graphics:
+            for vl in self.chunks.values():
+                vl.delete()
+            self.chunks.clear()
+
+    def visible_chunks(self, viewport):
+        """Yield the vertex lists of the chunks that viewport can see."""
+        l, r, b, t = viewport.world_bounds()
+        w = self.tilew * self.chunk_size
+        h = self.tileh * self.chunk_size
+        chunks = self.chunks
+        for cx in range(int(l // w), int(r // w) + 1):
+            for cy in range(int(b // h), int(t // h) + 1):
+                vl = chunks.get((cx, cy))
+                if vl:
+                    yield vl
+
+    def render(self, viewport):
+        if not self.graphics:
+            return
+        self.group.set_state()
+        for vl in self.visible_chunks(viewport):
+            vl.draw(gl.GL_QUADS)
+        self.group.unset_state()
 
@@ -12,6 +12,8 @@ from lepton.controller import Lifetime, Movement, Fader, ColorBlender, Growth
 
 from pymunk import Vec2d
 
+from textures import cache as texture_cache
+
 
 diffuse_system = ParticleSystem()
 
@@ -19,7 +21,7 @@ diffuse_system = ParticleSystem()
 class Trail:
     LIFETIME = 0.2
 
-    sprite = pyglet.resource.texture('trail.png')
+    sprite = texture_cache.texture('trail.png')
     group = ParticleGroup(
         controllers=[
             Lifetime(LIFETIME),
@@ -67,7 +69,7 @@ class Trail:
 class Smoke:
     LIFETIME = 0.8
 
-    sprite = pyglet.resource.texture('smoke.png')
+    sprite = texture_cache.texture('smoke.png')
     group = ParticleGroup(
         controllers=[
             Lifetime(LIFETIME),
@@ -120,7 +122,7 @@ class Impact:
 
     color = (0.9, 0.6, 0.2, 0.3)
 
-    spark_tex = pyglet.resource.texture('bullet.png')
+    spark_tex = texture_cache.texture('bullet.png')
     spark_texturizer = SpriteTexturizer(spark_tex.id)
 
     sparks = ParticleGroup(
@@ -151,7 +153,7 @@ class Debris:
 
     color = (1.0, 1.0, 1.0, 1.0)
 
-    fragment_tex = pyglet.resource.texture('fragment.png')
+    fragment_tex = texture_cache.texture('fragment.png')
     fragment_texturizer = SpriteTexturizer(fragment_tex.id)
 
     fragments = ParticleGroup(
@@ -186,7 +188,7 @@ class Kaboom:
 
     color = (0.9, 0.6, 0.2, 0.3)
 
-    spark_tex = pyglet.resource.texture('bullet.png')
+    spark_tex = texture_cache.texture('bullet.png')
     spark_texturizer = SpriteTexturizer(spark_tex.id)
 
     sparks = ParticleGroup(
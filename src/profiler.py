@@ -0,0 +1,277 @@
+"""Per-phase frame profiler.
+
+Wrap each phase of the frame in profiler.phase() and call end_frame()
+once per on_draw.  While the profiler is enabled it records how long each
+phase took (CPU wall time, and optionally GPU time from GL timer queries),
+can draw a stacked frame-time graph into the HUD, and can dump everything
+it has recorded as a Chrome trace (load it in chrome://tracing or
+https://ui.perfetto.dev).
+
+Phases nest; the graph shows each phase's self time, so nested phases
+aren't counted twice.
+"""
+import json
+import time
+from collections import deque
+from ctypes import byref
+
+import pyglet.graphics
+import pyglet.text
+from pyglet import gl
+
+
+FRAME_BUDGET = 1 / 60
+
+# colours for the phases in the graph, handed out in order of appearance
+PALETTE = [
+    (230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200),
+    (245, 130, 48), (145, 30, 180), (70, 240, 240), (240, 50, 230),
+    (210, 245, 60), (250, 190, 190), (0, 128, 128), (230, 190, 255),
+    (170, 110, 40), (255, 250, 200), (128, 0, 0), (170, 255, 195),
+]
+
+
+class GPUTimer:
+    """Brackets phases with GL_TIMESTAMP queries.
+
+    Results are read back a few frames later, once they are available, so
+    that we never stall the pipeline waiting for the GPU.
+    """
+
+    def __init__(self):
+        self.free = []
+        self.pending = deque()
+
+    @staticmethod
+    def supported():
+        return gl.gl_info.have_extension('GL_ARB_timer_query')
+
+    def _query(self):
+        if not self.free:
+            ids = (gl.GLuint * 32)()
+            gl.glGenQueries(32, ids)
+            self.free.extend(ids)
+        q = self.free.pop()
+        gl.glQueryCounter(q, gl.GL_TIMESTAMP)
+        return q
+
+    def begin(self):
+        return self._query()
+
+    def end(self, start_query, name, category, cpu_start):
+        self.pending.append((start_query, self._query(), name, category, cpu_start))
+
+    def collect(self):
+        """Yield (name, category, cpu start, gpu seconds) for finished queries."""
+        available = gl.GLint(0)
+        start = gl.GLuint64(0)
+        end = gl.GLuint64(0)
+        while self.pending:
+            q0, q1, name, category, cpu_start = self.pending[0]
+            gl.glGetQueryObjectiv(q1, gl.GL_QUERY_RESULT_AVAILABLE, byref(available))
+            if not available.value:
+                return
+            self.pending.popleft()
+            gl.glGetQueryObjectui64v(q0, gl.GL_QUERY_RESULT, byref(start))
+            gl.glGetQueryObjectui64v(q1, gl.GL_QUERY_RESULT, byref(end))
+            self.free.extend((q0, q1))
+            yield name, category, cpu_start, (end.value - start.value) * 1e-9
+
+
+class NullPhase:
+    """What Profiler.phase() hands out while the profiler is off."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase:
+    def __init__(self, profiler, name, category):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        # time spent in phases nested inside this one
+        self.child_time = 0.0
+        self.gpu = profiler.gpu if category == 'draw' else None
+
+    def __enter__(self):
+        if self.gpu:
+            self.query = self.gpu.begin()
+        self.profiler.stack.append(self)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        duration = time.perf_counter() - self.start
+        profiler = self.profiler
+        profiler.stack.pop()
+        if profiler.stack:
+            profiler.stack[-1].child_time += duration
+        profiler.record(self.name, self.category, self.start, duration, self.child_time)
+        if self.gpu:
+            self.gpu.end(self.query, self.name, self.category, self.start)
+
+
+class Profiler:
+    def __init__(self, history=120, trace_events=50000):
+        self.enabled = False
+        self.gpu = None
+        self.stack = []
+        # self time per phase for the frame in progress
+        self.current = {}
+        # one dict of {phase: self time} per completed frame
+        self.frames = deque(maxlen=history)
+        # (name, category, start, duration, thread) for the trace export
+        self.events = deque(maxlen=trace_events)
+        self.phase_names = []
+        self.epoch = time.perf_counter()
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        self.stack.clear()
+        self.current = {}
+
+    def set_gpu_timing(self, enabled):
+        """Turn GL timer queries on or off. Returns whether they're on."""
+        if enabled and GPUTimer.supported():
+            self.gpu = self.gpu or GPUTimer()
+        else:
+            self.gpu = None
+        return self.gpu is not None
+
+    def phase(self, name, category='draw'):
+        """Return a context manager that times the named phase."""
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name, category)
+
+    def record(self, name, category, start, duration, child_time):
+        self.current[name] = self.current.get(name, 0.0) + duration - child_time
+        self.events.append((name, category, start, duration, 'CPU'))
+        if name not in self.phase_names:
+            self.phase_names.append(name)
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self.frames.append(self.current)
+        self.current = {}
+        if self.gpu:
+            for name, category, start, duration in self.gpu.collect():
+                self.events.append((name, category, start, duration, 'GPU'))
+
+    def trace(self):
+        """Return the recorded events in Chrome trace event format."""
+        threads = {'CPU': 1, 'GPU': 2}
+        events = [
+            {
+                'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                'args': {'name': thread},
+            }
+            for thread, tid in threads.items()
+        ]
+        for name, category, start, duration, thread in self.events:
+            events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'pid': 1,
+                'tid': threads[thread],
+                'ts': round((start - self.epoch) * 1e6, 3),
+                'dur': round(duration * 1e6, 3),
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_trace(self, path=None):
+        """Write a Chrome trace JSON file and return its path."""
+        path = path or time.strftime('profile-%Y%m%d-%H%M%S.json')
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+        return path
+
+
+class ProfileGraph:
+    """A stacked bar graph of per-phase frame times, one bar per frame.
+
+    The white line marks the 60 fps frame budget.
+    """
+    BAR_WIDTH = 2
+    HEIGHT = 120
+    # pixels per second of frame time; the budget line sits at 2/3 height
+    SCALE = HEIGHT / (FRAME_BUDGET * 1.5)
+
+    def __init__(self, profiler, batch, x, y):
+        self.profiler = profiler
+        self.batch = batch
+        self.x = x
+        self.y = y
+        self.vl = None
+        self.labels = []
+
+        budget_y = y + FRAME_BUDGET * self.SCALE
+        width = profiler.frames.maxlen * self.BAR_WIDTH
+        self.budget_line = batch.add(
+            2, gl.GL_LINES, None,
+            ('v2f/static', (x, budget_y, x + width, budget_y)),
+            ('c3B/static', (255, 255, 255) * 2),
+        )
+
+    def delete(self):
+        self.budget_line.delete()
+        if self.vl:
+            self.vl.delete()
+        for label in self.labels:
+            label.delete()
+
+    def update_legend(self):
+        names = self.profiler.phase_names
+        x = self.x + self.profiler.frames.maxlen * self.BAR_WIDTH + 5
+        while len(self.labels) < len(names):
+            i = len(self.labels)
+            self.labels.append(pyglet.text.Label(
+                names[i],
+                font_size=8,
+                x=x,
+                y=self.y + self.HEIGHT - 10 * (i + 1),
+                color=(*PALETTE[i % len(PALETTE)], 255),
+                batch=self.batch,
+            ))
+
+    def update(self):
+        names = self.profiler.phase_names
+        frames = self.profiler.frames
+        if len(self.labels) < len(names):
+            self.update_legend()
+
+        verts = []
+        colors = []
+        x = self.x
+        for frame in frames:
+            y = self.y
+            for i, name in enumerate(names):
+                t = frame.get(name)
+                if not t:
+                    continue
+                top = y + t * self.SCALE
+                verts.extend((x, y, x + self.BAR_WIDTH, y, x + self.BAR_WIDTH, top, x, top))
+                colors.extend(PALETTE[i % len(PALETTE)] * 4)
+                y = top
+            x += self.BAR_WIDTH
+
+        count = len(verts) // 2
+        if not count:
+            return
+        if self.vl is None:
+            self.vl = self.batch.add(
+                count, gl.GL_QUADS, None,
+                'v2f/stream', 'c3B/stream'
+            )
+        elif self.vl.get_size() != count:
+            self.vl.resize(count)
+        self.vl.vertices = verts
+        self.vl.colors = colors
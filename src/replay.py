@@ -0,0 +1,220 @@
+"""Record a game's input, and play it back tick for tick.
+
+The simulation is deterministic apart from two things: the player's
+keyboard and mouse, and the random module (robot spawns and wanderings,
+weapon cooldowns, bounce angles).  So we write down which input events
+arrived before which engine tick, and reseed random at the start of
+every tick from one seed per recording.  Feed the same events back in
+before the same ticks and the engine does the same work again, tick for
+tick, which is what we want when comparing benchmark numbers across
+builds.
+
+To record, switch recording on before main is imported (as with
+headless mode); the recording is written when the game exits:
+
+    import replay
+    replay.record('boss.replay')
+    import main
+
+To play a recording back, load it and drive the engine with a Replayer,
+which calls main's window event handlers, and so reaches the Player,
+the Reticle and the Game just as the real window would:
+
+    replayer = Replayer(Recording.load('boss.replay'), main)
+    for tick in range(replayer.recording.ticks):
+        replayer.dispatch(tick)
+        headless.clock.advance(dt)
+        main.on_update(dt)
+
+Reseeding every tick (rather than once at the start) also means that
+anything that draws random numbers between ticks, like the particle
+effects, which only exist when there's a window, can't throw a replay
+off.
+
+Timers scheduled on the pyglet clock (respawning, light flashes) run on
+wall-clock time while recording but on simulation time when replayed
+headless, so if frames were being dropped while recording, those can
+land a few ticks later in the replay than they did in the game.  Two
+replays of the same recording always match.
+"""
+import gzip
+import json
+import random
+
+
+FORMAT = 1
+
+# the window events we record; a recorded event refers to its
+# type by index into this, to keep the file small
+EVENTS = (
+    'on_key_press',
+    'on_key_release',
+    'on_mouse_motion',
+    'on_mouse_drag',
+    'on_mouse_press',
+    'on_mouse_release',
+)
+
+
+def tick_seed(seed, tick):
+    """Return what to seed random with at the start of a tick."""
+    return seed * 2 ** 32 + tick
+
+
+class Recording:
+    """The input events of one game, and the seed it was played with.
+
+    events is a list of (tick, event name, args), in the order they
+    arrived; each was handled just before the engine ran that tick.
+    """
+
+    def __init__(self, seed, hz, ticks=0, events=None):
+        self.seed = seed
+        self.hz = hz
+        # how many engine ticks the game ran
+        self.ticks = ticks
+        self.events = events if events is not None else []
+
+    def save(self, path):
+        # ticks are stored as deltas, which are nearly always 0 or 1
+        packed = []
+        last = 0
+        for tick, name, args in self.events:
+            packed.append([tick - last, EVENTS.index(name), *args])
+            last = tick
+        data = {
+            'format': FORMAT,
+            'seed': self.seed,
+            'hz': self.hz,
+            'ticks': self.ticks,
+            'events': packed,
+        }
+        with gzip.open(path, 'wt', encoding='ascii') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='ascii') as f:
+            data = json.load(f)
+        if data.get('format') != FORMAT:
+            raise ValueError(f"{path} is not a recording we can play back")
+        events = []
+        tick = 0
+        for delta, index, *args in data['events']:
+            tick += delta
+            events.append((tick, EVENTS[index], tuple(args)))
+        return cls(data['seed'], data['hz'], data['ticks'], events)
+
+
+class TickSeeder:
+    """Reseeds random once per tick, before anything in that tick uses it."""
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.seeded = None
+
+    def reseed(self, tick):
+        if tick != self.seeded:
+            random.seed(tick_seed(self.seed, tick))
+            self.seeded = tick
+
+
+class Recorder(TickSeeder):
+    """Writes down the window's input events as the game is played.
+
+    attach() it to the window once the game's own event handlers are
+    set up, and run the engine ticks through what it returns, so we
+    know which tick is next.
+    """
+
+    def __init__(self, path, seed):
+        super().__init__(seed)
+        self.path = path
+        self.recording = Recording(seed, hz=None)
+        self.tick = 0
+
+    def attach(self, window, engine_tick, hz):
+        """Start recording window's events; return engine_tick wrapped for us."""
+        self.recording.hz = hz
+        # above the game's handlers, so we see every event first
+        window.push_handlers(self)
+
+        def tick(dt):
+            self.reseed(self.tick)
+            engine_tick(dt)
+            self.tick += 1
+        return tick
+
+    def record(self, name, *args):
+        # the event will be handled before the next tick runs,
+        # so it should see that tick's random numbers
+        self.reseed(self.tick)
+        self.recording.events.append((self.tick, name, args))
+
+    # these all return None, so the event carries on to the game
+
+    def on_key_press(self, symbol, modifiers):
+        self.record('on_key_press', symbol, modifiers)
+
+    def on_key_release(self, symbol, modifiers):
+        self.record('on_key_release', symbol, modifiers)
+
+    def on_mouse_motion(self, x, y, dx, dy):
+        self.record('on_mouse_motion', x, y, dx, dy)
+
+    def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
+        self.record('on_mouse_drag', x, y, dx, dy, buttons, modifiers)
+
+    def on_mouse_press(self, x, y, button, modifiers):
+        self.record('on_mouse_press', x, y, button, modifiers)
+
+    def on_mouse_release(self, x, y, button, modifiers):
+        self.record('on_mouse_release', x, y, button, modifiers)
+
+    def save(self):
+        self.recording.ticks = self.tick
+        self.recording.save(self.path)
+        return (
+            f"recorded {len(self.recording.events)} events over "
+            f"{self.tick} ticks to {self.path}"
+        )
+
+
+class Replayer(TickSeeder):
+    """Feeds a recording's events back to the game's event handlers.
+
+    handlers is anything with the window event handlers as attributes;
+    normally the main module.
+    """
+
+    def __init__(self, recording, handlers):
+        super().__init__(recording.seed)
+        self.recording = recording
+        self.handlers = handlers
+        self.events = recording.events
+        self.next_event = 0
+
+    def dispatch(self, tick):
+        """Reseed random for tick and handle every event due before it."""
+        self.reseed(tick)
+        events = self.events
+        while self.next_event < len(events) and events[self.next_event][0] <= tick:
+            _, name, args = events[self.next_event]
+            getattr(self.handlers, name)(*args)
+            self.next_event += 1
+
+
+# the Recorder for this game, if record() was called
+recorder = None
+
+
+def record(path, seed=None):
+    """Record the game about to be played to path.
+
+    Call this before main is imported.
+    """
+    global recorder
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    recorder = Recorder(path, seed)
+    return recorder
@@ -6,7 +6,99 @@
 #
 
 from pyglet.gl import *
-from ctypes import c_char_p, cast, pointer, POINTER, c_char, c_int, byref, create_string_buffer, c_float
+from ctypes import c_char_p, cast, pointer, POINTER, c_char, c_int, c_uint, byref, create_string_buffer, c_float
+from functools import partial
+
+# GL uniform type -> (setter for a single value, setter for arrays, components, element type)
+# matrices have no single value setter; they always go through glUniformMatrix*fv
+UNIFORM_TYPES = {
+    GL_FLOAT: (glUniform1f, glUniform1fv, 1, c_float),
+    GL_FLOAT_VEC2: (glUniform2f, glUniform2fv, 2, c_float),
+    GL_FLOAT_VEC3: (glUniform3f, glUniform3fv, 3, c_float),
+    GL_FLOAT_VEC4: (glUniform4f, glUniform4fv, 4, c_float),
+    GL_INT: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_INT_VEC2: (glUniform2i, glUniform2iv, 2, c_int),
+    GL_INT_VEC3: (glUniform3i, glUniform3iv, 3, c_int),
+    GL_INT_VEC4: (glUniform4i, glUniform4iv, 4, c_int),
+    GL_BOOL: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_BOOL_VEC2: (glUniform2i, glUniform2iv, 2, c_int),
+    GL_BOOL_VEC3: (glUniform3i, glUniform3iv, 3, c_int),
+    GL_BOOL_VEC4: (glUniform4i, glUniform4iv, 4, c_int),
+    GL_SAMPLER_1D: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_SAMPLER_2D: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_SAMPLER_3D: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_SAMPLER_CUBE: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_SAMPLER_1D_SHADOW: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_SAMPLER_2D_SHADOW: (glUniform1i, glUniform1iv, 1, c_int),
+    GL_FLOAT_MAT2: (None, glUniformMatrix2fv, 4, c_float),
+    GL_FLOAT_MAT3: (None, glUniformMatrix3fv, 9, c_float),
+    GL_FLOAT_MAT4: (None, glUniformMatrix4fv, 16, c_float),
+}
+
+# indexed by the number of values passed to uniformf/uniformi
+FLOAT_SETTERS = (None, glUniform1f, glUniform2f, glUniform3f, glUniform4f)
+INT_SETTERS = (None, glUniform1i, glUniform2i, glUniform3i, glUniform4i)
+
+
+def ignore(*vals):
+    # the setter handed out for uniforms the linker optimised away
+    pass
+
+
+class Uniform:
+    # an active uniform, as reported by the linker
+    # set(*vals) uploads it; vals are the flattened components,
+    # eg. set(x, y) for a vec2 or set(*mat) for a mat4
+    # the program must be currently bound
+    def __init__(self, name, location, type, size):
+        self.name = name
+        self.location = location
+        self.type = type
+        # the array length, or 1 if the uniform is not an array
+        self.size = size
+
+        scalar, vector, components, ctype = UNIFORM_TYPES[type]
+        # the total number of values set() takes
+        self.count = components * size
+        if scalar and size == 1:
+            # a single value: bind the location now, so setting it
+            # is one ctypes call
+            self.set = partial(scalar, location)
+        elif scalar:
+            self.set = partial(self._set_array, vector, location, size, ctype * self.count)
+        else:
+            self.set = partial(self._set_matrix, vector, location, size, ctype * self.count)
+
+    @staticmethod
+    def _set_array(fn, location, size, array_type, *vals):
+        fn(location, size, array_type(*vals))
+
+    @staticmethod
+    def _set_matrix(fn, location, size, array_type, *vals):
+        fn(location, size, False, array_type(*vals))
+
+
+class UniformGroup:
+    # a fixed list of uniforms that are always set together
+    # set() takes one value per uniform, in the order they were named:
+    # a number for single component uniforms, otherwise a sequence
+    def __init__(self, shader, names):
+        self.names = tuple(names)
+        # (setter, whether to unpack the value) for each uniform
+        self.setters = []
+        for name in self.names:
+            uniform = shader.uniforms.get(name)
+            if uniform is None:
+                self.setters.append((ignore, True))
+            else:
+                self.setters.append((uniform.set, uniform.count > 1))
+
+    def set(self, *values):
+        for (setter, unpack), value in zip(self.setters, values):
+            if unpack:
+                setter(*value)
+            else:
+                setter(value)
 
 class Shader:
     # vert, frag and geom take arrays of source strings
@@ -16,6 +108,8 @@ class Shader:
         self.handle = glCreateProgram()
         # we are not linked yet
         self.linked = False
+        # the active uniforms by name, filled in once we are linked
+        self.uniforms = {}
 
         # create the vertex shader
         self.createShader(vert, GL_VERTEX_SHADER)
@@ -78,6 +172,33 @@ class Shader:
         else:
             # all is well, so we are linked
             self.linked = True
+            # look up every uniform now, rather than on every upload
+            self.cache_uniforms()
+
+    def cache_uniforms(self):
+        self.uniforms = {}
+
+        count = c_int(0)
+        # retrieve the number of active uniforms
+        glGetProgramiv(self.handle, GL_ACTIVE_UNIFORMS, byref(count))
+        # and the length of the longest name
+        length = c_int(0)
+        glGetProgramiv(self.handle, GL_ACTIVE_UNIFORM_MAX_LENGTH, byref(length))
+
+        buffer = create_string_buffer(length.value + 1)
+        size = c_int(0)
+        type = c_uint(0)
+        for index in range(count.value):
+            glGetActiveUniform(self.handle, index, len(buffer), None, byref(size), byref(type), buffer)
+            # built-in uniforms (gl_ModelViewProjectionMatrix etc) have no location
+            location = glGetUniformLocation(self.handle, buffer.value)
+            if location < 0 or type.value not in UNIFORM_TYPES:
+                continue
+            name = buffer.value.decode('utf8')
+            # arrays are reported as 'name[0]'
+            if name.endswith('[0]'):
+                name = name[:-3]
+            self.uniforms[name] = Uniform(name, location, type.value, size.value)
 
     def bind(self):
         # bind the program
@@ -88,40 +209,47 @@ class Shader:
         # so this should probably be a class method instead
         glUseProgram(0)
 
+    # return the location of a uniform, or -1 if it isn't active
+    def location(self, name):
+        uniform = self.uniforms.get(name)
+        return uniform.location if uniform else -1
+
+    # return a function that uploads the named uniform
+    # look it up once and keep it, then call it as setter(*vals)
+    # this program must be currently bound when the setter is called
+    def setter(self, name):
+        uniform = self.uniforms.get(name)
+        return uniform.set if uniform else ignore
+
+    # return a UniformGroup for setting the named uniforms in one call
+    def uniform_group(self, *names):
+        return UniformGroup(self, names)
+
+    # upload several uniforms, given as name=value
+    # convenient, but for every frame uploads prefer uniform_group()
+    # this program must be currently bound
+    def set_uniforms(self, **values):
+        UniformGroup(self, values.keys()).set(*values.values())
+
     # upload a floating point uniform
     # this program must be currently bound
     def uniformf(self, name, *vals):
-        name = name.encode('utf8')
         # check there are 1-4 values
         if len(vals) in range(1, 5):
-            # select the correct function
-            { 1 : glUniform1f,
-                2 : glUniform2f,
-                3 : glUniform3f,
-                4 : glUniform4f
-                # retrieve the uniform location, and set
-            }[len(vals)](glGetUniformLocation(self.handle, name), *vals)
+            # select the correct function, and set at the cached location
+            FLOAT_SETTERS[len(vals)](self.location(name), *vals)
 
     # upload an integer uniform
     # this program must be currently bound
     def uniformi(self, name, *vals):
-        name = name.encode('utf8')
         # check there are 1-4 values
         if len(vals) in range(1, 5):
-            # select the correct function
-            { 1 : glUniform1i,
-                2 : glUniform2i,
-                3 : glUniform3i,
-                4 : glUniform4i
-                # retrieve the uniform location, and set
-            }[len(vals)](glGetUniformLocation(self.handle, name), *vals)
+            # select the correct function, and set at the cached location
+            INT_SETTERS[len(vals)](self.location(name), *vals)
 
     # upload a uniform matrix
     # works with matrices stored as lists,
     # as well as euclid matrices
     def uniform_matrixf(self, name, mat):
-        name = name.encode('utf8')
-        # obtian the uniform location
-        loc = glGetUniformLocation(self.handle, name)
         # uplaod the 4x4 floating point matrix
-        glUniformMatrix4fv(loc, 1, False, (c_float * 16)(*mat))
+        glUniformMatrix4fv(self.location(name), 1, False, (c_float * 16)(*mat))
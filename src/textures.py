@@ -0,0 +1,119 @@
+"""A process-wide cache of textures.
+
+pyglet.resource only keeps weak references to what it loads, so when a
+level closed, its tileset texture was freed and the next level uploaded
+the same mars_tiles.png all over again.  Everything that needs a texture
+gets it from the cache here instead, which holds on to it for the life
+of the process.
+
+Small images (up to ATLAS_MAX pixels square) are packed into shared
+atlas textures, so sprites from different files can be drawn without
+rebinding.  Anything that needs a texture to itself (because it is
+drawn with texture coordinates outside 0-1, or has its texture swapped
+out, like the robot sprites) should use texture() rather than image().
+"""
+import pyglet.image
+import pyglet.image.atlas
+import pyglet.resource
+
+from json_map import get_texture_sequence
+
+
+ATLAS_SIZE = 1024
+
+# images no bigger than this (in both dimensions) go in an atlas
+ATLAS_MAX = 256
+
+
+class TextureCache:
+    def __init__(self):
+        # filename -> image, maybe a region of an atlas
+        self.images = {}
+        # filename -> texture
+        self.textures = {}
+        # (image, tilewidth, tileheight, margin, spacing) -> TextureGrid
+        self.tilesets = {}
+        # (filename, rows, columns) -> TextureGrid
+        self.grids = {}
+        # created on first use, so importing us doesn't need a GL context
+        self.atlases = None
+        # texture ids of the atlases we've packed images into
+        self.atlas_ids = set()
+
+    def _load(self, filename):
+        with pyglet.resource.file(filename) as f:
+            return pyglet.image.load(filename, file=f)
+
+    def image(self, filename):
+        """Return the named resource image, packed into an atlas if it's small."""
+        image = self.images.get(filename)
+        if image is None:
+            data = self._load(filename)
+            if data.width <= ATLAS_MAX and data.height <= ATLAS_MAX:
+                if self.atlases is None:
+                    self.atlases = pyglet.image.atlas.TextureBin(ATLAS_SIZE, ATLAS_SIZE)
+                image = self.atlases.add(data)
+                self.atlas_ids.add(image.owner.id)
+            else:
+                image = data.get_texture()
+            self.images[filename] = image
+        return image
+
+    def texture(self, filename):
+        """Return the named resource image as a texture of its own."""
+        texture = self.textures.get(filename)
+        if texture is None:
+            texture = self.textures[filename] = self._load(filename).get_texture()
+        return texture
+
+    def grid(self, filename, rows, columns):
+        """Return an image cut into a rows x columns TextureGrid."""
+        key = (filename, rows, columns)
+        grid = self.grids.get(key)
+        if grid is None:
+            grid = self.grids[key] = pyglet.image.ImageGrid(
+                image=self.image(filename),
+                rows=rows,
+                columns=columns,
+            ).get_texture_sequence()
+        return grid
+
+    def tileset(self, image, tilewidth, tileheight, margin, spacing):
+        """Return the TextureGrid for the tiles of a tileset image."""
+        key = (image, tilewidth, tileheight, margin, spacing)
+        grid = self.tilesets.get(key)
+        if grid is None:
+            grid = self.tilesets[key] = get_texture_sequence(
+                image, tilewidth, tileheight, margin, spacing
+            )
+        return grid
+
+    def resident(self):
+        """Return {texture id: (width, height)} for every texture we hold."""
+        textures = {}
+        everything = [
+            *self.images.values(),
+            *self.textures.values(),
+            *self.tilesets.values(),
+            *self.grids.values(),
+        ]
+        for image in everything:
+            texture = getattr(image, 'owner', None) or image
+            textures[texture.id] = (texture.width, texture.height)
+        return textures
+
+    def vram(self):
+        """Return roughly how many bytes of texture memory we hold (RGBA8)."""
+        return sum(w * h * 4 for w, h in self.resident().values())
+
+    def report(self):
+        resident = self.resident()
+        return (
+            f"textures: {len(resident)} resident ({self.vram() / 2 ** 20:.1f} MiB), "
+            f"{len(self.atlas_ids)} of them atlases, "
+            f"{len(self.tilesets)} tilesets"
+        )
+
+
+# the cache shared by everything
+cache = TextureCache()
@@ -0,0 +1,55 @@
+"""Fixed-timestep engine ticks.
+
+pyglet calls us with however much time has passed since last time,
+which depends on the frame rate and on how busy the machine is.  The
+engine (physics, and the cooldowns that count ticks) wants every tick
+to be the same length, so we bank the time pyglet hands us and pay it
+out one fixed tick at a time:
+
+    timestep = FixedTimestep(on_update, hz=120, max_ticks=6)
+    pyglet.clock.schedule(timestep.advance)
+
+Whatever is left over, less than one tick, is how far we are into the
+next tick; alpha is that as a fraction, for drawing things partway
+between where the last two ticks left them.
+
+If a frame is so slow that we owe more than max_ticks ticks, we run
+max_ticks and drop the rest, and the game slows down for a moment.
+Catching up on all of them would make the next frame slower still,
+and so on: the spiral of death.
+"""
+
+
+class FixedTimestep:
+    def __init__(self, tick, hz, max_ticks):
+        # called with the tick length, once per tick
+        self.tick = tick
+        self.dt = 1 / hz
+        self.max_ticks = max_ticks
+        # time we owe the engine, in seconds
+        self.accumulator = 0.0
+        self.ticks = 0
+        # ticks we gave up on to keep up
+        self.dropped = 0
+
+    @property
+    def alpha(self):
+        """How far we are from the last tick to the next, from 0 to 1."""
+        return min(self.accumulator / self.dt, 1.0)
+
+    def advance(self, elapsed):
+        """Bank elapsed seconds, then run every tick that's now due."""
+        self.accumulator += elapsed
+        due = int(self.accumulator / self.dt)
+        if due > self.max_ticks:
+            self.dropped += due - self.max_ticks
+            self.accumulator -= (due - self.max_ticks) * self.dt
+            due = self.max_ticks
+        for i in range(due):
+            self.tick(self.dt)
+            self.accumulator -= self.dt
+        self.ticks += due
+        return due
+
+    def report(self):
+        return f"engine: {self.ticks} ticks, {self.dropped} dropped to keep up"